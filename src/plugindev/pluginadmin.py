@@ -1,5 +1,6 @@
 import configparser
 import datetime as dt
+import json
 import os
 import re
 import shlex
@@ -225,6 +226,145 @@ def install_qgis_into_venv(
     print(final_message)
 
 
+# script that `benchmark-startup` runs in a fresh Python interpreter. It starts
+# a headless QGIS, loads a project, sets the plugin up the same way QGIS does and
+# prints the duration of each stage as JSON
+_STARTUP_BENCHMARK_SCRIPT = """
+import json
+import sys
+import time
+
+import qgis.core
+from qgis.PyQt import QtCore
+from qgis.testing import start_app
+from qgis.testing.mocked import get_iface
+
+application = start_app()
+sys.path.append(qgis.core.QgsApplication.pkgDataPath() + "/python/plugins")
+from processing.core.Processing import Processing
+Processing.initialize()
+
+project = qgis.core.QgsProject.instance()
+project_path = {project_path!r}
+if project_path is not None:
+    if not project.read(project_path):
+        raise SystemExit(f"Could not read project {{project_path!r}}")
+else:
+    for layer_index in range({num_layers}):
+        layer = qgis.core.QgsVectorLayer(
+            "Polygon?crs=EPSG:3857&field=node_id:integer&field=area:double",
+            f"layer {{layer_index}}",
+            "memory"
+        )
+        features = []
+        for feature_index in range({num_features}):
+            feature = qgis.core.QgsFeature(layer.fields())
+            x_min = feature_index * 10
+            feature.setGeometry(
+                qgis.core.QgsGeometry.fromRect(qgis.core.QgsRectangle(x_min, 0, x_min + 5, 5)))
+            feature.setAttributes([feature_index + 1, 25.0])
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        project.addMapLayer(layer)
+
+settings = qgis.core.QgsSettings()
+settings_key = "PythonPlugins/{src_name}/lazy_startup"
+previous_lazy_startup = settings.value(settings_key)
+settings.setValue(settings_key, {lazy_startup})
+try:
+    durations = {{}}
+    start = time.perf_counter()
+    import {src_name}
+    durations["import"] = time.perf_counter() - start
+    start = time.perf_counter()
+    plugin = {src_name}.classFactory(get_iface())
+    durations["class_factory"] = time.perf_counter() - start
+    start = time.perf_counter()
+    plugin.initGui()
+    durations["init_gui"] = time.perf_counter() - start
+    if not {lazy_startup}:
+        loop = QtCore.QEventLoop()
+        plugin.analysis_scheduler.analysis_finished.connect(loop.quit)
+        QtCore.QTimer.singleShot({analysis_timeout_ms}, loop.quit)
+        loop.exec_()
+        durations["layer_analysis"] = time.perf_counter() - start
+    plugin.unload()
+finally:
+    if previous_lazy_startup is None:
+        settings.remove(settings_key)
+    else:
+        settings.setValue(settings_key, previous_lazy_startup)
+print(json.dumps(durations))
+"""
+
+
+@app.command()
+def benchmark_startup(
+    context: typer.Context,
+    repetitions: int = 5,
+    project: typing.Optional[Path] = None,
+    num_layers: int = 20,
+    num_features: int = 1000,
+    lazy_startup: bool = False,
+    analysis_timeout: float = 600,
+):
+    """Measure how long it takes for the plugin to start up in QGIS.
+
+    Each measurement is done in a fresh Python interpreter running a headless
+    QGIS, so that modules which have already been imported do not skew the
+    results. The plugin is loaded with `classFactory(iface).initGui()`, like
+    QGIS does, after opening `project` or, if it is not given, after adding
+    `num_layers` memory layers with `num_features` polygons each. When not using
+    lazy startup, the time until the loaded layers have been analyzed, which
+    includes the debounce interval of the analysis, is also measured.
+
+    This requires QGIS to be importable, for example after running
+    `install-qgis-into-venv`. The time spent by QGIS in each stage of the
+    plugin's startup is also recorded in the QGIS runtime profiler, under the
+    'startup' group.
+    """
+    measure_code = _STARTUP_BENCHMARK_SCRIPT.format(
+        src_name=SRC_NAME,
+        project_path=str(project.resolve()) if project is not None else None,
+        num_layers=num_layers,
+        num_features=num_features,
+        lazy_startup=lazy_startup,
+        analysis_timeout_ms=int(analysis_timeout * 1000),
+    )
+    env = {
+        **os.environ,
+        "QT_QPA_PLATFORM": os.getenv("QT_QPA_PLATFORM", "offscreen"),
+        "PYTHONPATH": os.pathsep.join(
+            p for p in (str(LOCAL_ROOT_DIR / "src"), os.getenv("PYTHONPATH")) if p
+        ),
+    }
+    durations = {}
+    for repetition in range(repetitions):
+        completed = subprocess.run(
+            [sys.executable, "-c", measure_code],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            print(f"Could not start the plugin:\n{completed.stderr}")
+            raise typer.Exit(code=1)
+        run_durations = json.loads(completed.stdout.strip().splitlines()[-1])
+        for stage, duration in run_durations.items():
+            durations.setdefault(stage, []).append(duration)
+        if context.obj["verbose"]:
+            details = ", ".join(
+                f"{stage}: {duration * 1000:.1f} ms" for stage, duration in run_durations.items())
+            print(f"Run {repetition + 1}: {details}")
+    for stage, stage_durations in durations.items():
+        stage_durations.sort()
+        print(
+            f"{stage!r} took {stage_durations[0] * 1000:.1f} ms at best and "
+            f"{stage_durations[len(stage_durations) // 2] * 1000:.1f} ms on median, "
+            f"over {repetitions} runs"
+        )
+
+
 @app.command()
 def generate_plugin_repo_xml(
     context: typer.Context,
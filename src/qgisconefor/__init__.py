@@ -1,7 +1,12 @@
-from qgis.gui import QgisInterface
+from typing import TYPE_CHECKING
 
+if TYPE_CHECKING:
+    # only imported for type checking, so that the package, including the
+    # headless sharding command, can be imported without the QGIS GUI
+    from qgis.gui import QgisInterface
 
-def classFactory(iface: QgisInterface):
+
+def classFactory(iface: "QgisInterface"):
     from .main import QgisConefor
 
     return QgisConefor(iface)
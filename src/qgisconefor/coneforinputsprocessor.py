@@ -1,16 +1,42 @@
+import dataclasses
+import itertools
 from pathlib import Path
 from typing import (
     Callable,
+    Iterable,
+    Iterator,
     Optional,
+    Sequence,
     Union,
 )
 
+import numpy as np
 import qgis.core
 from qgis.PyQt import (
     QtCore,
 )
 
-from .utilities import log
+from . import (
+    distances,
+    edgedistances,
+    featurerequests,
+    nodeids,
+    nodestore,
+    parallel,
+    progress,
+    textfiles,
+)
+from .schemas import (
+    ConeforNodeConnectionType,
+    LogVerbosity,
+    NodeConnectionType,
+    QgisConeforSettingsKey,
+)
+from .utilities import (
+    RateLimitedLogger,
+    load_settings_key,
+    log,
+)
 
 _NUMERIC_FIELD_TYPES = (
     QtCore.QMetaType.Int,
@@ -36,6 +62,13 @@ _IDENTIFIER_FIELD_TYPES = (
     QtCore.QMetaType.UShort,
 )
 
+# providers whose data source can compute field profiles with SQL aggregates
+_AGGREGATE_PUSHDOWN_PROVIDERS = (
+    "ogr",
+    "spatialite",
+    "postgres",
+)
+
 _BINARY_FIELD_TYPES = (
     QtCore.QMetaType.Int,
     QtCore.QMetaType.Short,
@@ -48,22 +81,229 @@ _BINARY_FIELD_TYPES = (
 )
 
 
+_MEBIBYTE = 1024 * 1024
+
+# number of nearest neighbour pairs that are passed on to the file writer at once
+_NEAREST_NEIGHBOUR_CHUNK_PAIRS = 65_536
+
+
 class InvalidAttributeError(Exception):
     pass
 
 
+@dataclasses.dataclass
+class FieldProfile:
+    """Summary of the values of a layer field, as needed for validating Conefor node fields.
+
+    Like `uniqueValues()`, `distinct_count` counts NULL as one more distinct
+    value. `is_binary` is only true when all values are either 0 or 1.
+    """
+
+    field: qgis.core.QgsField
+    num_features: int = 0
+    distinct_count: int = 0
+    null_count: int = 0
+    min_value: Optional[float] = None
+    max_value: Optional[float] = None
+    is_binary: bool = True
+
+    @property
+    def has_unique_values(self) -> bool:
+        return self.distinct_count == self.num_features
+
+
+def _is_null(value) -> bool:
+    return value is None or (isinstance(value, QtCore.QVariant) and value.isNull())
+
+
+def _quote_identifier(identifier: str) -> str:
+    escaped = identifier.replace('"', '""')
+    return f'"{escaped}"'
+
+
+def _get_aggregate_pushdown_target(
+        layer: qgis.core.QgsVectorLayer
+) -> Optional[tuple[qgis.core.QgsAbstractDatabaseProviderConnection, str]]:
+    """Return a database connection and the quoted table of a layer, if it supports pushdown.
+
+    Pushdown is only used for GeoPackage, SpatiaLite and PostGIS layers without
+    unsaved edits and whose filter, if any, is a plain SQL `WHERE` clause.
+    """
+    provider_name = layer.providerType()
+    subset = layer.subsetString().strip()
+    has_pending_edits = layer.isEditable() and layer.isModified()
+    if (
+            provider_name not in _AGGREGATE_PUSHDOWN_PROVIDERS or
+            has_pending_edits or
+            subset.lower().startswith("select")
+    ):
+        return None
+    provider_registry = qgis.core.QgsProviderRegistry.instance()
+    if provider_name == "ogr":
+        uri_parts = provider_registry.decodeUri(provider_name, layer.source())
+        path = uri_parts.get("path", "")
+        layer_name = uri_parts.get("layerName")
+        if not path.lower().endswith(".gpkg") or not layer_name:
+            return None
+        connection_uri = path
+        table = _quote_identifier(layer_name)
+    else:
+        data_source_uri = qgis.core.QgsDataSourceUri(layer.source())
+        is_query_layer = data_source_uri.table().startswith("(")
+        if data_source_uri.table() == "" or is_query_layer or data_source_uri.sql() != "":
+            return None
+        connection_uri = layer.source()
+        table = _quote_identifier(data_source_uri.table())
+        if data_source_uri.schema() != "":
+            table = f"{_quote_identifier(data_source_uri.schema())}.{table}"
+    metadata = provider_registry.providerMetadata(provider_name)
+    try:
+        connection = metadata.createConnection(connection_uri, {})
+    except qgis.core.QgsProviderConnectionException:
+        return None
+    return connection, table
+
+
+def _profile_fields_with_aggregates(
+        layer: qgis.core.QgsVectorLayer,
+        field_names: list[str],
+) -> Optional[dict[str, FieldProfile]]:
+    """Profile fields with a single SQL aggregate query that runs in the data source.
+
+    Returns `None` when the layer's provider does not support this, in which case
+    the fields must be profiled in Python.
+    """
+    target = _get_aggregate_pushdown_target(layer)
+    if target is None:
+        return None
+    connection, table = target
+    columns = ["COUNT(*)"]
+    for name in field_names:
+        column = _quote_identifier(name)
+        columns.extend(
+            (
+                f"COUNT(DISTINCT {column})",
+                f"SUM(CASE WHEN {column} IS NULL THEN 1 ELSE 0 END)",
+                f"MIN({column})",
+                f"MAX({column})",
+                f"SUM(CASE WHEN {column} IN (0, 1) THEN 0 ELSE 1 END)",
+            )
+        )
+    query = f"SELECT {', '.join(columns)} FROM {table}"
+    subset = layer.subsetString().strip()
+    if subset != "":
+        query = f"{query} WHERE {subset}"
+    try:
+        rows = connection.executeSql(query)
+    except qgis.core.QgsProviderConnectionException as err:
+        log(
+            f"Could not profile fields of layer {layer.name()!r} in its data source, "
+            f"profiling them in Python instead - {err}",
+            verbosity=LogVerbosity.VERBOSE
+        )
+        return None
+    values = [None if _is_null(value) else value for value in rows[0]]
+    num_features = int(values[0])
+    fields = layer.fields()
+    result = {}
+    for position, name in enumerate(field_names):
+        distinct, nulls, min_value, max_value, non_binary = values[1 + position * 5:6 + position * 5]
+        null_count = int(nulls or 0)
+        result[name] = FieldProfile(
+            field=fields.at(fields.lookupField(name)),
+            num_features=num_features,
+            # COUNT(DISTINCT) ignores NULL, whereas profiles count it as a value
+            distinct_count=int(distinct or 0) + (1 if null_count > 0 else 0),
+            null_count=null_count,
+            min_value=min_value,
+            max_value=max_value,
+            is_binary=int(non_binary or 0) == 0,
+        )
+    return result
+
+
+def profile_fields(
+        feature_source: Union[
+            qgis.core.QgsVectorLayer, qgis.core.QgsProcessingFeatureSource],
+        field_names: Iterable[str],
+) -> dict[str, FieldProfile]:
+    """Profile several fields of a layer in a single pass over its features.
+
+    For GeoPackage, SpatiaLite and PostGIS layers, the profile is computed by
+    the data source itself, with SQL aggregates. Other sources are profiled in
+    Python, requesting only the attributes of the profiled fields, without
+    geometries.
+    """
+    field_names = list(dict.fromkeys(field_names))
+    if len(field_names) == 0:
+        return {}
+    if isinstance(feature_source, qgis.core.QgsVectorLayer):
+        pushed_down = _profile_fields_with_aggregates(feature_source, field_names)
+        if pushed_down is not None:
+            return pushed_down
+    fields = feature_source.fields()
+    field_indexes = {name: fields.lookupField(name) for name in field_names}
+    result = {
+        name: FieldProfile(field=fields.at(index)) for name, index in field_indexes.items()}
+    distinct_values = {name: set() for name in field_indexes}
+    request = qgis.core.QgsFeatureRequest()
+    request.setFlags(qgis.core.QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(list(field_indexes.values()))
+    num_features = 0
+    for feat in feature_source.getFeatures(request):
+        num_features += 1
+        attributes = feat.attributes()
+        for name, index in field_indexes.items():
+            value = attributes[index]
+            profile = result[name]
+            if _is_null(value):
+                profile.null_count += 1
+                profile.is_binary = False
+                distinct_values[name].add(None)
+            else:
+                distinct_values[name].add(value)
+                if profile.min_value is None or value < profile.min_value:
+                    profile.min_value = value
+                if profile.max_value is None or value > profile.max_value:
+                    profile.max_value = value
+                if value not in (0, 1):
+                    profile.is_binary = False
+    for name, profile in result.items():
+        profile.num_features = num_features
+        profile.distinct_count = len(distinct_values[name])
+    return result
+
+
+def profile_candidate_fields(
+        feature_source: Union[
+            qgis.core.QgsVectorLayer, qgis.core.QgsProcessingFeatureSource],
+) -> dict[str, FieldProfile]:
+    """Profile those fields whose type makes them candidates for node ids or 'nodes to add'."""
+    return profile_fields(
+        feature_source,
+        [
+            field.name() for field in feature_source.fields()
+            if field.type() in _IDENTIFIER_FIELD_TYPES + _BINARY_FIELD_TYPES
+        ]
+    )
+
+
 def validate_node_identifier_attribute(
         feature_source: Union[
             qgis.core.QgsVectorLayer, qgis.core.QgsProcessingFeatureSource],
         field: qgis.core.QgsField,
+        profile: Optional[FieldProfile] = None,
 ) -> bool:
     is_eligible = field.type() in _IDENTIFIER_FIELD_TYPES
-    field_index = list(feature_source.fields()).index(field)
-    has_unique_values = (
-            feature_source.featureCount() ==
-            len(feature_source.uniqueValues(field_index))
-    )
-    return is_eligible and has_unique_values
+    if is_eligible:
+        if profile is None:
+            profile = profile_fields(feature_source, [field.name()])[field.name()]
+        has_unique_values = profile.has_unique_values
+        fits_node_ids = profile.max_value is None or profile.max_value <= nodeids.MAX_NODE_ID
+    else:
+        has_unique_values = False
+        fits_node_ids = False
+    return is_eligible and has_unique_values and fits_node_ids
 
 
 def validate_node_attribute(
@@ -78,48 +318,31 @@ def validate_node_to_add_attribute(
         feature_source: Union[
             qgis.core.QgsVectorLayer, qgis.core.QgsProcessingFeatureSource],
         field: qgis.core.QgsField,
+        profile: Optional[FieldProfile] = None,
 ) -> bool:
     is_eligible = field.type() in _BINARY_FIELD_TYPES
-    field_index = list(feature_source.fields()).index(field)
-    has_only_binary_values = set(feature_source.uniqueValues(field_index)) <= {0, 1}
+    if is_eligible:
+        if profile is None:
+            profile = profile_fields(feature_source, [field.name()])[field.name()]
+        has_only_binary_values = profile.is_binary
+    else:
+        has_only_binary_values = False
     return is_eligible and has_only_binary_values
 
 
-def get_output_path(tentative_path: Path) -> Path:
-    """
-    Rename the output name if it is already present in the directory.
-    """
+def get_writer_memory_budget() -> int:
+    """Return the memory budget of each file writer, in bytes, from the plugin settings.
 
-    index = 1
-    while True:
-        if index == 1:
-            to_check = tentative_path
-        else:
-            original_file_name = tentative_path.stem
-            suffix = tentative_path.suffix
-            new_name = f"{original_file_name}_{index}{suffix}"
-            to_check = tentative_path.parent / new_name
-        if not to_check.exists():
-            return to_check
-        else:
-            index += 1
-
-
-def save_text_file(
-        data,
-        tentative_output_path: Path,
-        encoding: Optional[str] = "utf-8",
-) -> Path:
-    tentative_output_path.parent.mkdir(parents=True, exist_ok=True)
-    output_path = get_output_path(tentative_output_path)
-    sorted_data = sorted(data, key=lambda tup: tup[0])
-    with output_path.open(encoding=encoding, mode="w") as fh:
-        for tup in sorted_data:
-            line = "\t".join(str(i) for i in tup)
-            fh.write(f"{line}\n")
-        # Conefor manual states that files should terminate with a blank line
-        fh.write("\n")
-    return output_path
+    The setting is given in MiB.
+    """
+    default_budget = textfiles.DEFAULT_WRITER_MEMORY_BUDGET // _MEBIBYTE
+    raw_budget = load_settings_key(
+        QgisConeforSettingsKey.WRITER_MEMORY_BUDGET, default_to=default_budget)
+    try:
+        requested = int(raw_budget)
+    except (TypeError, ValueError):
+        requested = default_budget
+    return max(requested, 1) * _MEBIBYTE
 
 
 def get_measurer(
@@ -132,203 +355,765 @@ def get_measurer(
     return measurer
 
 
-def generate_node_file_by_attribute(
-    node_id_field_name: str,
-    node_attribute_field_name: str,
-    nodes_to_add_field_name: Optional[str],
-    feature_iterator_factory: Callable[[], qgis.core.QgsFeatureIterator],
+def get_area_calculator(
+        source_crs: qgis.core.QgsCoordinateReferenceSystem,
+        area_unit: Optional[qgis.core.Qgis.AreaUnit] = None,
+) -> Callable[[qgis.core.QgsGeometry], Optional[float]]:
+    """Return a function that computes the ellipsoidal area of geometries.
+
+    All geometries are measured with the same measurer. Areas are converted to
+    `area_unit` when it is given. Null and empty geometries have no area.
+    """
+    measurer = get_measurer(source_crs)
+    if area_unit is not None:
+        conversion_factor = qgis.core.QgsUnitTypes.fromUnitToUnitFactor(
+            measurer.areaUnits(), area_unit)
+    else:
+        conversion_factor = 1.0
+
+    def calculate_area(geometry: qgis.core.QgsGeometry) -> Optional[float]:
+        if geometry.isNull() or geometry.isEmpty():
+            return None
+        return measurer.measureArea(geometry) * conversion_factor
+
+    return calculate_area
+
+
+def _append_node_record(
+        records: textfiles.ConeforRecordBuffer,
+        node_id,
+        attribute,
+        nodes_to_add_value,
+        uses_nodes_to_add: bool,
+        attribute_description: str,
+        logger: RateLimitedLogger,
+) -> bool:
+    """Append the row of a node to the node file records, if its attribute is valid.
+
+    Skipped nodes are counted by `logger`, and only described one by one at
+    debug verbosity. Returns whether the row has been appended.
+    """
+    appended = False
+    if attribute is not None:
+        if attribute >= 0:
+            if uses_nodes_to_add:
+                if nodes_to_add_value is not None:
+                    records.append((node_id, attribute, nodes_to_add_value))
+                else:
+                    raise qgis.core.QgsProcessingException(
+                        f"node id {node_id!r} has invalid value for the 'nodes to add' "
+                        f"attribute. Conefor expects 'nodes to add' to be "
+                        f"either 0 or 1 - found a value of "
+                        f"{nodes_to_add_value!r}."
+                    )
+            else:
+                records.append((node_id, attribute))
+            appended = True
+        else:
+            logger.count("features with a negative node attribute were skipped")
+            if logger.should_emit(
+                    LogVerbosity.DEBUG, key="features with a negative node attribute"):
+                logger.info(
+                    f"Feature with id {node_id!r}: Attribute "
+                    f"{attribute_description} "
+                    f"has value: {attribute!r} - this is lower than zero. Skipping this "
+                    f"feature...",
+                    verbosity=LogVerbosity.DEBUG,
+                    key="features with a negative node attribute"
+                )
+    else:
+        logger.count("features without a node attribute were skipped")
+        if logger.should_emit(LogVerbosity.DEBUG, key="features without a node attribute"):
+            logger.info(
+                f"Was not able to retrieve a valid value for node attribute "
+                f"for node with id ({node_id!r}), skipping this feature...",
+                verbosity=LogVerbosity.DEBUG,
+                key="features without a node attribute"
+            )
+    return appended
+
+
+def _get_attribute_description(node_attribute_field_name: Optional[str]) -> str:
+    return repr(node_attribute_field_name) if node_attribute_field_name is not None else "area"
+
+
+def generate_node_file_from_store(
+    nodes: nodestore.NodeStore,
     output_path: Path,
     progress_callback: Optional[Callable[[int], None]],
     progress_step: float,
     start_progress: int = 0,
     info_callback: Optional[Callable[[str], None]] = log,
+    writer_memory_budget: int = textfiles.DEFAULT_WRITER_MEMORY_BUDGET,
+    attribute_description: str = "node attribute",
+) -> Optional[Path]:
+    """Generate Conefor node file from nodes that have already been read."""
+    writer = textfiles.ConeforTextFileWriter(
+        output_path, memory_budget=writer_memory_budget)
+    with writer:
+        uses_nodes_to_add = nodes.nodes_to_add is not None
+        records = textfiles.ConeforRecordBuffer(3 if uses_nodes_to_add else 2)
+        reporter = progress.ProgressReporter(
+            progress_callback,
+            info_callback=info_callback,
+            start_progress=start_progress,
+            progress_step=progress_step,
+            unit="nodes",
+        )
+        logger = RateLimitedLogger(info_callback)
+        nodes_to_add = nodes.nodes_to_add if uses_nodes_to_add else itertools.repeat(None)
+        for node_id, attribute, nodes_to_add_value in zip(
+                nodes.node_ids, nodes.attributes, nodes_to_add):
+            appended = _append_node_record(
+                records,
+                node_id,
+                attribute,
+                nodes_to_add_value,
+                uses_nodes_to_add,
+                attribute_description,
+                logger
+            )
+            if appended:
+                reporter.advance()
+        logger.flush()
+        reporter.finish()
+        info_callback("Finishing attribute file...")
+        writer.write_buffer(records)
+        result = writer.close()
+        if result is None:
+            info_callback("Was not able to extract any data")
+        return result
 
+
+def _transform_distances(
+        distances_: Union[np.ndarray, Iterable[float]],
+        distance_transform: Optional[Callable[[np.ndarray], np.ndarray]],
+):
+    return distance_transform(np.asarray(distances_)) if distance_transform is not None else distances_
+
+
+def _write_nearest_neighbour_pairs(
+        writer: textfiles.ConeforTextFileWriter,
+        nearest_neighbours: Iterator[tuple[int, Sequence[int], Sequence[float]]],
+        node_ids: np.ndarray,
+        num_neighbours: int,
+        reporter: progress.ProgressReporter,
+        info_callback: Callable[[str], None],
+        max_distance: Optional[float] = None,
+        distance_transform: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+) -> None:
+    """Write the pairs that link each node to its nearest neighbours, each pair only once.
+
+    `nearest_neighbours` yields the nodes' positions in ascending order, along
+    with the positions of their neighbours and the distances to them. Pairs are
+    passed on to `writer` in chunks, which sorts them within its memory budget.
+    A pair of nodes that are neighbours of each other is written with the
+    distance measured from the earlier node. Only the neighbours of each node
+    are kept until the end, taking eight bytes each.
+    """
+    node_neighbours = np.full((len(node_ids), num_neighbours), -1, dtype=np.int64)
+    pending = []
+    num_pending = 0
+    for row, neighbours, neighbour_distances in nearest_neighbours:
+        if reporter.is_cancelled():
+            info_callback("Aborting...")
+            break
+        neighbours = np.asarray(neighbours, dtype=np.int64)
+        neighbour_distances = np.asarray(neighbour_distances, dtype=np.float64)
+        if max_distance is not None:
+            within = neighbour_distances <= max_distance
+            neighbours = neighbours[within]
+            neighbour_distances = neighbour_distances[within]
+        node_neighbours[row, :neighbours.size] = neighbours
+        # pairs with an earlier node have already been written when this node
+        # is one of its neighbours, while later nodes have no neighbours yet
+        is_new = ~(node_neighbours[neighbours] == row).any(axis=1)
+        pending.append((row, neighbours[is_new], neighbour_distances[is_new]))
+        num_pending += pending[-1][1].size
+        if num_pending >= _NEAREST_NEIGHBOUR_CHUNK_PAIRS:
+            _write_pending_pairs(writer, pending, node_ids, distance_transform)
+            pending = []
+            num_pending = 0
+        reporter.advance(num_neighbours)
+    _write_pending_pairs(writer, pending, node_ids, distance_transform)
+
+
+def _write_pending_pairs(
+        writer: textfiles.ConeforTextFileWriter,
+        pending: list[tuple[int, np.ndarray, np.ndarray]],
+        node_ids: np.ndarray,
+        distance_transform: Optional[Callable[[np.ndarray], np.ndarray]],
+) -> None:
+    if len(pending) == 0:
+        return
+    rows = np.concatenate(
+        [np.full(neighbours.size, row, dtype=np.int64) for row, neighbours, _ in pending])
+    cols = np.concatenate([neighbours for _, neighbours, _ in pending])
+    pair_distances = np.concatenate([distances_ for _, _, distances_ in pending])
+    writer.write_buffer(
+        textfiles.ConeforRecordBuffer.from_columns(
+            node_ids[np.minimum(rows, cols)],
+            node_ids[np.maximum(rows, cols)],
+            _transform_distances(pair_distances, distance_transform)
+        )
+    )
+
+
+def write_connection_file_with_centroid_distances(
+    centroids: distances.CentroidStore,
+    crs: qgis.core.QgsCoordinateReferenceSystem,
+    output_path: Path,
+    progress_callback: Optional[Callable[[int], None]],
+    progress_step: float,
+    start_progress: int = 0,
+    info_callback: Optional[Callable[[str], None]] = log,
+    cancelled_callback: Optional[Callable[[], bool]] = None,
+    use_geodesic_kernel: bool = False,
+    max_distance: Optional[float] = None,
+    num_nearest_neighbours: Optional[int] = None,
+    num_workers: int = 1,
+    writer_memory_budget: int = textfiles.DEFAULT_WRITER_MEMORY_BUDGET,
+    decimal_places: Optional[int] = None,
+    distance_transform: Optional[Callable[[np.ndarray], np.ndarray]] = None,
 ) -> Optional[Path]:
-    """Generate Conefor node file using each feature's attribute as the node attribute."""
+    """Write Conefor connection file with the distances between already extracted centroids.
 
-    data = []
-    current_progress = start_progress
-    seen_ids = set()
-    for feat in feature_iterator_factory():
-        info_callback(f"Processing feature {feat.id()}...")
-        if len(list(feat.geometry().constParts())) > 1:
-            log(
-                f"Feature {feat.id()} has multiple parts",
-                level=qgis.core.Qgis.Warning
+    Distances are computed in blocks of node pairs.
+
+    When `use_geodesic_kernel` is set and the CRS is geographic, ellipsoidal
+    distances are computed with a batched geodesic kernel, whose results match
+    those of `QgsDistanceArea.measureLine()` to within
+    `distances.GEODESIC_KERNEL_TOLERANCE` meters.
+
+    When `max_distance` is given, only the pairs of nodes whose distance is not
+    greater than it are written, and candidate pairs are found with a KD-tree.
+
+    When `num_nearest_neighbours` is given, only the pairs that link each node to
+    its nearest neighbours are written.
+
+    When `num_workers` is greater than one, all pairs are measured by that many
+    worker processes, each taking row blocks of the upper triangle with similar
+    numbers of pairs. Blocks are written in the same order as when measuring in
+    a single process and each pair is measured with the same operations, which
+    makes the file identical. Distances that need `QgsDistanceArea` are always
+    measured in a single process, as are those limited by `max_distance` and
+    nearest neighbours.
+
+    When `distance_transform` is given, it is applied to the distances before
+    writing them, for example for turning them into probabilities. Pairs are
+    still selected by their distance.
+
+    Rows are written as they are produced. At most `writer_memory_budget` bytes
+    are used for sorting them, when they are not produced in order. Distances
+    are written with `decimal_places` decimals, or with full precision when it
+    is `None`.
+    """
+
+    writer = textfiles.ConeforTextFileWriter(
+        output_path, memory_budget=writer_memory_budget, decimal_places=decimal_places)
+    with writer:
+        measurer = get_measurer(crs)
+        num_nodes = len(centroids.node_ids)
+        reporter = progress.ProgressReporter(
+            progress_callback,
+            cancelled_callback=cancelled_callback,
+            info_callback=info_callback,
+            start_progress=start_progress,
+            progress_step=progress_step,
+            total_items=(
+                num_nodes * num_nearest_neighbours if num_nearest_neighbours is not None
+                else num_nodes * (num_nodes - 1) // 2
+            ),
+            unit="pairs",
+        )
+        engine = distances.CentroidDistanceEngine(
+            centroids.coordinates, measurer, use_geodesic_kernel=use_geodesic_kernel)
+        if use_geodesic_kernel and not engine.uses_geodesic_kernel:
+            info_callback(
+                "The batched geodesic kernel is only used with geographic CRSs and an "
+                "ellipsoid - measuring distances with the QGIS distance calculator instead"
             )
-        id_ = feat[node_id_field_name]
-        if id_ not in seen_ids:
-            attr = feat[node_attribute_field_name]
-            if attr is not None:
-                if attr >= 0:
-                    if nodes_to_add_field_name is not None:
-                        nodes_to_add_attr_value = feat[nodes_to_add_field_name]
-                        if nodes_to_add_attr_value is not None:
-                            data.append((id_, attr, nodes_to_add_attr_value))
-                        else:
-                            raise qgis.core.QgsProcessingException(
-                                f"node id {id_!r} has invalid value for the 'nodes to add' "
-                                f"attribute. Conefor expects 'nodes to add' to be "
-                                f"either 0 or 1 - found a value of "
-                                f"{nodes_to_add_attr_value!r}."
-                            )
-                    else:
-                        data.append((id_, attr))
-                    seen_ids.add(id_)
-                    current_progress += progress_step
-                    progress_callback(int(current_progress))
-                else:
-                    info_callback(
-                        f"Feature with id {id_!r}: Attribute "
-                        f"{node_attribute_field_name!r} "
-                        f"has value: {attr!r} - this is lower than zero. Skipping this "
-                        f"feature...",
+        node_ids = np.asarray(centroids.node_ids)
+        if num_nearest_neighbours is not None:
+            info_callback(
+                f"Finding the {num_nearest_neighbours} nearest neighbours of each node...")
+            _write_nearest_neighbour_pairs(
+                writer,
+                engine.iter_nearest_neighbours(num_nearest_neighbours),
+                node_ids,
+                num_nearest_neighbours,
+                reporter,
+                info_callback,
+                max_distance=max_distance,
+                distance_transform=distance_transform,
+            )
+        elif num_workers > 1 and max_distance is None and engine.supports_worker_processes:
+            info_callback(
+                f"Computing {engine.num_pairs} centroid distances with {num_workers} "
+                f"worker processes..."
+            )
+            worker_pool = parallel.WorkerPool(
+                num_workers, distances.initialize_worker, engine.get_worker_arguments())
+            with worker_pool:
+                row_blocks = list(
+                    parallel.iter_balanced_row_blocks(
+                        num_nodes, num_workers, max_pairs_per_block=engine.max_pairs_per_block)
+                )
+                results = worker_pool.iter_ordered_results(
+                    distances.measure_row_block,
+                    row_blocks,
+                    reporter.is_cancelled,
+                    max_pending_tasks=2 * num_workers,
+                )
+                for (row_start, row_end), block_distances in zip(row_blocks, results):
+                    rows, cols = distances.get_upper_triangle_pairs(
+                        num_nodes, row_start, row_end)
+                    if engine.uses_geodesic_kernel:
+                        block_distances = engine.fill_not_converged(rows, cols, block_distances)
+                    writer.write_buffer(
+                        textfiles.ConeforRecordBuffer.from_columns(
+                            node_ids[rows],
+                            node_ids[cols],
+                            _transform_distances(block_distances, distance_transform)
+                        )
                     )
+                    reporter.advance(rows.size)
+        else:
+            if num_workers > 1:
+                info_callback(
+                    "Worker processes are only used for measuring all pairs with planar "
+                    "distances or the batched geodesic kernel - using a single process"
+                )
+            if max_distance is None:
+                info_callback(f"Computing {engine.num_pairs} centroid distances...")
             else:
                 info_callback(
-                    f"Was not able to retrieve a valid value for node attribute "
-                    f"for node with id ({id_!r}), skipping this feature...",
+                    f"Computing centroid distances not greater than {max_distance}...")
+            for block in engine.iter_blocks(max_distance=max_distance):
+                if reporter.is_cancelled():
+                    info_callback("Aborting...")
+                    break
+                writer.write_buffer(
+                    textfiles.ConeforRecordBuffer.from_columns(
+                        node_ids[block.rows],
+                        node_ids[block.cols],
+                        _transform_distances(block.distances, distance_transform)
+                    )
                 )
+                reporter.advance(block.num_triangle_pairs(engine.num_nodes))
 
+        reporter.finish()
+        info_callback("Finishing connections file...")
+        if not reporter.is_cancelled(force_poll=True):
+            result = writer.close()
+            if result is None:
+                info_callback("Was not able to extract any data")
+            return result
         else:
-            raise qgis.core.QgsProcessingException(
-                f"node id {id_!r} is not unique. Conefor node identifiers must be "
-                f"unique - Please select another layer field."
-            )
-        # current_progress += (end_progress - start_progress)/num_features
-        # progress_callback(int(start_progress + current_progress))
-    info_callback("Writing attribute file...")
-    if len(data) > 0:
-        return save_text_file(data, output_path)
-    else:
-        info_callback("Was not able to extract any data")
-        return None
+            writer.discard()
+            info_callback("Did not write any output file, processing has been aborted")
 
 
-def generate_connection_file_with_centroid_distances(
-    node_id_field_name: str,
+def write_connection_file_with_edge_distances(
+    store: edgedistances.GeometryStore,
     crs: qgis.core.QgsCoordinateReferenceSystem,
-    feature_iterator_factory: Callable[[], qgis.core.QgsFeatureIterator],
-    num_features: int,
     output_path: Path,
     progress_callback: Optional[Callable[[int], None]],
     progress_step: float,
     start_progress: int = 0,
     info_callback: Optional[Callable[[str], None]] = log,
     cancelled_callback: Optional[Callable[[], bool]] = None,
+    max_distance: Optional[float] = None,
+    num_nearest_neighbours: Optional[int] = None,
+    prepared_geometry_cache_budget: int = (
+            edgedistances.DEFAULT_PREPARED_GEOMETRY_CACHE_BUDGET),
+    statistics: Optional[edgedistances.EdgeDistanceStatistics] = None,
+    num_workers: int = 1,
+    writer_memory_budget: int = textfiles.DEFAULT_WRITER_MEMORY_BUDGET,
+    decimal_places: Optional[int] = None,
+    distance_transform: Optional[Callable[[np.ndarray], np.ndarray]] = None,
 ) -> Optional[Path]:
-    data = []
-    measurer = get_measurer(crs)
-    current_progress = start_progress
-    seen_ids = set()
-    for feat in feature_iterator_factory():
-        feat_id = feat[node_id_field_name]
-        if feat_id not in seen_ids:
-            seen_ids.add(feat_id)
-            info_callback(f"Processing feature {feat_id}...")
-            feat_centroid = feat.geometry().centroid().asPoint()
-            for pair_feat in feature_iterator_factory():
-                should_abort = cancelled_callback() if cancelled_callback is not None else False
-                if should_abort:
+    """Write Conefor connection file with the distances between the edges of already extracted geometries.
+
+    Nodes with a null or empty geometry are skipped, as there is no distance
+    between them and other nodes.
+
+    Geometries of layers with a geographic CRS are reprojected in place, only
+    once, and measured in a local projected CRS which is chosen automatically.
+    Distances are measured with prepared GEOS geometries, which are kept in a
+    cache whose size is limited by `prepared_geometry_cache_budget` bytes.
+
+    When `max_distance` is given, only the pairs of nodes whose distance is not
+    greater than it are written. Candidate pairs are then found with an R-tree of
+    the features' bounding boxes and those whose parts' bounding boxes are already
+    farther apart than `max_distance` are pruned before measuring their exact
+    distance.
+
+    When `num_nearest_neighbours` is given, only the pairs that link each node to
+    its nearest neighbours are written. These are found with nearest neighbour
+    queries on an R-tree which stores the features' geometries.
+
+    When `num_workers` is greater than one, the upper triangle of the pairs
+    matrix is split into balanced row blocks, which are measured by that many
+    worker processes. Only a few blocks are submitted ahead of the one being
+    written, which keeps memory bounded. Their results are merged in the same
+    order as when measuring in a single process. Nearest neighbours are always measured in a
+    single process.
+
+    When `distance_transform` is given, it is applied to the distances before
+    writing them, for example for turning them into probabilities. Pairs are
+    still selected by their distance.
+
+    The counts of candidate, pruned and measured pairs are recorded in
+    `statistics`, when it is given.
+
+    Rows are written as they are produced. At most `writer_memory_budget` bytes
+    are used for sorting them, when they are not produced in order. Distances
+    are written with `decimal_places` decimals, or with full precision when it
+    is `None`.
+    """
+
+    writer = textfiles.ConeforTextFileWriter(
+        output_path, memory_budget=writer_memory_budget, decimal_places=decimal_places)
+    with writer:
+        statistics = (
+            statistics if statistics is not None
+            else edgedistances.EdgeDistanceStatistics()
+        )
+        store, num_without_geometry = edgedistances.drop_empty_geometries(store)
+        if num_without_geometry > 0:
+            info_callback(
+                f"Skipping {num_without_geometry} nodes with a null or empty geometry - "
+                f"they are not connected to any other node"
+            )
+        num_nodes = len(store)
+        reporter = progress.ProgressReporter(
+            progress_callback,
+            cancelled_callback=cancelled_callback,
+            info_callback=info_callback,
+            start_progress=start_progress,
+            progress_step=progress_step,
+            total_items=(
+                num_nodes * num_nearest_neighbours if num_nearest_neighbours is not None
+                else num_nodes * (num_nodes - 1) // 2
+            ),
+            unit="pairs",
+        )
+        node_ids = np.asarray(store.node_ids)
+        if crs.isGeographic():
+            projected_crs = edgedistances.get_local_projected_crs(store.extent())
+            info_callback(
+                f"Layer has a geographic CRS - measuring edge distances in "
+                f"{projected_crs.description() or projected_crs.toProj()!r}..."
+            )
+            edgedistances.reproject_geometries(store, crs, projected_crs)
+        prepared_geometries = edgedistances.PreparedGeometryCache(
+            store.geometries, prepared_geometry_cache_budget)
+        if num_nearest_neighbours is not None:
+            nearest_neighbours = edgedistances.iter_nearest_neighbours(
+                store, num_nearest_neighbours, prepared_geometries)
+
+            def count_measured_pairs(nearest_neighbours_):
+                for row, neighbours, neighbour_distances in nearest_neighbours_:
+                    statistics.candidate_pairs += len(neighbours)
+                    statistics.measured_pairs += len(neighbours)
+                    yield row, neighbours, neighbour_distances
+
+            _write_nearest_neighbour_pairs(
+                writer,
+                count_measured_pairs(nearest_neighbours),
+                node_ids,
+                num_nearest_neighbours,
+                reporter,
+                info_callback,
+                max_distance=max_distance,
+                distance_transform=distance_transform,
+            )
+        elif num_workers > 1:
+            info_callback(f"Measuring edge distances with {num_workers} worker processes...")
+            worker_pool = parallel.WorkerPool(
+                num_workers,
+                edgedistances.initialize_worker,
+                (
+                    edgedistances.serialize_geometries(store.geometries),
+                    max_distance,
+                    prepared_geometry_cache_budget,
+                )
+            )
+            with worker_pool:
+                row_blocks = parallel.iter_balanced_row_blocks(
+                    len(store),
+                    num_workers,
+                    max_pairs_per_block=distances.DEFAULT_MAX_PAIRS_PER_BLOCK
+                )
+                results = worker_pool.iter_ordered_results(
+                    edgedistances.measure_row_block,
+                    row_blocks,
+                    reporter.is_cancelled,
+                    max_pending_tasks=2 * num_workers,
+                )
+                for block, block_statistics in results:
+                    statistics.add(block_statistics)
+                    writer.write_buffer(
+                        textfiles.ConeforRecordBuffer.from_columns(
+                            node_ids[block.rows],
+                            node_ids[block.cols],
+                            _transform_distances(block.distances, distance_transform)
+                        )
+                    )
+                    reporter.advance(block.num_triangle_pairs(len(store)))
+        else:
+            if max_distance is None:
+                candidate_pairs = edgedistances.iter_all_pairs(store)
+            else:
+                candidate_pairs = edgedistances.iter_candidate_pairs_within_distance(
+                    store, max_distance)
+                bounding_box_filter = edgedistances.BoundingBoxDistanceFilter(store.geometries)
+            for row, candidates in candidate_pairs:
+                if reporter.is_cancelled():
                     info_callback("Aborting...")
                     break
-                if pair_feat.id() > feat.id():
-                    pair_feat_id = pair_feat[node_id_field_name]
-                    pair_centroid = pair_feat.geometry().centroid().asPoint()
-                    centroid_distance = measurer.measureLine([feat_centroid, pair_centroid])
-                    data.append((feat_id, pair_feat_id, centroid_distance))
-                    current_progress += progress_step
-                    progress_callback(int(current_progress))
-            else:
-                # this `else` block belongs to the inner `for` block and
-                # it gets executed if the `for` loop is able to run until
-                # completion (i.e. is not stopped by a `break`).
-                # current_progress += (end_progress - start_progress) / num_features
-                # progress_callback(int(start_progress + current_progress))
-                continue
-            # if the inner loop did not run until completion, then the outer loop should `break` too
-            break
+                statistics.candidate_pairs += len(candidates)
+                if max_distance is not None:
+                    num_candidates = len(candidates)
+                    candidates = bounding_box_filter.filter_candidates(
+                        row, candidates, max_distance)
+                    statistics.pruned_pairs += num_candidates - len(candidates)
+                statistics.measured_pairs += len(candidates)
+                cols = []
+                edge_distances = []
+                for col in candidates:
+                    edge_distance = prepared_geometries.distance(row, col)
+                    if max_distance is None or edge_distance <= max_distance:
+                        cols.append(col)
+                        edge_distances.append(edge_distance)
+                writer.write_buffer(
+                    textfiles.ConeforRecordBuffer.from_columns(
+                        np.full(len(cols), node_ids[row]),
+                        node_ids[np.array(cols, dtype=np.int64)],
+                        _transform_distances(
+                            np.array(edge_distances, dtype=np.float64), distance_transform)
+                    )
+                )
+                reporter.advance(len(store) - 1 - row)
+        statistics.connections = writer.num_rows
+        info_callback(
+            f"Edge distances: {statistics.candidate_pairs} candidate pairs, "
+            f"{statistics.pruned_pairs} pruned by bounding box distance, "
+            f"{statistics.measured_pairs} measured, {statistics.connections} connections"
+        )
+        reporter.finish()
+        info_callback("Finishing edges file...")
+        if not reporter.is_cancelled(force_poll=True):
+            result = writer.close()
+            if result is None:
+                info_callback("Was not able to extract any data")
+            return result
         else:
-            raise qgis.core.QgsProcessingException(
-                f"node id {feat_id!r} is not unique. Conefor node identifiers must be "
-                f"unique - Please select another layer field."
-            )
+            writer.discard()
+            info_callback("Did not write any output file, processing has been aborted")
+
+
+@dataclasses.dataclass
+class ConnectionFileSpec:
+    """A connection file to be written by `generate_conefor_files()`.
+
+    When `decay_distance` and `decay_probability` are given, the file holds
+    direct dispersal probabilities, as computed by
+    `distances.get_distance_decay()`, instead of distances.
+    """
+
+    connection_method: NodeConnectionType
+    output_path: Path
+    max_distance: Optional[float] = None
+    num_nearest_neighbours: Optional[int] = None  # only used by the nearest neighbours methods
+    use_geodesic_kernel: bool = False
+    num_workers: int = 1
+    decimal_places: Optional[int] = None
+    decay_distance: Optional[float] = None
+    decay_probability: Optional[float] = None
+
+    @property
+    def uses_edges(self) -> bool:
+        return self.connection_method in (
+            NodeConnectionType.EDGE_DISTANCE,
+            NodeConnectionType.EDGE_DISTANCE_NEAREST_NEIGHBOURS,
+        )
 
-    info_callback("Writing connections file...")
-    info_callback(f"{data=}")
-    if not cancelled_callback():
-        if len(data) > 0:
-            return save_text_file(data, output_path)
+    @property
+    def uses_nearest_neighbours(self) -> bool:
+        return self.connection_method in (
+            NodeConnectionType.EDGE_DISTANCE_NEAREST_NEIGHBOURS,
+            NodeConnectionType.CENTROID_DISTANCE_NEAREST_NEIGHBOURS,
+        )
+
+    @property
+    def connection_type(self) -> ConeforNodeConnectionType:
+        return (
+            ConeforNodeConnectionType.PROBABILITY if self.decay_distance is not None
+            else ConeforNodeConnectionType.DISTANCE
+        )
+
+    def get_num_pairs(self, num_nodes: int) -> int:
+        """Number of pairs of nodes that are handled while writing the file."""
+        if self.uses_nearest_neighbours:
+            result = num_nodes * self.num_nearest_neighbours
         else:
-            info_callback("Was not able to extract any data")
-    else:
-        info_callback("Did not write any output file, processing has been aborted")
+            result = num_nodes * (num_nodes - 1) // 2
+        return result
+
+    def get_distance_transform(self) -> Optional[Callable[[np.ndarray], np.ndarray]]:
+        if self.connection_type == ConeforNodeConnectionType.PROBABILITY:
+            result = distances.get_distance_decay(self.decay_distance, self.decay_probability)
+        else:
+            result = None
+        return result
+
+
+@dataclasses.dataclass
+class ConeforFiles:
+    """Paths of the files written by `generate_conefor_files()`.
+
+    Connection file paths are in the same order as the requested files, with
+    `None` for files that have not been written.
+    """
+
+    nodes_path: Optional[Path] = None
+    connections_paths: list[Optional[Path]] = dataclasses.field(default_factory=list)
 
 
-def generate_connection_file_with_edge_distances(
+def generate_conefor_files(
     node_id_field_name: Optional[str],
+    node_attribute_field_name: Optional[str],
+    nodes_to_add_field_name: Optional[str],
     crs: qgis.core.QgsCoordinateReferenceSystem,
-    feature_iterator_factory: Callable[[], qgis.core.QgsFeatureIterator],
+    feature_iterator_factory: featurerequests.FeatureIteratorFactory,
+    fields: qgis.core.QgsFields,
     num_features: int,
-    output_path: Path,
+    nodes_output_path: Path,
+    connection_files: list[ConnectionFileSpec],
     progress_callback: Optional[Callable[[int], None]],
-    progress_step: float,
     start_progress: int = 0,
     info_callback: Optional[Callable[[str], None]] = log,
     cancelled_callback: Optional[Callable[[], bool]] = None,
-) -> Optional[Path]:
-    data = []
-    if crs.isGeographic():
-        qgis_project = qgis.core.QgsProject.instance()
-        destination_crs = qgis.core.QgsCoordinateReferenceSystem(qgis_project.crs())
-        transformer = qgis.core.QgsCoordinateTransform(
-            crs, destination_crs, qgis_project.transformContext())
-    else:
-        transformer = None
+    area_calculator: Optional[Callable[[qgis.core.QgsGeometry], Optional[float]]] = None,
+    autogenerated_node_ids: Optional[nodeids.AutogeneratedNodeIds] = None,
+    writer_memory_budget: int = textfiles.DEFAULT_WRITER_MEMORY_BUDGET,
+    layer_sink: Optional[nodestore.GeneratedLayerSink] = None,
+) -> ConeforFiles:
+    """Generate the Conefor node file and any number of connection files in a single job.
+
+    Features are read only once, into a `nodestore.NodeStore` which keeps
+    only the centroids and geometries needed by the requested connection
+    files. The node file and each connection file are then written from the
+    store, in turn. Progress goes from `start_progress` to 100 over the whole
+    job.
+
+    When `node_attribute_field_name` is `None`, the node attribute is computed
+    from each feature's geometry with `area_calculator`. When
+    `node_id_field_name` is `None`, node ids are taken from
+    `autogenerated_node_ids`. Copies of the features with these generated
+    values are added to `layer_sink` while reading them, if it is given.
+
+    Each file is written with at most `writer_memory_budget` bytes for sorting
+    its rows, which the Processing algorithms take from the plugin settings.
+    """
+    result = ConeforFiles()
+    total_items = 2 * num_features + sum(
+        spec.get_num_pairs(num_features) for spec in connection_files)
+    progress_step = (100 - start_progress) / max(total_items, 1)
     current_progress = start_progress
-    info_callback(f"About to start processing {num_features} features...")
-    seen_ids = set()
-    for feat in feature_iterator_factory():
-        feat_id = feat[node_id_field_name]
-        if feat_id not in seen_ids:
-            seen_ids.add(feat_id)
-            info_callback(f"Processing feature {feat_id}...")
-            feat_geom = feat.geometry()
-            if transformer is not None:
-                feat_geom.transform(transformer)
-            for pair_feat in feature_iterator_factory():
-                should_abort = cancelled_callback() if cancelled_callback is not None else False
-                if should_abort:
-                    info_callback("Aborting...")
-                    break
-                if pair_feat.id() > feat.id():
-                    pair_feat_id = pair_feat[node_id_field_name]
-                    pair_feat_geom = pair_feat.geometry()
-                    if transformer is not None:
-                        pair_feat_geom.transform(transformer)
-                    edge_distance = feat_geom.distance(pair_feat_geom)
-                    data.append((feat_id, pair_feat_id, edge_distance))
-                    current_progress += progress_step
-                    progress_callback(int(current_progress))
-            else:
-                # this `else` block belongs to the inner `for` block and
-                # it gets executed if the `for` loop is able to run until
-                # completion (i.e. is not stopped by a `break`).
-                # current_progress += (end_progress - start_progress) / num_features
-                # progress_callback(int(start_progress + current_progress))
-                continue
-            # if the inner loop did not run until completion, then the outer loop should `break` too
+    reporter = progress.ProgressReporter(
+        progress_callback,
+        cancelled_callback=cancelled_callback,
+        info_callback=info_callback,
+        start_progress=current_progress,
+        progress_step=progress_step,
+        total_items=num_features,
+        unit="features",
+    )
+    logger = RateLimitedLogger(info_callback)
+    info_callback(f"Reading {num_features} features...")
+    nodes = nodestore.extract_nodes(
+        node_id_field_name,
+        node_attribute_field_name,
+        nodes_to_add_field_name,
+        feature_iterator_factory,
+        fields,
+        area_calculator=area_calculator,
+        autogenerated_node_ids=autogenerated_node_ids,
+        keep_centroids=any(not spec.uses_edges for spec in connection_files),
+        keep_geometries=any(spec.uses_edges for spec in connection_files),
+        reporter=reporter,
+        logger=logger,
+        layer_sink=layer_sink,
+    )
+    logger.flush()
+    reporter.finish()
+    if reporter.is_cancelled(force_poll=True):
+        info_callback("Did not write any output file, processing has been aborted")
+        return result
+    current_progress += progress_step * num_features
+
+    result.nodes_path = generate_node_file_from_store(
+        nodes,
+        nodes_output_path,
+        progress_callback,
+        progress_step,
+        start_progress=current_progress,
+        info_callback=info_callback,
+        writer_memory_budget=writer_memory_budget,
+        attribute_description=_get_attribute_description(node_attribute_field_name),
+    )
+    current_progress += progress_step * num_features
+
+    for spec in connection_files:
+        if cancelled_callback is not None and cancelled_callback():
+            info_callback("Aborting...")
             break
-        else:
-            raise qgis.core.QgsProcessingException(
-                f"node id {feat_id!r} is not unique. Conefor node identifiers must be "
-                f"unique - Please select another layer field."
+        info_callback(
+            f"Generating {spec.connection_type.value} connection file with "
+            f"{spec.connection_method.value}..."
+        )
+        num_nearest_neighbours = (
+            spec.num_nearest_neighbours if spec.uses_nearest_neighbours else None)
+        if spec.uses_edges:
+            connections_path = write_connection_file_with_edge_distances(
+                nodes.get_geometry_store(),
+                crs,
+                spec.output_path,
+                progress_callback,
+                progress_step,
+                start_progress=current_progress,
+                info_callback=info_callback,
+                cancelled_callback=cancelled_callback,
+                max_distance=spec.max_distance,
+                num_nearest_neighbours=num_nearest_neighbours,
+                num_workers=spec.num_workers,
+                writer_memory_budget=writer_memory_budget,
+                decimal_places=spec.decimal_places,
+                distance_transform=spec.get_distance_transform(),
             )
-    info_callback("Writing edges file...")
-    if not cancelled_callback():
-        if len(data) > 0:
-            return save_text_file(data, output_path)
         else:
-            info_callback("Was not able to extract any data")
-    else:
-        info_callback("Did not write any output file, processing has been aborted")
+            connections_path = write_connection_file_with_centroid_distances(
+                nodes.get_centroid_store(),
+                crs,
+                spec.output_path,
+                progress_callback,
+                progress_step,
+                start_progress=current_progress,
+                info_callback=info_callback,
+                cancelled_callback=cancelled_callback,
+                use_geodesic_kernel=spec.use_geodesic_kernel,
+                max_distance=spec.max_distance,
+                num_nearest_neighbours=num_nearest_neighbours,
+                num_workers=spec.num_workers,
+                writer_memory_budget=writer_memory_budget,
+                decimal_places=spec.decimal_places,
+                distance_transform=spec.get_distance_transform(),
+            )
+        result.connections_paths.append(connections_path)
+        current_progress += progress_step * spec.get_num_pairs(num_features)
+    result.connections_paths.extend(
+        [None] * (len(connection_files) - len(result.connections_paths)))
+    return result
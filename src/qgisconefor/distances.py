@@ -0,0 +1,665 @@
+"""Vectorized distance computations for generating Conefor connection files."""
+
+import dataclasses
+import math
+import multiprocessing.synchronize
+from typing import (
+    Callable,
+    Iterator,
+    Optional,
+)
+
+import numpy as np
+import qgis.core
+
+# maximum number of node pairs that are measured together in a single block
+DEFAULT_MAX_PAIRS_PER_BLOCK = 1_000_000
+
+# blocks are kept smaller when distances must be measured one pair at a time,
+# so that cancellation and progress are still reported regularly
+DEFAULT_MAX_PAIRS_PER_MEASURER_BLOCK = 20_000
+
+# the geodesic kernel needs around twenty temporary arrays per block
+DEFAULT_MAX_PAIRS_PER_GEODESIC_BLOCK = 250_000
+
+# Maximum difference, in meters, between the distances computed by the batched
+# geodesic kernel and those computed by `QgsDistanceArea.measureLine()`. Vincenty's
+# inverse formula is accurate to well below a millimeter, except for nearly
+# antipodal points, where it may not converge - these pairs are measured with
+# `QgsDistanceArea` instead.
+GEODESIC_KERNEL_TOLERANCE = 0.001
+
+_VINCENTY_MAX_ITERATIONS = 200
+_VINCENTY_CONVERGENCE_THRESHOLD = 1e-12
+
+# enlarges geographic search rectangles, so that they remain a conservative bound
+_SEARCH_RECTANGLE_SAFETY_FACTOR = 1.01
+
+
+@dataclasses.dataclass
+class DistanceBlock:
+    """Distances of a block of pairs of nodes.
+
+    The block covers the rows `row_start:row_end` of the upper triangle of the
+    pairs matrix, but it may include only some of the pairs of those rows.
+    """
+
+    row_start: int
+    row_end: int
+    rows: np.ndarray
+    cols: np.ndarray
+    distances: np.ndarray
+
+    def num_triangle_pairs(self, num_nodes: int) -> int:
+        """Number of pairs of the upper triangle that are covered by this block."""
+        num_rows = self.row_end - self.row_start
+        return num_rows * (num_nodes - 1) - (self.row_start + self.row_end - 1) * num_rows // 2
+
+
+@dataclasses.dataclass
+class CentroidStore:
+    """Node ids and centroid coordinates of a layer's features.
+
+    Nodes are ordered by their feature id, which is the same order used when
+    deciding which pairs of features are connected.
+    """
+
+    node_ids: list
+    feature_ids: np.ndarray
+    coordinates: np.ndarray
+
+
+def iter_upper_triangle_row_blocks(
+        num_nodes: int,
+        max_pairs_per_block: int,
+        start_row: int = 0,
+        stop_row: Optional[int] = None,
+) -> Iterator[tuple[int, int]]:
+    """Split the upper triangle of the pairs matrix into contiguous row blocks.
+
+    Each yielded `(row_start, row_end)` block holds at most `max_pairs_per_block`
+    pairs, except when a single row is already bigger than that. Only the rows
+    from `start_row` up to, but not including, `stop_row` are split.
+    """
+    last_row = num_nodes - 1 if stop_row is None else min(stop_row, num_nodes - 1)
+    row_start = start_row
+    while row_start < last_row:
+        row_end = row_start
+        block_pairs = 0
+        while row_end < last_row:
+            row_pairs = num_nodes - 1 - row_end
+            if block_pairs > 0 and block_pairs + row_pairs > max_pairs_per_block:
+                break
+            block_pairs += row_pairs
+            row_end += 1
+        yield row_start, row_end
+        row_start = row_end
+
+
+def get_upper_triangle_pairs(
+        num_nodes: int,
+        row_start: int,
+        row_end: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return the `(rows, cols)` indices of all pairs `i < j` with `i` in the block."""
+    block_rows = np.arange(row_start, row_end, dtype=np.int64)
+    counts = num_nodes - 1 - block_rows
+    rows = np.repeat(block_rows, counts)
+    offsets = np.arange(rows.size, dtype=np.int64) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    cols = rows + 1 + offsets
+    return rows, cols
+
+
+def measure_planar_distances(
+        coordinates: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+) -> np.ndarray:
+    deltas = coordinates[cols] - coordinates[rows]
+    # this is the same formula used by QgsDistanceArea.measureLine() when
+    # not using an ellipsoid, which means results are identical
+    return np.sqrt(deltas[:, 0] * deltas[:, 0] + deltas[:, 1] * deltas[:, 1])
+
+
+def measure_distances_with_measurer(
+        points: list[qgis.core.QgsPointXY],
+        rows: np.ndarray,
+        cols: np.ndarray,
+        measurer: qgis.core.QgsDistanceArea,
+) -> np.ndarray:
+    return np.fromiter(
+        (
+            measurer.measureLine([points[row], points[col]])
+            for row, col in zip(rows.tolist(), cols.tolist())
+        ),
+        dtype=np.float64,
+        count=rows.size
+    )
+
+
+def get_distance_decay(
+        decay_distance: float,
+        decay_probability: float,
+) -> Callable[[np.ndarray], np.ndarray]:
+    """Return a function that turns distances into direct dispersal probabilities.
+
+    Probabilities follow a negative exponential decay, which has a value of
+    `decay_probability` at `decay_distance`. This is the same model used by
+    Conefor's `-confProb` option when it is given a distance file.
+    Negative distances, which mark pairs that could not be measured, get a
+    probability of zero.
+    """
+    if decay_distance <= 0:
+        raise ValueError(f"Decay distance must be positive - got {decay_distance!r}")
+    if not 0 < decay_probability < 1:
+        raise ValueError(
+            f"Decay probability must be between zero and one - got {decay_probability!r}")
+    decay_rate = -math.log(decay_probability) / decay_distance
+
+    def decay(distances: np.ndarray) -> np.ndarray:
+        distances = np.asarray(distances, dtype=np.float64)
+        return np.where(distances >= 0, np.exp(-decay_rate * distances), 0.0)
+
+    return decay
+
+
+@dataclasses.dataclass(frozen=True)
+class Ellipsoid:
+    semi_major_axis: float
+    semi_minor_axis: float
+
+    @property
+    def flattening(self) -> float:
+        return (self.semi_major_axis - self.semi_minor_axis) / self.semi_major_axis
+
+    @classmethod
+    def from_measurer(cls, measurer: qgis.core.QgsDistanceArea) -> "Ellipsoid":
+        return cls(
+            semi_major_axis=measurer.ellipsoidSemiMajor(),
+            semi_minor_axis=measurer.ellipsoidSemiMinor(),
+        )
+
+
+def get_ellipsoid_coordinates(
+        coordinates: np.ndarray,
+        measurer: qgis.core.QgsDistanceArea,
+) -> np.ndarray:
+    """Convert coordinates to the measurer's ellipsoid CRS, as longitude/latitude degrees."""
+    transformer = qgis.core.QgsCoordinateTransform(
+        measurer.sourceCrs(),
+        measurer.ellipsoidCrs(),
+        qgis.core.QgsProject.instance().transformContext()
+    )
+    if transformer.isShortCircuited():
+        result = coordinates.copy()
+    else:
+        transformed = [
+            transformer.transform(qgis.core.QgsPointXY(x, y))
+            for x, y in coordinates.tolist()
+        ]
+        result = np.array(
+            [(point.x(), point.y()) for point in transformed],
+            dtype=np.float64
+        ).reshape(-1, 2)
+    return result
+
+
+def measure_geodesic_distances(
+        lon_lat: np.ndarray,
+        rows: np.ndarray,
+        cols: np.ndarray,
+        ellipsoid: Ellipsoid,
+) -> np.ndarray:
+    """Compute ellipsoidal distances between pairs of points using Vincenty's inverse formula.
+
+    `lon_lat` holds longitude/latitude degrees. The result is in meters and has
+    NaN for those pairs where the formula did not converge.
+    """
+    a = ellipsoid.semi_major_axis
+    b = ellipsoid.semi_minor_axis
+    f = ellipsoid.flattening
+    radians = np.radians(lon_lat)
+    lon_diff = radians[cols, 0] - radians[rows, 0]
+    lon_diff = (lon_diff + np.pi) % (2 * np.pi) - np.pi
+    reduced_lat_1 = np.arctan((1 - f) * np.tan(radians[rows, 1]))
+    reduced_lat_2 = np.arctan((1 - f) * np.tan(radians[cols, 1]))
+    sin_u1 = np.sin(reduced_lat_1)
+    cos_u1 = np.cos(reduced_lat_1)
+    sin_u2 = np.sin(reduced_lat_2)
+    cos_u2 = np.cos(reduced_lat_2)
+
+    lambda_ = lon_diff.copy()
+    converged = np.zeros(rows.size, dtype=bool)
+    sin_sigma = np.zeros(rows.size)
+    cos_sigma = np.ones(rows.size)
+    sigma = np.zeros(rows.size)
+    cos_sq_alpha = np.ones(rows.size)
+    cos_2_sigma_m = np.zeros(rows.size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(_VINCENTY_MAX_ITERATIONS):
+            active = ~converged
+            if not active.any():
+                break
+            sin_lambda = np.sin(lambda_[active])
+            cos_lambda = np.cos(lambda_[active])
+            s_u1 = sin_u1[active]
+            c_u1 = cos_u1[active]
+            s_u2 = sin_u2[active]
+            c_u2 = cos_u2[active]
+            current_sin_sigma = np.sqrt(
+                (c_u2 * sin_lambda) ** 2 +
+                (c_u1 * s_u2 - s_u1 * c_u2 * cos_lambda) ** 2
+            )
+            current_cos_sigma = s_u1 * s_u2 + c_u1 * c_u2 * cos_lambda
+            current_sigma = np.arctan2(current_sin_sigma, current_cos_sigma)
+            sin_alpha = np.where(
+                current_sin_sigma == 0,
+                0.0,
+                c_u1 * c_u2 * sin_lambda / current_sin_sigma
+            )
+            current_cos_sq_alpha = 1 - sin_alpha ** 2
+            # equatorial lines have cos_sq_alpha == 0
+            current_cos_2_sigma_m = np.where(
+                current_cos_sq_alpha == 0,
+                0.0,
+                current_cos_sigma - 2 * s_u1 * s_u2 / current_cos_sq_alpha
+            )
+            c = f / 16 * current_cos_sq_alpha * (4 + f * (4 - 3 * current_cos_sq_alpha))
+            previous_lambda = lambda_[active]
+            new_lambda = lon_diff[active] + (1 - c) * f * sin_alpha * (
+                current_sigma + c * current_sin_sigma * (
+                    current_cos_2_sigma_m + c * current_cos_sigma * (
+                        -1 + 2 * current_cos_2_sigma_m ** 2)
+                )
+            )
+            lambda_[active] = new_lambda
+            sin_sigma[active] = current_sin_sigma
+            cos_sigma[active] = current_cos_sigma
+            sigma[active] = current_sigma
+            cos_sq_alpha[active] = current_cos_sq_alpha
+            cos_2_sigma_m[active] = current_cos_2_sigma_m
+            converged[active] = (
+                    np.abs(new_lambda - previous_lambda) < _VINCENTY_CONVERGENCE_THRESHOLD)
+
+        u_sq = cos_sq_alpha * (a ** 2 - b ** 2) / b ** 2
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (
+            cos_2_sigma_m + big_b / 4 * (
+                cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2) -
+                big_b / 6 * cos_2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (
+                    -3 + 4 * cos_2_sigma_m ** 2)
+            )
+        )
+        result = b * big_a * (sigma - delta_sigma)
+    result[~converged] = np.nan
+    return result
+
+
+def get_geographic_search_rectangle(
+        lon: float,
+        lat: float,
+        radius: float,
+        ellipsoid: Ellipsoid,
+) -> qgis.core.QgsRectangle:
+    """Return a longitude/latitude rectangle that contains all points within `radius` meters.
+
+    The rectangle is computed on a sphere whose radius is the ellipsoid's semi-minor
+    axis, with an additional safety margin, which makes it a conservative bound for
+    ellipsoidal distances. Rectangles that would cross the antimeridian or include a
+    pole span the full longitude range.
+    """
+    angular_radius = _SEARCH_RECTANGLE_SAFETY_FACTOR * radius / ellipsoid.semi_minor_axis
+    lat_radians = math.radians(lat)
+    min_lat = lat_radians - angular_radius
+    max_lat = lat_radians + angular_radius
+    min_lon = -math.pi
+    max_lon = math.pi
+    if min_lat > -math.pi / 2 and max_lat < math.pi / 2:
+        sin_ratio = math.sin(min(angular_radius, math.pi / 2)) / math.cos(lat_radians)
+        if sin_ratio < 1:
+            lon_radians = math.radians(lon)
+            delta_lon = math.asin(sin_ratio)
+            if -math.pi <= lon_radians - delta_lon and lon_radians + delta_lon <= math.pi:
+                min_lon = lon_radians - delta_lon
+                max_lon = lon_radians + delta_lon
+    return qgis.core.QgsRectangle(
+        math.degrees(min_lon),
+        math.degrees(max(min_lat, -math.pi / 2)),
+        math.degrees(max_lon),
+        math.degrees(min(max_lat, math.pi / 2)),
+    )
+
+
+def build_point_index(
+        coordinates: np.ndarray,
+) -> tuple[qgis.core.QgsSpatialIndexKDBush, dict[int, int]]:
+    """Build a KD-tree over the input coordinates.
+
+    Returns the index and a mapping of the index's ids to positions in `coordinates`.
+    """
+    layer = qgis.core.QgsVectorLayer("Point", "conefor_centroids", "memory")
+    features = []
+    for x, y in coordinates.tolist():
+        feature = qgis.core.QgsFeature()
+        feature.setGeometry(
+            qgis.core.QgsGeometry.fromPointXY(qgis.core.QgsPointXY(x, y)))
+        features.append(feature)
+    _, added_features = layer.dataProvider().addFeatures(features)
+    index = qgis.core.QgsSpatialIndexKDBush(layer.dataProvider())
+    positions = {feature.id(): position for position, feature in enumerate(added_features)}
+    return index, positions
+
+
+def build_point_rtree(coordinates: np.ndarray) -> qgis.core.QgsSpatialIndex:
+    """Build an R-tree over the input coordinates, using their position as id."""
+    index = qgis.core.QgsSpatialIndex()
+    for position, (x, y) in enumerate(coordinates.tolist()):
+        index.addFeature(position, qgis.core.QgsRectangle(x, y, x, y))
+    return index
+
+
+class CentroidDistanceEngine:
+    """Computes pairwise centroid distances in blocks of pairs.
+
+    Planar distances are computed with vectorized NumPy operations. When the
+    measurer is set up to use an ellipsoid, each pair is measured with the
+    measurer itself, but centroids are still only extracted once. Alternatively,
+    ellipsoidal distances may be computed with the batched geodesic kernel, which
+    is only used when the source CRS is geographic.
+
+    When a maximum distance is given, a KD-tree of the centroids is used for
+    finding the candidate pairs and only those are measured. Tree-based queries
+    are also used for finding each node's nearest neighbours.
+    """
+
+    coordinates: np.ndarray
+    measurer: qgis.core.QgsDistanceArea
+    max_pairs_per_block: int
+    uses_geodesic_kernel: bool
+    _points: Optional[list[qgis.core.QgsPointXY]]
+    _ellipsoid_coordinates: Optional[np.ndarray]
+
+    def __init__(
+            self,
+            coordinates: np.ndarray,
+            measurer: qgis.core.QgsDistanceArea,
+            max_pairs_per_block: Optional[int] = None,
+            use_geodesic_kernel: bool = False,
+    ):
+        self.coordinates = coordinates
+        self.measurer = measurer
+        self.uses_geodesic_kernel = (
+            use_geodesic_kernel and
+            measurer.willUseEllipsoid() and
+            measurer.sourceCrs().isGeographic()
+        )
+        if max_pairs_per_block is None:
+            if self.uses_geodesic_kernel:
+                max_pairs_per_block = DEFAULT_MAX_PAIRS_PER_GEODESIC_BLOCK
+            elif measurer.willUseEllipsoid():
+                max_pairs_per_block = DEFAULT_MAX_PAIRS_PER_MEASURER_BLOCK
+            else:
+                max_pairs_per_block = DEFAULT_MAX_PAIRS_PER_BLOCK
+        self.max_pairs_per_block = max_pairs_per_block
+        self._points = None
+        self._ellipsoid_coordinates = None
+
+    @property
+    def num_nodes(self) -> int:
+        return self.coordinates.shape[0]
+
+    @property
+    def num_pairs(self) -> int:
+        return self.num_nodes * (self.num_nodes - 1) // 2
+
+    @property
+    def ellipsoid(self) -> Ellipsoid:
+        return Ellipsoid.from_measurer(self.measurer)
+
+    @property
+    def ellipsoid_coordinates(self) -> np.ndarray:
+        if self._ellipsoid_coordinates is None:
+            self._ellipsoid_coordinates = get_ellipsoid_coordinates(
+                self.coordinates, self.measurer)
+        return self._ellipsoid_coordinates
+
+    @property
+    def supports_worker_processes(self) -> bool:
+        """Whether distances can be measured in worker processes.
+
+        Workers compute planar distances and run the geodesic kernel, but they
+        cannot measure with `QgsDistanceArea`.
+        """
+        return self.uses_geodesic_kernel or not self.measurer.willUseEllipsoid()
+
+    def get_worker_arguments(self) -> tuple[np.ndarray, Optional[Ellipsoid]]:
+        """Return the arguments of `initialize_worker()` for measuring like this engine."""
+        if self.uses_geodesic_kernel:
+            result = self.ellipsoid_coordinates, self.ellipsoid
+        else:
+            result = self.coordinates, None
+        return result
+
+    def measure(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        if self.uses_geodesic_kernel:
+            result = self.fill_not_converged(
+                rows,
+                cols,
+                measure_geodesic_distances(
+                    self.ellipsoid_coordinates, rows, cols, self.ellipsoid)
+            )
+        elif self.measurer.willUseEllipsoid():
+            result = self._measure_with_measurer(rows, cols)
+        else:
+            result = measure_planar_distances(self.coordinates, rows, cols)
+        return result
+
+    def fill_not_converged(
+            self,
+            rows: np.ndarray,
+            cols: np.ndarray,
+            geodesic_distances: np.ndarray,
+    ) -> np.ndarray:
+        """Measure, in place, the pairs for which the geodesic kernel did not converge."""
+        not_converged = np.isnan(geodesic_distances)
+        if not_converged.any():
+            geodesic_distances[not_converged] = self._measure_with_measurer(
+                rows[not_converged], cols[not_converged])
+        return geodesic_distances
+
+    def _measure_with_measurer(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        if self._points is None:
+            self._points = [
+                qgis.core.QgsPointXY(x, y) for x, y in self.coordinates.tolist()]
+        return measure_distances_with_measurer(self._points, rows, cols, self.measurer)
+
+    def iter_blocks(
+            self,
+            max_distance: Optional[float] = None,
+            start_row: int = 0,
+            stop_row: Optional[int] = None,
+    ) -> Iterator[DistanceBlock]:
+        """Yield the distances of each block of rows of the upper triangle.
+
+        If `max_distance` is given, blocks only include the pairs whose distance
+        is not greater than it. Only the rows from `start_row` up to, but not
+        including, `stop_row` are measured.
+        """
+        stop_row = self.num_nodes if stop_row is None else min(stop_row, self.num_nodes)
+        if max_distance is None:
+            yield from self._iter_all_pairs_blocks(start_row, stop_row)
+        else:
+            yield from self._iter_blocks_within_distance(max_distance, start_row, stop_row)
+
+    def _iter_all_pairs_blocks(self, start_row: int, stop_row: int) -> Iterator[DistanceBlock]:
+        for row_start, row_end in iter_upper_triangle_row_blocks(
+                self.num_nodes, self.max_pairs_per_block, start_row, stop_row):
+            rows, cols = get_upper_triangle_pairs(self.num_nodes, row_start, row_end)
+            yield DistanceBlock(
+                row_start=row_start,
+                row_end=row_end,
+                rows=rows,
+                cols=cols,
+                distances=self.measure(rows, cols),
+            )
+
+    def _iter_blocks_within_distance(
+            self,
+            max_distance: float,
+            start_row: int,
+            stop_row: int,
+    ) -> Iterator[DistanceBlock]:
+        if self.measurer.willUseEllipsoid():
+            index_coordinates = self.ellipsoid_coordinates
+            ellipsoid = self.ellipsoid
+        else:
+            index_coordinates = self.coordinates
+            ellipsoid = None
+        index, positions = build_point_index(index_coordinates)
+        block_rows = []
+        block_cols = []
+        row_start = start_row
+        coordinate_list = index_coordinates.tolist()
+        for row in range(start_row, stop_row):
+            x, y = coordinate_list[row]
+            if ellipsoid is not None:
+                found = index.intersects(
+                    get_geographic_search_rectangle(x, y, max_distance, ellipsoid))
+            else:
+                found = index.within(qgis.core.QgsPointXY(x, y), max_distance)
+            candidates = sorted(
+                position for position in (positions[item.id] for item in found)
+                if position > row
+            )
+            block_rows.extend([row] * len(candidates))
+            block_cols.extend(candidates)
+            if len(block_rows) >= self.max_pairs_per_block or row == stop_row - 1:
+                yield self._measure_candidates_block(
+                    row_start, row + 1, block_rows, block_cols, max_distance)
+                block_rows = []
+                block_cols = []
+                row_start = row + 1
+
+    def _measure_candidates_block(
+            self,
+            row_start: int,
+            row_end: int,
+            candidate_rows: list[int],
+            candidate_cols: list[int],
+            max_distance: float,
+    ) -> DistanceBlock:
+        rows = np.array(candidate_rows, dtype=np.int64)
+        cols = np.array(candidate_cols, dtype=np.int64)
+        block_distances = self.measure(rows, cols)
+        within = block_distances <= max_distance
+        return DistanceBlock(
+            row_start=row_start,
+            row_end=row_end,
+            rows=rows[within],
+            cols=cols[within],
+            distances=block_distances[within],
+        )
+
+    def iter_nearest_neighbours(
+            self,
+            num_neighbours: int,
+    ) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+        """Yield each node's position along with its nearest neighbours and their distances.
+
+        Neighbours are found with an R-tree nearest neighbour query. When distances
+        are ellipsoidal, the R-tree works with longitude/latitude coordinates and its
+        results are only used to estimate a search radius, which is then refined
+        with a KD-tree range query - this ensures the neighbours are the nearest
+        ones also in terms of ellipsoidal distance.
+        """
+        if self.measurer.willUseEllipsoid():
+            index_coordinates = self.ellipsoid_coordinates
+            ellipsoid = self.ellipsoid
+            range_index, positions = build_point_index(index_coordinates)
+        else:
+            index_coordinates = self.coordinates
+            ellipsoid = None
+            range_index = None
+            positions = None
+        nearest_index = build_point_rtree(index_coordinates)
+        for row, (x, y) in enumerate(index_coordinates.tolist()):
+            candidates = np.array(
+                [
+                    position for position in nearest_index.nearestNeighbor(
+                        qgis.core.QgsPointXY(x, y), num_neighbours + 1)
+                    if position != row
+                ],
+                dtype=np.int64
+            )
+            candidate_distances = self.measure(
+                np.full(candidates.size, row, dtype=np.int64), candidates)
+            if ellipsoid is not None and candidates.size > 0:
+                radius = np.sort(candidate_distances)[
+                    min(num_neighbours, candidates.size) - 1]
+                found = range_index.intersects(
+                    get_geographic_search_rectangle(x, y, radius, ellipsoid))
+                candidates = np.array(
+                    [
+                        position for position in (positions[item.id] for item in found)
+                        if position != row
+                    ],
+                    dtype=np.int64
+                )
+                candidate_distances = self.measure(
+                    np.full(candidates.size, row, dtype=np.int64), candidates)
+            nearest = np.lexsort((candidates, candidate_distances))[:num_neighbours]
+            yield row, candidates[nearest], candidate_distances[nearest]
+
+
+@dataclasses.dataclass
+class _WorkerState:
+    coordinates: np.ndarray
+    ellipsoid: Optional[Ellipsoid]
+    cancel_event: multiprocessing.synchronize.Event
+
+
+# state of a worker process, as set up by `initialize_worker()`
+_worker_state: Optional[_WorkerState] = None
+
+
+def initialize_worker(
+        cancel_event: multiprocessing.synchronize.Event,
+        coordinates: np.ndarray,
+        ellipsoid: Optional[Ellipsoid],
+) -> None:
+    """Set up a worker process for measuring centroid distances.
+
+    Coordinates are received only once per worker. When `ellipsoid` is given
+    they are longitude/latitude degrees, measured with the geodesic kernel,
+    otherwise they are measured as planar coordinates.
+    """
+    global _worker_state
+    _worker_state = _WorkerState(
+        coordinates=coordinates,
+        ellipsoid=ellipsoid,
+        cancel_event=cancel_event,
+    )
+
+
+def measure_row_block(row_start: int, row_end: int) -> np.ndarray:
+    """Measure all pairs of a row block of the upper triangle, in a worker process.
+
+    Only the distances are returned, in the order of `get_upper_triangle_pairs()`,
+    which keeps the results that are sent back to the main process small.
+    Geodesic distances are NaN where the kernel did not converge.
+
+    Once processing has been cancelled the block is not measured and an empty
+    array is returned instead. Such results are never yielded by
+    `parallel.WorkerPool.iter_ordered_results()`.
+    """
+    state = _worker_state
+    if state.cancel_event.is_set():
+        return np.empty(0, dtype=np.float64)
+    rows, cols = get_upper_triangle_pairs(state.coordinates.shape[0], row_start, row_end)
+    if state.ellipsoid is not None:
+        result = measure_geodesic_distances(state.coordinates, rows, cols, state.ellipsoid)
+    else:
+        result = measure_planar_distances(state.coordinates, rows, cols)
+    return result
@@ -0,0 +1,471 @@
+"""Edge distance computations for generating Conefor connection files."""
+
+import collections
+import dataclasses
+import multiprocessing.synchronize
+from typing import (
+    Iterator,
+    Optional,
+)
+
+import numpy as np
+import qgis.core
+
+from . import distances
+
+# approximate memory used by each vertex of a prepared GEOS geometry, including
+# the GEOS coordinates and the spatial index built when preparing it
+_PREPARED_GEOMETRY_BYTES_PER_VERTEX = 96
+
+DEFAULT_PREPARED_GEOMETRY_CACHE_BUDGET = 256 * 1024 * 1024
+
+# layers that are no wider than a UTM zone and lie within the UTM latitude
+# limits are measured in UTM, the others in an azimuthal equidistant projection
+_UTM_ZONE_WIDTH = 6
+_UTM_MIN_LATITUDE = -80
+_UTM_MAX_LATITUDE = 84
+
+
+@dataclasses.dataclass
+class GeometryStore:
+    """Node ids and geometries of a layer's features, ordered by their feature id."""
+
+    node_ids: list
+    feature_ids: list[int]
+    geometries: list[qgis.core.QgsGeometry]
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def extent(self) -> qgis.core.QgsRectangle:
+        result = qgis.core.QgsRectangle()
+        result.setNull()
+        for geom in self.geometries:
+            if not geom.isNull():
+                result.combineExtentWith(geom.boundingBox())
+        return result
+
+
+@dataclasses.dataclass
+class EdgeDistanceStatistics:
+    """Counts of the pairs of nodes handled while generating edge distances."""
+
+    candidate_pairs: int = 0
+    pruned_pairs: int = 0
+    measured_pairs: int = 0
+    connections: int = 0
+
+    def add(self, other: "EdgeDistanceStatistics") -> None:
+        self.candidate_pairs += other.candidate_pairs
+        self.pruned_pairs += other.pruned_pairs
+        self.measured_pairs += other.measured_pairs
+        self.connections += other.connections
+
+
+class PreparedGeometryCache:
+    """LRU cache of prepared geometry engines, bounded by a memory budget.
+
+    Measuring the distance between two geometries with a prepared GEOS geometry
+    avoids rebuilding its GEOS representation for each pair and uses an index
+    of its segments. Of each pair, the geometry with more vertices is the one
+    that gets prepared, as it is the one that benefits the most.
+    """
+
+    geometries: list[qgis.core.QgsGeometry]
+    memory_budget: int
+    used_memory: int
+    _engines: collections.OrderedDict[int, tuple[qgis.core.QgsGeometryEngine, int]]
+
+    def __init__(
+            self,
+            geometries: list[qgis.core.QgsGeometry],
+            memory_budget: int = DEFAULT_PREPARED_GEOMETRY_CACHE_BUDGET,
+    ):
+        self.geometries = geometries
+        self.memory_budget = memory_budget
+        self.used_memory = 0
+        self._engines = collections.OrderedDict()
+
+    def get_engine(self, position: int) -> qgis.core.QgsGeometryEngine:
+        cached = self._engines.get(position)
+        if cached is not None:
+            self._engines.move_to_end(position)
+            engine = cached[0]
+        else:
+            geom = self.geometries[position]
+            engine = qgis.core.QgsGeometry.createGeometryEngine(geom.constGet())
+            engine.prepareGeometry()
+            size = geom.constGet().nCoordinates() * _PREPARED_GEOMETRY_BYTES_PER_VERTEX
+            if size <= self.memory_budget:
+                while self.used_memory + size > self.memory_budget:
+                    _, (_, evicted_size) = self._engines.popitem(last=False)
+                    self.used_memory -= evicted_size
+                self._engines[position] = (engine, size)
+                self.used_memory += size
+        return engine
+
+    def distance(self, position: int, other_position: int) -> float:
+        geom = self.geometries[position]
+        other_geom = self.geometries[other_position]
+        if geom.isNull() or other_geom.isNull():
+            # preserve the behavior of QgsGeometry.distance(), which returns -1
+            return geom.distance(other_geom)
+        if other_geom.constGet().nCoordinates() > geom.constGet().nCoordinates():
+            position, other_position = other_position, position
+            other_geom = geom
+        return self.get_engine(position).distance(other_geom.constGet())
+
+
+def get_local_projected_crs(
+        geographic_extent: qgis.core.QgsRectangle
+) -> qgis.core.QgsCoordinateReferenceSystem:
+    """Choose a projected CRS that is suitable for measuring distances inside the extent.
+
+    Small extents get the WGS84 UTM zone of their center, larger ones get an
+    azimuthal equidistant projection centered on the extent.
+    """
+    center = geographic_extent.center()
+    fits_utm_zone = (
+        geographic_extent.width() <= _UTM_ZONE_WIDTH and
+        _UTM_MIN_LATITUDE <= center.y() <= _UTM_MAX_LATITUDE
+    )
+    if fits_utm_zone:
+        zone = min(int((center.x() + 180) // _UTM_ZONE_WIDTH) + 1, 60)
+        epsg_code = (32600 if center.y() >= 0 else 32700) + zone
+        result = qgis.core.QgsCoordinateReferenceSystem(f"EPSG:{epsg_code}")
+    else:
+        result = qgis.core.QgsCoordinateReferenceSystem.fromProj(
+            f"+proj=aeqd +lat_0={center.y()} +lon_0={center.x()} +x_0=0 +y_0=0 "
+            f"+datum=WGS84 +units=m +no_defs"
+        )
+    return result
+
+
+def reproject_geometries(
+        store: GeometryStore,
+        source_crs: qgis.core.QgsCoordinateReferenceSystem,
+        destination_crs: qgis.core.QgsCoordinateReferenceSystem,
+) -> None:
+    """Transform all of the store's geometries, in place, exactly once."""
+    transformer = qgis.core.QgsCoordinateTransform(
+        source_crs,
+        destination_crs,
+        qgis.core.QgsProject.instance().transformContext()
+    )
+    for geom in store.geometries:
+        if not geom.isNull():
+            geom.transform(transformer)
+
+
+def drop_empty_geometries(store: GeometryStore) -> tuple[GeometryStore, int]:
+    """Return a store without the nodes whose geometry is null or empty, and their count.
+
+    There is no edge distance between these nodes and any other, which means
+    they cannot be connected. The order of the remaining nodes is kept.
+    """
+    kept = [
+        position for position, geom in enumerate(store.geometries)
+        if not (geom.isNull() or geom.isEmpty())
+    ]
+    num_dropped = len(store) - len(kept)
+    if num_dropped == 0:
+        return store, 0
+    return GeometryStore(
+        node_ids=[store.node_ids[position] for position in kept],
+        feature_ids=[store.feature_ids[position] for position in kept],
+        geometries=[store.geometries[position] for position in kept],
+    ), num_dropped
+
+
+def iter_all_pairs(store: GeometryStore) -> Iterator[tuple[int, range]]:
+    """Yield each row of the pairs matrix along with all of its later columns."""
+    num_nodes = len(store)
+    for row in range(num_nodes):
+        yield row, range(row + 1, num_nodes)
+
+
+def build_bounding_box_index(
+        geometries: list[qgis.core.QgsGeometry]
+) -> qgis.core.QgsSpatialIndex:
+    """Build an R-tree with the bounding box of each geometry, using its position as id."""
+    index = qgis.core.QgsSpatialIndex()
+    for position, geom in enumerate(geometries):
+        index.addFeature(position, geom.boundingBox())
+    return index
+
+
+def iter_candidate_pairs_within_distance(
+        store: GeometryStore,
+        max_distance: float,
+) -> Iterator[tuple[int, list[int]]]:
+    """Yield each row of the pairs matrix along with its candidate columns.
+
+    Candidates are those later nodes whose bounding box intersects the row's
+    bounding box, grown by `max_distance`. They are yielded in ascending order.
+    """
+    index = build_bounding_box_index(store.geometries)
+    for row in range(len(store)):
+        yield row, get_candidates_within_distance(index, store.geometries, row, max_distance)
+
+
+def get_candidates_within_distance(
+        index: qgis.core.QgsSpatialIndex,
+        geometries: list[qgis.core.QgsGeometry],
+        row: int,
+        max_distance: float,
+) -> list[int]:
+    search_rectangle = geometries[row].boundingBox().buffered(max_distance)
+    return sorted(
+        position for position in index.intersects(search_rectangle)
+        if position > row
+    )
+
+
+def get_part_bounding_boxes(geom: qgis.core.QgsGeometry) -> np.ndarray:
+    """Return an array with the `xmin, ymin, xmax, ymax` box of each part of the geometry.
+
+    Null and empty geometries get a single box at infinity, which is infinitely far
+    away from any other box.
+    """
+    boxes = []
+    if not geom.isNull():
+        for part in geom.constParts():
+            if not part.isEmpty():
+                box = part.boundingBox()
+                boxes.append(
+                    (box.xMinimum(), box.yMinimum(), box.xMaximum(), box.yMaximum()))
+    if len(boxes) == 0:
+        boxes.append((np.inf, np.inf, -np.inf, -np.inf))
+    return np.array(boxes, dtype=np.float64)
+
+
+class BoundingBoxDistanceFilter:
+    """Cheap lower bound of the edge distances between geometries.
+
+    The distance between two geometries is never smaller than the smallest
+    distance between the bounding boxes of their parts. Pairs whose lower bound
+    is already greater than the maximum distance can be discarded without
+    measuring their exact distance.
+    """
+
+    boxes: np.ndarray
+    part_offsets: np.ndarray
+    part_counts: np.ndarray
+
+    def __init__(self, geometries: list[qgis.core.QgsGeometry]):
+        geometry_boxes = [get_part_bounding_boxes(geom) for geom in geometries]
+        self.part_counts = np.array(
+            [len(boxes) for boxes in geometry_boxes], dtype=np.int64)
+        self.part_offsets = np.cumsum(self.part_counts) - self.part_counts
+        self.boxes = (
+            np.concatenate(geometry_boxes) if len(geometry_boxes) > 0
+            else np.empty((0, 4), dtype=np.float64)
+        )
+
+    def get_lower_bound_distances(
+            self,
+            position: int,
+            other_positions: np.ndarray,
+    ) -> np.ndarray:
+        """Return the lower bound of the distance between a geometry and each of the others."""
+        counts = self.part_counts[other_positions]
+        starts = np.cumsum(counts) - counts
+        other_part_indices = (
+            np.arange(counts.sum()) -
+            np.repeat(starts, counts) +
+            np.repeat(self.part_offsets[other_positions], counts)
+        )
+        other_boxes = self.boxes[other_part_indices]
+        offset = self.part_offsets[position]
+        own_boxes = self.boxes[offset:offset + self.part_counts[position], np.newaxis, :]
+        dx = np.maximum(
+            np.maximum(other_boxes[:, 0] - own_boxes[..., 2], own_boxes[..., 0] - other_boxes[:, 2]),
+            0
+        )
+        dy = np.maximum(
+            np.maximum(other_boxes[:, 1] - own_boxes[..., 3], own_boxes[..., 1] - other_boxes[:, 3]),
+            0
+        )
+        part_distances = np.sqrt(dx * dx + dy * dy).min(axis=0)
+        return np.minimum.reduceat(part_distances, starts)
+
+    def filter_candidates(
+            self,
+            position: int,
+            candidates: list[int],
+            max_distance: float,
+    ) -> list[int]:
+        """Return those candidates whose lower bound distance does not exceed `max_distance`."""
+        if len(candidates) == 0:
+            return candidates
+        other_positions = np.asarray(candidates, dtype=np.int64)
+        lower_bounds = self.get_lower_bound_distances(position, other_positions)
+        return other_positions[lower_bounds <= max_distance].tolist()
+
+
+def build_geometry_index(
+        geometries: list[qgis.core.QgsGeometry]
+) -> qgis.core.QgsSpatialIndex:
+    """Build an R-tree which also stores geometries, using their position as id.
+
+    Storing geometries makes nearest neighbour queries use the actual distance
+    between geometries rather than the distance between their bounding boxes.
+    """
+    index = qgis.core.QgsSpatialIndex(
+        qgis.core.QgsSpatialIndex.FlagStoreFeatureGeometries)
+    for position, geom in enumerate(geometries):
+        feature = qgis.core.QgsFeature(position)
+        feature.setGeometry(geom)
+        index.addFeature(feature)
+    return index
+
+
+def iter_nearest_neighbours(
+        store: GeometryStore,
+        num_neighbours: int,
+        prepared_geometries: PreparedGeometryCache,
+) -> Iterator[tuple[int, list[int], list[float]]]:
+    """Yield each node's position along with its nearest neighbours and their edge distances."""
+    index = build_geometry_index(store.geometries)
+    for row, geom in enumerate(store.geometries):
+        candidates = (
+            position for position in index.nearestNeighbor(geom, num_neighbours + 1)
+            if position != row
+        )
+        nearest = sorted(
+            (prepared_geometries.distance(row, position), position)
+            for position in candidates
+        )[:num_neighbours]
+        yield (
+            row,
+            [position for _, position in nearest],
+            [distance for distance, _ in nearest],
+        )
+
+
+class RowBlockMeasurer:
+    """Measures the edge distances of row blocks of the pairs matrix.
+
+    It holds the geometries, together with the indexes that are built from
+    them, so that they are shared by all the row blocks that it measures. It
+    is used by worker processes and when generating shards of a connection
+    file.
+    """
+
+    geometries: list[qgis.core.QgsGeometry]
+    max_distance: Optional[float]
+    prepared_geometries: PreparedGeometryCache
+    bounding_box_index: Optional[qgis.core.QgsSpatialIndex]
+    bounding_box_filter: Optional[BoundingBoxDistanceFilter]
+    cancel_event: Optional[multiprocessing.synchronize.Event]
+
+    def __init__(
+            self,
+            geometries: list[qgis.core.QgsGeometry],
+            max_distance: Optional[float],
+            prepared_geometry_cache_budget: int = DEFAULT_PREPARED_GEOMETRY_CACHE_BUDGET,
+            cancel_event: Optional[multiprocessing.synchronize.Event] = None,
+    ):
+        self.geometries = geometries
+        self.max_distance = max_distance
+        self.prepared_geometries = PreparedGeometryCache(
+            geometries, prepared_geometry_cache_budget)
+        if max_distance is not None:
+            self.bounding_box_index = build_bounding_box_index(geometries)
+            self.bounding_box_filter = BoundingBoxDistanceFilter(geometries)
+        else:
+            self.bounding_box_index = None
+            self.bounding_box_filter = None
+        self.cancel_event = cancel_event
+
+    def measure(
+            self,
+            row_start: int,
+            row_end: int,
+    ) -> tuple[distances.DistanceBlock, EdgeDistanceStatistics]:
+        """Measure the edge distances of a row block of the pairs matrix.
+
+        Pairs are returned ordered by row and then by column. A block that is
+        interrupted by cancellation is returned incomplete.
+        """
+        num_nodes = len(self.geometries)
+        statistics = EdgeDistanceStatistics()
+        rows = []
+        cols = []
+        edge_distances = []
+        for row in range(row_start, row_end):
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                break
+            if self.max_distance is None:
+                candidates = range(row + 1, num_nodes)
+            else:
+                candidates = get_candidates_within_distance(
+                    self.bounding_box_index, self.geometries, row, self.max_distance)
+            statistics.candidate_pairs += len(candidates)
+            if self.max_distance is not None:
+                num_candidates = len(candidates)
+                candidates = self.bounding_box_filter.filter_candidates(
+                    row, candidates, self.max_distance)
+                statistics.pruned_pairs += num_candidates - len(candidates)
+            statistics.measured_pairs += len(candidates)
+            for col in candidates:
+                edge_distance = self.prepared_geometries.distance(row, col)
+                if self.max_distance is None or edge_distance <= self.max_distance:
+                    rows.append(row)
+                    cols.append(col)
+                    edge_distances.append(edge_distance)
+        block = distances.DistanceBlock(
+            row_start=row_start,
+            row_end=row_end,
+            rows=np.array(rows, dtype=np.int64),
+            cols=np.array(cols, dtype=np.int64),
+            distances=np.array(edge_distances, dtype=np.float64),
+        )
+        return block, statistics
+
+
+# measurer of a worker process, as set up by `initialize_worker()`
+_worker_measurer: Optional[RowBlockMeasurer] = None
+
+
+def serialize_geometries(geometries: list[qgis.core.QgsGeometry]) -> list[Optional[bytes]]:
+    """Convert geometries to WKB, so that they can be sent to worker processes."""
+    return [None if geom.isNull() else bytes(geom.asWkb()) for geom in geometries]
+
+
+def deserialize_geometries(wkb_geometries: list[Optional[bytes]]) -> list[qgis.core.QgsGeometry]:
+    result = []
+    for wkb in wkb_geometries:
+        geom = qgis.core.QgsGeometry()
+        if wkb is not None:
+            geom.fromWkb(wkb)
+        result.append(geom)
+    return result
+
+
+def initialize_worker(
+        cancel_event: multiprocessing.synchronize.Event,
+        wkb_geometries: list[Optional[bytes]],
+        max_distance: Optional[float],
+        prepared_geometry_cache_budget: int,
+) -> None:
+    """Set up a worker process for measuring edge distances.
+
+    The geometries, and the indexes that are built from them, are received only
+    once per worker and then shared by all the row blocks that it measures.
+    """
+    global _worker_measurer
+    _worker_measurer = RowBlockMeasurer(
+        deserialize_geometries(wkb_geometries),
+        max_distance,
+        prepared_geometry_cache_budget=prepared_geometry_cache_budget,
+        cancel_event=cancel_event,
+    )
+
+
+def measure_row_block(
+        row_start: int,
+        row_end: int,
+) -> tuple[distances.DistanceBlock, EdgeDistanceStatistics]:
+    """Measure the edge distances of a row block of the pairs matrix, in a worker process."""
+    return _worker_measurer.measure(row_start, row_end)
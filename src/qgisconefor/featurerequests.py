@@ -0,0 +1,52 @@
+"""Minimal feature requests for the generators of Conefor files.
+
+Generators receive a `feature_iterator_factory`, which is called with a
+`QgsFeatureRequest` and returns an iterator over the requested features, like
+`QgsFeatureSource.getFeatures()` does. Each generator requests only the
+attributes that it reads and skips geometries when it does not use them.
+"""
+
+from typing import (
+    Callable,
+    Iterable,
+    Optional,
+)
+
+import qgis.core
+
+FeatureIteratorFactory = Callable[[qgis.core.QgsFeatureRequest], qgis.core.QgsFeatureIterator]
+
+
+def get_field_index(fields: qgis.core.QgsFields, field_name: Optional[str]) -> Optional[int]:
+    """Return the index of a field, or `None` when no field name is given."""
+    if field_name is None:
+        return None
+    index = fields.lookupField(field_name)
+    if index < 0:
+        raise qgis.core.QgsProcessingException(f"Field {field_name!r} does not exist")
+    return index
+
+
+def build_feature_request(
+        attribute_indexes: Iterable[Optional[int]],
+        needs_geometry: bool,
+) -> qgis.core.QgsFeatureRequest:
+    """Build a request for only some attributes, and for geometries only if they are needed.
+
+    `None` indexes are ignored, which allows passing the indexes of optional fields.
+    """
+    request = qgis.core.QgsFeatureRequest()
+    if not needs_geometry:
+        request.setFlags(qgis.core.QgsFeatureRequest.NoGeometry)
+    indexes = sorted({index for index in attribute_indexes if index is not None})
+    if len(indexes) > 0:
+        request.setSubsetOfAttributes(indexes)
+    else:
+        request.setNoAttributes()
+    return request
+
+
+def count_parts(geometry: qgis.core.QgsGeometry) -> int:
+    """Return the number of parts of a geometry, without iterating over them."""
+    abstract_geometry = geometry.constGet()
+    return abstract_geometry.partCount() if abstract_geometry is not None else 0
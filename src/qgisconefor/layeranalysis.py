@@ -0,0 +1,161 @@
+"""Caching of the analysis of the layers loaded in the QGIS project."""
+
+import dataclasses
+import hashlib
+import json
+import os
+from typing import (
+    Iterable,
+    Optional,
+)
+
+import qgis.core
+
+from . import schemas
+from .utilities import (
+    load_settings_key,
+    log,
+)
+
+# name of the layer custom property where the analysis is persisted, which
+# QGIS saves together with the project
+_CUSTOM_PROPERTY_NAME = "qgisconefor/layer_analysis"
+
+# providers whose data source is a local file, with a meaningful modification time
+_FILE_BASED_PROVIDERS = ("ogr", "spatialite", "delimitedtext")
+
+
+@dataclasses.dataclass
+class CachedLayerAnalysis:
+    fingerprint: str
+    relevant_fields: Optional[schemas.LayerRelevantFields]  # None means the layer is not usable
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "fingerprint": self.fingerprint,
+                "relevant_fields": (
+                    dataclasses.asdict(self.relevant_fields)
+                    if self.relevant_fields is not None else None
+                ),
+            }
+        )
+
+    @classmethod
+    def from_json(cls, raw: str) -> "CachedLayerAnalysis":
+        parsed = json.loads(raw)
+        raw_fields = parsed["relevant_fields"]
+        return cls(
+            fingerprint=parsed["fingerprint"],
+            relevant_fields=(
+                schemas.LayerRelevantFields(**raw_fields) if raw_fields is not None else None
+            ),
+        )
+
+
+def _get_data_source_modification_time(layer: qgis.core.QgsVectorLayer) -> Optional[float]:
+    result = None
+    provider_name = layer.providerType()
+    if provider_name in _FILE_BASED_PROVIDERS:
+        uri_parts = qgis.core.QgsProviderRegistry.instance().decodeUri(
+            provider_name, layer.source())
+        path = uri_parts.get("path", "")
+        try:
+            result = os.stat(path).st_mtime if path != "" else None
+        except OSError:
+            result = None
+    return result
+
+
+def get_layer_fingerprint(layer: qgis.core.QgsVectorLayer) -> str:
+    """Return a digest of the properties of a layer that affect its analysis.
+
+    The fingerprint covers the data source and its filter, the number of
+    features, the schema of the fields and, for file based data sources, the
+    modification time of the file.
+
+    This is computed on the main thread, so the number of features is the one
+    reported by the data provider, which is usually known without iterating
+    over the features.
+    """
+    provider = layer.dataProvider()
+    contents = {
+        "provider": layer.providerType(),
+        "source": layer.source(),
+        "subset": layer.subsetString(),
+        "geometry_type": int(layer.geometryType()),
+        "feature_count": provider.featureCount() if provider is not None else None,
+        "fields": [(field.name(), field.typeName()) for field in layer.fields()],
+        "modification_time": _get_data_source_modification_time(layer),
+    }
+    return hashlib.sha1(json.dumps(contents).encode("utf-8")).hexdigest()
+
+
+def should_persist_layer_analysis() -> bool:
+    return load_settings_key(
+        schemas.QgisConeforSettingsKey.PERSIST_LAYER_ANALYSIS,
+        as_boolean=True,
+        default_to=False
+    )
+
+
+class LayerAnalysisCache:
+    """Results of analyzing layers, keyed by layer id and validated by the layer's fingerprint.
+
+    When `persist` is `True`, results are also stored as a custom property of
+    each layer, which QGIS saves with the project. This allows reusing them
+    after reopening the project, as long as the layer has not changed.
+    """
+
+    persist: bool
+    _entries: dict[str, CachedLayerAnalysis]
+
+    def __init__(self, persist: bool = False):
+        self.persist = persist
+        self._entries = {}
+
+    def get(
+            self,
+            layer: qgis.core.QgsVectorLayer,
+            fingerprint: str,
+    ) -> Optional[CachedLayerAnalysis]:
+        """Return the cached analysis of a layer, or `None` if it is missing or outdated."""
+        entry = self._entries.get(layer.id())
+        if entry is None and self.persist:
+            entry = self._read_persisted(layer)
+            if entry is not None:
+                self._entries[layer.id()] = entry
+        return entry if entry is not None and entry.fingerprint == fingerprint else None
+
+    def store(
+            self,
+            layer: qgis.core.QgsVectorLayer,
+            fingerprint: str,
+            relevant_fields: Optional[schemas.LayerRelevantFields],
+    ) -> None:
+        entry = CachedLayerAnalysis(fingerprint=fingerprint, relevant_fields=relevant_fields)
+        self._entries[layer.id()] = entry
+        if self.persist:
+            layer.setCustomProperty(_CUSTOM_PROPERTY_NAME, entry.to_json())
+
+    def invalidate(self, layer: qgis.core.QgsMapLayer) -> None:
+        self._entries.pop(layer.id(), None)
+        layer.removeCustomProperty(_CUSTOM_PROPERTY_NAME)
+
+    def discard(self, layer_ids: Iterable[str]) -> None:
+        """Forget about layers that are no longer loaded in the project."""
+        for layer_id in layer_ids:
+            self._entries.pop(layer_id, None)
+
+    def _read_persisted(self, layer: qgis.core.QgsVectorLayer) -> Optional[CachedLayerAnalysis]:
+        raw = layer.customProperty(_CUSTOM_PROPERTY_NAME)
+        result = None
+        if raw:
+            try:
+                result = CachedLayerAnalysis.from_json(raw)
+            except (ValueError, KeyError, TypeError):
+                log(
+                    f"Ignoring invalid persisted analysis of layer {layer.name()!r}",
+                    verbosity=schemas.LogVerbosity.VERBOSE
+                )
+        return result
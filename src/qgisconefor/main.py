@@ -5,7 +5,10 @@ A QGIS plugin for writing input files to the Conefor software.
 import dataclasses
 import functools
 import uuid
-from typing import Optional
+from typing import (
+    Iterable,
+    Optional,
+)
 
 import qgis.core
 import qgis.gui
@@ -20,10 +23,10 @@ from qgis.PyQt import (
 from .resources import *  # noqa
 
 from . import (
+    layeranalysis,
     schemas,
     tasks,
 )
-from .conefordialog import ConeforDialog
 from .processing.provider import ProcessingConeforProvider
 from .processing.algorithms.coneforinputs import ConeforInputsPolygon
 from .tablemodel import (
@@ -35,8 +38,15 @@ from .tablemodel import (
 from .utilities import (
     log,
     load_settings_key,
+    refresh_log_verbosity,
 )
 
+# time, in milliseconds, to wait for more layer events before analyzing layers
+_ANALYSIS_DEBOUNCE_INTERVAL = 500
+
+# group of the QGIS runtime profiler where the plugin startup stages are recorded
+_PROFILER_GROUP = "startup"
+
 
 @dataclasses.dataclass(frozen=True)
 class ConeforInputParameters:
@@ -58,6 +68,148 @@ class ConeforInputParameters:
         )
 
 
+class LayerAnalysisScheduler(QtCore.QObject):
+    """Analyze layers in the background, coalescing bursts of requests.
+
+    Requests are collected until no new request arrives for `debounce_interval`
+    milliseconds and are then handled by a single `LayerAnalyzerTask`, which
+    only gets the requested layers that are not in the analysis cache. A task
+    that is still running when new layers are requested is cancelled and the
+    layers it did not get to are analyzed by the new task instead.
+
+    Each task is tagged with a generation number, which is also recorded for
+    each layer it handles. Results of a task that arrive after a newer task
+    got the same layer are stale and are dropped, since a cancelled task may
+    still deliver results after those of the task that superseded it.
+
+    Emits the results of the requested layers, keyed by their id, as soon as
+    they are known, which for analyzed layers means one at a time. Layers
+    which cannot be used as inputs have a result of `None`. Once there are no
+    more pending requests, emits `analysis_finished`.
+    """
+
+    layers_analyzed = QtCore.pyqtSignal(dict)
+    analysis_finished = QtCore.pyqtSignal()
+
+    cache: layeranalysis.LayerAnalysisCache
+    _pending_layer_ids: set[str]
+    _task: Optional[tasks.LayerAnalyzerTask]
+    _timer: QtCore.QTimer
+    _generation: int
+    _layer_generations: dict[str, int]
+
+    def __init__(
+            self,
+            cache: layeranalysis.LayerAnalysisCache,
+            debounce_interval: int = _ANALYSIS_DEBOUNCE_INTERVAL,
+            parent: Optional[QtCore.QObject] = None,
+    ):
+        super().__init__(parent)
+        self.cache = cache
+        self._pending_layer_ids = set()
+        self._task = None
+        self._generation = 0
+        self._layer_generations = {}
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(debounce_interval)
+        self._timer.timeout.connect(self._start_pending)
+
+    def schedule(self, layer_ids: Iterable[str]) -> None:
+        self._pending_layer_ids.update(layer_ids)
+        self._timer.start()
+
+    def forget(self, layer_ids: Iterable[str]) -> None:
+        """Stop tracking layers that are being removed from the project."""
+        layer_ids = list(layer_ids)
+        self._pending_layer_ids.difference_update(layer_ids)
+        for layer_id in layer_ids:
+            self._layer_generations.pop(layer_id, None)
+        self.cache.discard(layer_ids)
+
+    def cancel(self) -> None:
+        self._timer.stop()
+        self._pending_layer_ids = set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _start_pending(self) -> None:
+        if self._task is not None:
+            log("Cancelling superseded layer analysis", verbosity=schemas.LogVerbosity.VERBOSE)
+            self._pending_layer_ids.update(self._task.pending_layer_ids)
+            self._task.cancel()
+            self._task = None
+        qgis_project = qgis.core.QgsProject.instance()
+        self._generation += 1
+        known_layers = {}
+        layers_to_analyze = {}
+        fingerprints = {}
+        for layer_id in self._pending_layer_ids:
+            layer = qgis_project.mapLayer(layer_id)
+            if layer is None or layer.type() != qgis.core.QgsMapLayer.LayerType.Vector:
+                continue
+            self._layer_generations[layer_id] = self._generation
+            fingerprint = layeranalysis.get_layer_fingerprint(layer)
+            cached = self.cache.get(layer, fingerprint)
+            if cached is not None:
+                known_layers[layer_id] = cached.relevant_fields
+            else:
+                layers_to_analyze[layer_id] = layer
+                fingerprints[layer_id] = fingerprint
+        self._pending_layer_ids = set()
+        if len(layers_to_analyze) > 0:
+            log(
+                f"Analyzing {len(layers_to_analyze)} new or changed layers",
+                verbosity=schemas.LogVerbosity.VERBOSE
+            )
+            task = tasks.LayerAnalyzerTask(
+                description="analyze currently loaded layers",
+                layers_to_analyze=layers_to_analyze,
+            )
+            task.layer_analyzed.connect(
+                functools.partial(
+                    self._handle_layer_analyzed, self._generation, fingerprints))
+            task.layers_analyzed.connect(
+                functools.partial(self._handle_task_finished, task))
+            self._task = task
+            qgis.core.QgsApplication.taskManager().addTask(task)
+        if len(known_layers) > 0:
+            self.layers_analyzed.emit(known_layers)
+        if self._task is None:
+            self.analysis_finished.emit()
+
+    def _handle_layer_analyzed(
+            self,
+            generation: int,
+            fingerprints: dict[str, str],
+            layer_id: str,
+            relevant_fields: Optional[schemas.LayerRelevantFields],
+    ) -> None:
+        if self._layer_generations.get(layer_id) != generation:
+            log(
+                f"Dropping superseded analysis of layer {layer_id!r}",
+                verbosity=schemas.LogVerbosity.DEBUG
+            )
+            return
+        # results of cancelled tasks are still valid for the layers they reached,
+        # as long as no newer task got those layers
+        layer = qgis.core.QgsProject.instance().mapLayer(layer_id)
+        if layer is not None:
+            self.cache.store(layer, fingerprints[layer_id], relevant_fields)
+            self.layers_analyzed.emit({layer_id: relevant_fields})
+
+    def _handle_task_finished(
+            self,
+            task: tasks.LayerAnalyzerTask,
+            analyzed_layers: dict[str, Optional[schemas.LayerRelevantFields]],
+    ) -> None:
+        if task is self._task:
+            self._task = None
+            if len(self._pending_layer_ids) == 0 and not self._timer.isActive():
+                self.analysis_finished.emit()
+
+
 class QgisConefor:
 
     _action_title = "Conefor inputs"
@@ -73,7 +225,10 @@ class QgisConefor:
     ]
     _task_results: dict[str, bool]
 
-    analyzer_task: Optional[tasks.LayerAnalyzerTask]
+    layer_analysis_cache: layeranalysis.LayerAnalysisCache
+    analysis_scheduler: Optional[LayerAnalysisScheduler]
+    _is_tracking_project: bool
+    _show_dialog_when_analyzed: bool
 
     def __init__(self, iface: qgis.gui.QgisInterface):
         self.iface = iface
@@ -83,6 +238,11 @@ class QgisConefor:
         self.processing_context = None
         self._processing_tasks = {}
         self._task_results = {}
+        self.layer_analysis_cache = layeranalysis.LayerAnalysisCache(
+            persist=layeranalysis.should_persist_layer_analysis())
+        self.analysis_scheduler = None
+        self._is_tracking_project = False
+        self._show_dialog_when_analyzed = False
 
     def init_processing(self):
         self.processing_provider = ProcessingConeforProvider()
@@ -90,39 +250,57 @@ class QgisConefor:
         processing_registry.addProvider(self.processing_provider)
 
     def initGui(self):
-        self.init_processing()
-        self.analyzer_task = None
+        """Set up the plugin.
+
+        In lazy startup mode, which is off by default, layers are only tracked
+        and analyzed after the plugin action is used for the first time. The time
+        spent in each stage is recorded in the QGIS runtime profiler.
+        """
+        with qgis.core.QgsScopedRuntimeProfile(
+                "Conefor: register Processing provider", _PROFILER_GROUP):
+            self.init_processing()
+        self.analysis_scheduler = LayerAnalysisScheduler(self.layer_analysis_cache)
+        self.analysis_scheduler.layers_analyzed.connect(self.finished_analyzing_layers)
+        self.analysis_scheduler.analysis_finished.connect(self._handle_analysis_finished)
         self.model = ProcessLayerTableModel(
             qgis_layers={},
             initial_layers_to_process=[],
             lock_layers=False,
             dialog=None
         )
-        self.dialog = ConeforDialog(self, model=self.model)
-        self.dialog.setModal(True)
-        self.dialog.finished.connect(self.handle_dialog_closed)
-        self.dialog.accepted.connect(self.prepare_conefor_inputs)
         self.action = QtWidgets.QAction(
             QtGui.QIcon(schemas.ICON_RESOURCE_PATH),
             f"&{self._action_title}",
             self.iface.mainWindow()
         )
         self.action.triggered.connect(self.run)
-        self.action.setEnabled(False)
+        is_lazy = load_settings_key(
+            schemas.QgisConeforSettingsKey.LAZY_STARTUP, as_boolean=True, default_to=False)
+        self.action.setEnabled(is_lazy)
         self.iface.addPluginToVectorMenu(None, self.action)
         self.iface.addVectorToolBarIcon(self.action)
+        if not is_lazy:
+            with qgis.core.QgsScopedRuntimeProfile(
+                    "Conefor: start tracking layers", _PROFILER_GROUP):
+                self.start_tracking_project()
+
+    def start_tracking_project(self):
+        """Start analyzing the loaded layers and reacting to changes in the project's layers."""
+        self._is_tracking_project = True
         qgis_project = qgis.core.QgsProject.instance()
         self.start_tracking_layers(new_layers=qgis_project.mapLayers().values())
         qgis_project.legendLayersAdded.connect(self.start_tracking_layers)
-        qgis_project.layersRemoved.connect(self.check_for_removed_layers)
+        qgis_project.layersWillBeRemoved.connect(self.check_for_removed_layers)
 
     def unload(self):
         # return
         processing_registry = qgis.core.QgsApplication.processingRegistry()
         processing_registry.removeProvider(self.processing_provider)
-        qgis_project = qgis.core.QgsProject.instance()
-        qgis_project.legendLayersAdded.disconnect(self.start_tracking_layers)
-        qgis_project.layersRemoved.disconnect(self.check_for_removed_layers)
+        if self._is_tracking_project:
+            qgis_project = qgis.core.QgsProject.instance()
+            qgis_project.legendLayersAdded.disconnect(self.start_tracking_layers)
+            qgis_project.layersWillBeRemoved.disconnect(self.check_for_removed_layers)
+        self.analysis_scheduler.cancel()
         self.action.triggered.disconnect(self.run)
         # iface.removePluginVectorMenu() does not work here because it assumes it
         # is dealing with a menu, not a single action
@@ -130,20 +308,19 @@ class QgisConefor:
         vector_menu.removeAction(self.action)
         self.iface.removeVectorToolBarIcon(self.action)
 
-    def start_analyzing_layers(self, disregard_ids: Optional[list[str]] = None) -> None:
-        current_layers = qgis.core.QgsProject.instance().mapLayers()
-        to_disregard = disregard_ids or []
-        relevant_layers = {
-            id_: la for id_, la in current_layers.items() if id_ not in to_disregard}
-        self.analyzer_task = tasks.LayerAnalyzerTask(
-            description="analyze currently loaded layers",
-            layers_to_analyze=relevant_layers,
-        )
-        self.analyzer_task.layers_analyzed.connect(self.finished_analyzing_layers)
-        task_manager = qgis.core.QgsApplication.taskManager()
-        task_manager.addTask(self.analyzer_task)
-
     def run(self):
+        refresh_log_verbosity()
+        if not self._is_tracking_project:
+            # in lazy startup mode layers are only analyzed now and the dialog is
+            # shown once they are done
+            self._show_dialog_when_analyzed = True
+            self.action.setEnabled(False)
+            self.start_tracking_project()
+            self.iface.messageBar().pushMessage(
+                "Conefor inputs", "Analyzing loaded layers...", level=qgis.core.Qgis.Info, duration=3)
+            return
+        if self.dialog is None:
+            self.dialog = self._create_dialog()
         delegate = ProcessLayerDelegate()
         self.dialog.tableView.setItemDelegate(delegate)
         self.model.removeRows(position=0, rows=self.model.rowCount())
@@ -164,10 +341,40 @@ class QgisConefor:
 
     def finished_analyzing_layers(
             self,
-            usable_layers: dict[qgis.core.QgsVectorLayer, schemas.LayerRelevantFields],
+            analyzed_layers: dict[str, Optional[schemas.LayerRelevantFields]],
     ):
-        self.model.data_ = usable_layers
-        self.action.setEnabled(any(usable_layers))
+        """Merge the results of analyzing some layers into the model's data."""
+        qgis_project = qgis.core.QgsProject.instance()
+        results = {}
+        for layer_id, relevant_fields in analyzed_layers.items():
+            layer = qgis_project.mapLayer(layer_id)
+            if layer is not None:
+                results[layer] = relevant_fields
+        self.model.update_layers(results)
+        self.action.setEnabled(any(self.model.data_))
+
+    def _handle_analysis_finished(self):
+        if self._show_dialog_when_analyzed:
+            self._show_dialog_when_analyzed = False
+            if any(self.model.data_):
+                self.run()
+            else:
+                self.iface.messageBar().pushMessage(
+                    "Conefor inputs",
+                    "There are no loaded polygon layers with numeric fields",
+                    level=qgis.core.Qgis.Warning
+                )
+
+    def _create_dialog(self) -> QtWidgets.QDialog:
+        # the dialog module loads its UI file when imported, so it is only
+        # imported when the dialog is first needed
+        from .conefordialog import ConeforDialog
+
+        dialog = ConeforDialog(self, model=self.model)
+        dialog.setModal(True)
+        dialog.finished.connect(self.handle_dialog_closed)
+        dialog.accepted.connect(self.prepare_conefor_inputs)
+        return dialog
 
     def handle_dialog_closed(self, result: int):
         log(f"Dialog has been closed with result {result!r}")
@@ -208,6 +415,12 @@ class QgisConefor:
                     input_layer_param),
                 ConeforInputsPolygon.INPUT_NODE_CONNECTION_DISTANCE_METHOD[0]: (
                     connection_method),
+                # the generated layer relates autogenerated node ids and areas
+                # back to the features
+                ConeforInputsPolygon.INPUT_GENERATE_LAYER[0]: (
+                    layer_params.id_attribute_field_name is None
+                    or layer_params.attribute_field_name is None
+                ),
             },
             context=self.processing_context
         )
@@ -304,7 +517,7 @@ class QgisConefor:
             log("loading generated layer onto map canvas...")
             layer_store = self.processing_context.temporaryLayerStore()
             temp_store_layer_id = results["output_generated_layer"]
-            log(f"{layer_store.mapLayers()=}")
+            log(f"{layer_store.mapLayers()=}", verbosity=schemas.LogVerbosity.DEBUG)
             temp_store_output_layer = layer_store.mapLayers()[temp_store_layer_id]
             output_layer = layer_store.takeMapLayer(temp_store_output_layer)
             output_layer.setName(f"{layer_params.layer.name()}_conefor")
@@ -355,10 +568,14 @@ class QgisConefor:
             if layer.geometryType() == qgis.core.Qgis.GeometryType.Polygon:
                 layer.committedAttributesAdded.connect(self._react_to_layer_attributes_added)
                 layer.committedAttributesDeleted.connect(self._react_to_layer_attributes_deleted)
-        self.start_analyzing_layers()
+                layer.committedAttributeValuesChanges.connect(
+                    self._react_to_layer_attribute_values_changed)
+        self.analysis_scheduler.schedule(layer.id() for layer in new_layers)
 
     def check_for_removed_layers(self, removed_layer_ids: list[str]):
-        self.start_analyzing_layers(disregard_ids=removed_layer_ids)
+        self.analysis_scheduler.forget(removed_layer_ids)
+        self.model.remove_layers(removed_layer_ids)
+        self.action.setEnabled(any(self.model.data_))
 
     def open_output_dir(self):
         output_dir = load_settings_key(
@@ -371,16 +588,34 @@ class QgisConefor:
             layer_id: str,
             added_attributes: list[qgis.core.QgsField]
     ):
-        log(f"inside _react_to_layer_attributes_added called - {locals()}")
-        self.start_analyzing_layers()
+        log(
+            f"inside _react_to_layer_attributes_added called - {locals()}",
+            verbosity=schemas.LogVerbosity.DEBUG
+        )
+        self.analysis_scheduler.schedule([layer_id])
 
     def _react_to_layer_attributes_deleted(
             self,
             layer_id: str,
             deleted_attributes: list[int],
     ):
-        log(f"inside _react_to_layer_attributes_deleted called - {locals()}")
-        self.start_analyzing_layers()
+        log(
+            f"inside _react_to_layer_attributes_deleted called - {locals()}",
+            verbosity=schemas.LogVerbosity.DEBUG
+        )
+        self.analysis_scheduler.schedule([layer_id])
+
+    def _react_to_layer_attribute_values_changed(
+            self,
+            layer_id: str,
+            changed_attribute_values: dict,
+    ):
+        # changing values does not alter the fingerprint of the layer, so its
+        # cached analysis must be dropped explicitly
+        layer = qgis.core.QgsProject.instance().mapLayer(layer_id)
+        if layer is not None:
+            self.layer_analysis_cache.invalidate(layer)
+        self.analysis_scheduler.schedule([layer_id])
 
 
 
@@ -0,0 +1,70 @@
+"""Autogenerated Conefor node identifiers."""
+
+from typing import (
+    Iterable,
+    Optional,
+)
+
+import qgis.core
+
+from . import featurerequests
+
+# node ids are stored as 64 bit signed integers while writing Conefor files
+MAX_NODE_ID = 2 ** 63 - 1
+
+
+class AutogeneratedNodeIds:
+    """Sequential node ids, starting at 1, assigned to features in the order of their feature ids.
+
+    This avoids copying a layer just for adding a node id field to it. The
+    numbering is the same as the one produced by the QGIS 'Add autoincremental
+    field' algorithm when sorting by `$id`, which is used for generating a layer
+    with the node ids, when requested.
+    """
+
+    _node_ids: dict[int, int]
+
+    def __init__(self, feature_ids: Iterable[int]):
+        self._node_ids = {
+            feature_id: node_id
+            for node_id, feature_id in enumerate(sorted(feature_ids), start=1)
+        }
+
+    @classmethod
+    def from_feature_source(
+            cls,
+            source: qgis.core.QgsFeatureSource,
+    ) -> "AutogeneratedNodeIds":
+        """Number the features of a source, reading only their feature ids."""
+        request = featurerequests.build_feature_request([], needs_geometry=False)
+        return cls(feat.id() for feat in source.getFeatures(request))
+
+    def __len__(self):
+        return len(self._node_ids)
+
+    def __getitem__(self, feature_id: int) -> int:
+        return self._node_ids[feature_id]
+
+
+def get_node_id(
+        feature: qgis.core.QgsFeature,
+        node_id_field_index: Optional[int],
+        autogenerated_node_ids: Optional[AutogeneratedNodeIds] = None,
+):
+    """Return the node id of a feature, read from its attributes or autogenerated.
+
+    Node ids that are greater than `MAX_NODE_ID`, which may be found in unsigned
+    64 bit integer fields, are rejected.
+    """
+    if node_id_field_index is not None:
+        result = feature.attribute(node_id_field_index)
+    elif autogenerated_node_ids is not None:
+        result = autogenerated_node_ids[feature.id()]
+    else:
+        raise ValueError("Either a node id field or autogenerated node ids are needed")
+    if isinstance(result, int) and result > MAX_NODE_ID:
+        raise qgis.core.QgsProcessingException(
+            f"node id {result!r} is too large. Conefor node identifiers must not be "
+            f"greater than {MAX_NODE_ID} - Please select another layer field."
+        )
+    return result
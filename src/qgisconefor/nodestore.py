@@ -0,0 +1,222 @@
+"""In-memory store of the nodes of a layer, read in a single pass over its features."""
+
+import dataclasses
+from typing import (
+    Callable,
+    Optional,
+)
+
+import numpy as np
+import qgis.core
+from qgis.PyQt import QtCore
+
+from . import (
+    distances,
+    edgedistances,
+    featurerequests,
+    nodeids,
+    progress,
+)
+from .schemas import LogVerbosity
+from .utilities import RateLimitedLogger
+
+
+@dataclasses.dataclass
+class NodeStore:
+    """Node ids, node attributes and geometric data of a layer's features.
+
+    Nodes are ordered by their feature id, which is the same order used by
+    `distances.CentroidStore` and `edgedistances.GeometryStore`. Node
+    attributes and 'nodes to add' values are stored as read, including
+    `None` for missing values. Centroids and geometries are only stored
+    when they have been requested.
+    """
+
+    node_ids: list
+    feature_ids: np.ndarray
+    attributes: list
+    nodes_to_add: Optional[list] = None
+    centroids: Optional[np.ndarray] = None
+    geometries: Optional[list[qgis.core.QgsGeometry]] = None
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def get_centroid_store(self) -> distances.CentroidStore:
+        if self.centroids is None:
+            raise ValueError("Centroids have not been extracted")
+        return distances.CentroidStore(
+            node_ids=self.node_ids,
+            feature_ids=self.feature_ids,
+            coordinates=self.centroids,
+        )
+
+    def get_geometry_store(self) -> edgedistances.GeometryStore:
+        """Return a store with copies of the geometries.
+
+        Edge distance generators reproject the geometries of their store in
+        place, so each one gets its own copies. Copies of a `QgsGeometry` are
+        implicitly shared, and only take extra memory once they are modified.
+        """
+        if self.geometries is None:
+            raise ValueError("Geometries have not been extracted")
+        return edgedistances.GeometryStore(
+            node_ids=self.node_ids,
+            feature_ids=self.feature_ids.tolist(),
+            geometries=[qgis.core.QgsGeometry(geom) for geom in self.geometries],
+        )
+
+
+@dataclasses.dataclass
+class GeneratedLayerSink:
+    """Sink for copies of the features, with their generated node ids and attributes.
+
+    Each copy holds all of the feature's attributes, followed by its
+    autogenerated node id when `node_id_field_name` is set, and by its
+    computed node attribute when `node_attribute_field_name` is set.
+    """
+
+    sink: qgis.core.QgsFeatureSink
+    fields: qgis.core.QgsFields
+    node_id_field_name: Optional[str] = None
+    node_attribute_field_name: Optional[str] = None
+
+    @staticmethod
+    def get_fields(
+            source_fields: qgis.core.QgsFields,
+            node_id_field_name: Optional[str],
+            node_attribute_field_name: Optional[str],
+    ) -> qgis.core.QgsFields:
+        """Return the fields of the copies, which are the fields of the sink."""
+        fields = qgis.core.QgsFields(source_fields)
+        if node_id_field_name is not None:
+            fields.append(qgis.core.QgsField(node_id_field_name, QtCore.QVariant.LongLong))
+        if node_attribute_field_name is not None:
+            fields.append(qgis.core.QgsField(node_attribute_field_name, QtCore.QVariant.Double))
+        return fields
+
+    def add_feature(self, feature: qgis.core.QgsFeature, node_id, attribute) -> None:
+        copy = qgis.core.QgsFeature(self.fields, feature.id())
+        copy.setGeometry(feature.geometry())
+        attributes = feature.attributes()
+        if self.node_id_field_name is not None:
+            attributes.append(node_id)
+        if self.node_attribute_field_name is not None:
+            attributes.append(attribute)
+        copy.setAttributes(attributes)
+        if not self.sink.addFeature(copy, qgis.core.QgsFeatureSink.FastInsert):
+            raise qgis.core.QgsProcessingException(
+                f"Could not add feature {feature.id()} to the generated layer")
+
+
+def extract_nodes(
+        node_id_field_name: Optional[str],
+        node_attribute_field_name: Optional[str],
+        nodes_to_add_field_name: Optional[str],
+        feature_iterator_factory: featurerequests.FeatureIteratorFactory,
+        fields: qgis.core.QgsFields,
+        area_calculator: Optional[Callable[[qgis.core.QgsGeometry], Optional[float]]] = None,
+        autogenerated_node_ids: Optional[nodeids.AutogeneratedNodeIds] = None,
+        keep_centroids: bool = False,
+        keep_geometries: bool = False,
+        reporter: Optional[progress.ProgressReporter] = None,
+        logger: Optional[RateLimitedLogger] = None,
+        layer_sink: Optional[GeneratedLayerSink] = None,
+) -> NodeStore:
+    """Read all features once and store everything needed for generating Conefor files.
+
+    When `node_attribute_field_name` is `None`, the node attribute is computed
+    from each feature's geometry with `area_calculator`. When there is neither,
+    as when only connection files are written, all node attributes are `None`.
+    When `node_id_field_name` is `None`, node ids are taken from
+    `autogenerated_node_ids`.
+
+    Only the attributes of the given fields are requested, and geometries are
+    only requested when computing areas or storing centroids or geometries.
+    Features with multiple parts are reported when geometries are requested.
+
+    When `layer_sink` is given, all attributes and geometries are requested
+    and a copy of each feature is added to it, in the same pass.
+
+    Reading stops early when `reporter` reports that processing has been
+    cancelled.
+    """
+    logger = logger if logger is not None else RateLimitedLogger()
+    node_id_field_index = featurerequests.get_field_index(fields, node_id_field_name)
+    node_attribute_field_index = featurerequests.get_field_index(
+        fields, node_attribute_field_name)
+    nodes_to_add_field_index = featurerequests.get_field_index(fields, nodes_to_add_field_name)
+    computes_areas = node_attribute_field_index is None and area_calculator is not None
+    needs_geometry = computes_areas or keep_centroids or keep_geometries or layer_sink is not None
+    if layer_sink is not None:
+        request = qgis.core.QgsFeatureRequest()
+    else:
+        request = featurerequests.build_feature_request(
+            [node_id_field_index, node_attribute_field_index, nodes_to_add_field_index],
+            needs_geometry=needs_geometry
+        )
+    records = []
+    seen_ids = set()
+    for feat in feature_iterator_factory(request):
+        if reporter is not None and reporter.is_cancelled():
+            break
+        if logger.should_emit(LogVerbosity.VERBOSE, key="read features"):
+            logger.info(
+                f"Reading feature {feat.id()}...",
+                verbosity=LogVerbosity.VERBOSE,
+                key="read features"
+            )
+        node_id = nodeids.get_node_id(feat, node_id_field_index, autogenerated_node_ids)
+        if node_id in seen_ids:
+            raise qgis.core.QgsProcessingException(
+                f"node id {node_id!r} is not unique. Conefor node identifiers must be "
+                f"unique - Please select another layer field."
+            )
+        seen_ids.add(node_id)
+        geometry = feat.geometry() if needs_geometry else None
+        if geometry is not None and featurerequests.count_parts(geometry) > 1:
+            logger.warning(
+                f"Feature {feat.id()} has multiple parts",
+                key="features with multiple parts"
+            )
+        if node_attribute_field_index is not None:
+            attribute = feat.attribute(node_attribute_field_index)
+        elif computes_areas:
+            attribute = area_calculator(geometry)
+        else:
+            attribute = None
+        if layer_sink is not None:
+            layer_sink.add_feature(feat, node_id, attribute)
+        if keep_centroids:
+            centroid = geometry.centroid().asPoint()
+            centroid_coordinates = (centroid.x(), centroid.y())
+        else:
+            centroid_coordinates = None
+        records.append((
+            feat.id(),
+            node_id,
+            attribute,
+            (
+                feat.attribute(nodes_to_add_field_index)
+                if nodes_to_add_field_index is not None else None
+            ),
+            centroid_coordinates,
+            geometry if keep_geometries else None,
+        ))
+        if reporter is not None:
+            reporter.advance()
+    records.sort(key=lambda record: record[0])
+    return NodeStore(
+        node_ids=[record[1] for record in records],
+        feature_ids=np.array([record[0] for record in records], dtype=np.int64),
+        attributes=[record[2] for record in records],
+        nodes_to_add=(
+            [record[3] for record in records] if nodes_to_add_field_name is not None
+            else None
+        ),
+        centroids=(
+            np.array([record[4] for record in records], dtype=np.float64).reshape(-1, 2)
+            if keep_centroids else None
+        ),
+        geometries=[record[5] for record in records] if keep_geometries else None,
+    )
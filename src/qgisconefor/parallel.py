@@ -0,0 +1,173 @@
+"""Helpers for spreading the generation of Conefor connection files over processes."""
+
+import collections
+import concurrent.futures
+import math
+import multiprocessing
+import multiprocessing.synchronize
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+)
+
+from . import distances
+from .schemas import QgisConeforSettingsKey
+from .utilities import load_settings_key
+
+# each worker gets several row blocks, so that workers which happen to get
+# cheaper blocks do not sit idle while the others finish
+_BLOCKS_PER_WORKER = 8
+
+# how often, in seconds, the main process checks for cancellation while it
+# waits for results
+_CANCELLATION_POLL_INTERVAL = 0.2
+
+
+def get_python_executable() -> str:
+    """Return the path to a Python interpreter that can run worker processes.
+
+    When running inside QGIS, `sys.executable` is usually the QGIS binary rather
+    than a Python interpreter, so the interpreter is looked up next to it.
+    """
+    current = Path(sys.executable)
+    if current.name.lower().startswith("python"):
+        result = str(current)
+    else:
+        if os.name == "nt":
+            candidates = [Path(sys.exec_prefix) / "python.exe", current.parent / "python.exe"]
+        else:
+            candidates = [
+                Path(sys.exec_prefix) / "bin" / f"python{sys.version_info.major}",
+                Path(sys.exec_prefix) / "bin" / "python",
+            ]
+        for candidate in candidates:
+            if candidate.is_file():
+                result = str(candidate)
+                break
+        else:
+            result = shutil.which(f"python{sys.version_info.major}") or "python"
+    return result
+
+
+def get_num_workers(requested: int) -> int:
+    """Return the number of worker processes to use, with 0 meaning all CPUs."""
+    return requested if requested > 0 else (os.cpu_count() or 1)
+
+
+def get_centroid_distance_workers() -> int:
+    """Return the number of worker processes for centroid distances, from the plugin settings."""
+    raw_num_workers = load_settings_key(
+        QgisConeforSettingsKey.CENTROID_DISTANCE_WORKERS, default_to=1)
+    try:
+        requested = int(raw_num_workers)
+    except (TypeError, ValueError):
+        requested = 1
+    return get_num_workers(max(requested, 0))
+
+
+def iter_balanced_row_blocks(
+        num_nodes: int,
+        num_workers: int,
+        max_pairs_per_block: Optional[int] = None,
+) -> Iterator[tuple[int, int]]:
+    """Split the upper triangle of the pairs matrix into row blocks of similar size.
+
+    Blocks are made smaller when they would hold more than `max_pairs_per_block`
+    pairs, which bounds the memory used for measuring each of them.
+    """
+    num_pairs = num_nodes * (num_nodes - 1) // 2
+    balanced_pairs_per_block = max(
+        1, math.ceil(num_pairs / (num_workers * _BLOCKS_PER_WORKER)))
+    if max_pairs_per_block is not None:
+        balanced_pairs_per_block = min(balanced_pairs_per_block, max_pairs_per_block)
+    yield from distances.iter_upper_triangle_row_blocks(num_nodes, balanced_pairs_per_block)
+
+
+class WorkerPool:
+    """A pool of worker processes which can be cancelled from the main process.
+
+    Workers are started with the `spawn` method, which is the only one that is
+    available on all platforms and does not copy the state of QGIS into the
+    workers. Each worker receives `cancel_event` as the first argument of its
+    initializer and is expected to check it regularly.
+    """
+
+    cancel_event: multiprocessing.synchronize.Event
+    executor: concurrent.futures.ProcessPoolExecutor
+
+    def __init__(
+            self,
+            num_workers: int,
+            initializer: Callable,
+            initargs: tuple = (),
+    ):
+        context = multiprocessing.get_context("spawn")
+        context.set_executable(get_python_executable())
+        self.cancel_event = context.Event()
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=context,
+            initializer=initializer,
+            initargs=(self.cancel_event, *initargs),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cancel()
+        return False
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def cancel(self):
+        self.cancel_event.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def iter_ordered_results(
+            self,
+            function: Callable,
+            tasks: Iterable[tuple],
+            cancelled_callback: Optional[Callable[[], bool]] = None,
+            max_pending_tasks: Optional[int] = None,
+    ) -> Iterator:
+        """Run `function` on every task and yield the results in the order of the tasks.
+
+        When `max_pending_tasks` is given, no more than that many tasks are
+        submitted ahead of the result that is yielded next. This bounds the
+        memory held by results that are waiting for earlier ones to finish.
+
+        Stops early, cancelling all pending and running tasks, as soon as
+        `cancelled_callback` returns `True`.
+        """
+        task_iterator = iter(tasks)
+        futures = collections.deque()
+        while True:
+            while max_pending_tasks is None or len(futures) < max_pending_tasks:
+                task = next(task_iterator, None)
+                if task is None:
+                    break
+                futures.append(self.executor.submit(function, *task))
+            if len(futures) == 0:
+                break
+            future = futures.popleft()
+            while True:
+                if cancelled_callback is not None and cancelled_callback():
+                    self.cancel()
+                    return
+                try:
+                    result = future.result(timeout=_CANCELLATION_POLL_INTERVAL)
+                except concurrent.futures.TimeoutError:
+                    continue
+                break
+            yield result
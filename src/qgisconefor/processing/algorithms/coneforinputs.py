@@ -1,17 +1,27 @@
+import dataclasses
 from pathlib import Path
 from typing import Optional
 
 import qgis.core
 from qgis import processing
 
-from ... import coneforinputsprocessor
+from ... import nodeids
 from ...schemas import (
+    LogVerbosity,
     NodeConnectionType,
     QgisConeforSettingsKey,
 )
-from ...utilities import load_settings_key
+from ...utilities import (
+    load_settings_key,
+    log,
+    refresh_log_verbosity,
+)
 from . import base
 
+# The modules that generate the Conefor files, together with NumPy, are only
+# imported when an algorithm runs, so that registering the Processing provider
+# at QGIS startup stays cheap
+
 
 class ConeforInputsBase(base.Base):
     _autogenerated_node_id_field_name = "conefor_node_id"
@@ -24,9 +34,53 @@ class ConeforInputsBase(base.Base):
         "nodes_to_add_attribute",
         "Which attribute to use for the 'nodes to add' Conefor feature"
     )
+    INPUT_USE_GEODESIC_KERNEL = (
+        "use_geodesic_kernel",
+        "Compute centroid distances with the batched geodesic kernel (geographic CRS only)"
+    )
+    INPUT_MAX_CONNECTION_DISTANCE = (
+        "max_connection_distance",
+        "Maximum connection distance, in the same units as the generated distances "
+        "(0 means all pairs of nodes are connected)"
+    )
+    INPUT_NUM_NEAREST_NEIGHBOURS = (
+        "num_nearest_neighbours",
+        "Number of nearest neighbours (only used by the k nearest neighbours methods)"
+    )
+    INPUT_DISTANCE_DECIMAL_PLACES = (
+        "distance_decimal_places",
+        "Number of decimal places of the generated distances (-1 means full precision)"
+    )
+    INPUT_NUM_WORKERS = (
+        "num_workers",
+        "Number of worker processes used for measuring edge distances (0 means one per CPU)"
+    )
+    INPUT_GENERATE_LAYER = (
+        "generate_layer",
+        "Generate a copy of the layer with the autogenerated node attributes"
+    )
+    INPUT_ADDITIONAL_NODE_CONNECTION_DISTANCE_METHODS = (
+        "additional_node_connections",
+        "Additional node connection distance methods, each generating its own connections file"
+    )
+    INPUT_DECAY_DISTANCE = (
+        "decay_distance",
+        "Distance at which the direct dispersal probability equals the decay probability, "
+        "used for also generating probability connection files (0 means no probability files)"
+    )
+    INPUT_DECAY_PROBABILITY = (
+        "decay_probability",
+        "Direct dispersal probability at the decay distance"
+    )
+    INPUT_PROBABILITY_DECIMAL_PLACES = (
+        "probability_decimal_places",
+        "Number of decimal places of the generated probabilities (-1 means full precision)"
+    )
     INPUT_OUTPUT_DIRECTORY = ("output_dir", "Output directory for generated Conefor input files")
     OUTPUT_CONEFOR_NODES_FILE_PATH = ("output_path", "Conefor nodes file")
     OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH = ("output_connections_path", "Conefor connections file")
+    OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS = (
+        "output_connections_paths", "Conefor connections files, one for each requested file")
     OUTPUT_GENERATED_CONEFOR_LAYER = ("output_generated_layer", "Layer with Conefor-generated attributes")
 
     def group(self):
@@ -35,25 +89,56 @@ class ConeforInputsBase(base.Base):
     def groupId(self):
         return "coneforinputs"
 
+    def _get_profiled_layer(
+            self,
+            parameters,
+            parameter_name: str,
+            context: qgis.core.QgsProcessingContext,
+    ) -> Optional[qgis.core.QgsVectorLayer]:
+        """Return the layer of a feature source parameter, for profiling its fields.
+
+        Unlike the feature source, the layer lets GeoPackage, SpatiaLite and
+        PostGIS data sources compute the profiles themselves. Returns `None` when
+        the source only reads some of the layer's features, such as the
+        selected ones.
+        """
+        definition = parameters.get(parameter_name)
+        if isinstance(definition, qgis.core.QgsProcessingFeatureSourceDefinition) and (
+                definition.selectedFeaturesOnly or
+                definition.featureLimit >= 0 or
+                definition.filterExpression != ""
+        ):
+            return None
+        return self.parameterAsVectorLayer(parameters, parameter_name, context)
+
     def _validate_node_attributes(
             self,
             source: qgis.core.QgsProcessingFeatureSource,
             node_id_field: Optional[str],
             nodes_to_add_field: Optional[str],
             node_attribute_field: Optional[str] = None,
+            layer: Optional[qgis.core.QgsVectorLayer] = None,
     ):
+        """Check the node fields, profiling them with `layer` when it is given."""
+        from ... import coneforinputsprocessor
+
+        profiles = coneforinputsprocessor.profile_fields(
+            layer if layer is not None else source,
+            [name for name in (node_id_field, nodes_to_add_field) if name is not None]
+        )
         if node_id_field is not None:
             node_id_source_field = [
                 f for f in source.fields() if f.name() == node_id_field][0]
             node_id_field_is_valid = (
                 coneforinputsprocessor.validate_node_identifier_attribute(
-                    source, node_id_source_field
+                    source, node_id_source_field, profiles[node_id_field]
                 )
             )
             if not node_id_field_is_valid:
                 raise qgis.core.QgsProcessingException(
                     f"Node id field is not valid - if set, the node id field must be "
-                    f"an integer column with unique values"
+                    f"an integer column with unique values, none of them greater than "
+                    f"{nodeids.MAX_NODE_ID}"
                 )
         if node_attribute_field is not None:
             node_attribute_source_field = [
@@ -71,7 +156,8 @@ class ConeforInputsBase(base.Base):
             nodes_to_add_field_is_valid = (
                 coneforinputsprocessor.validate_node_to_add_attribute(
                     source,
-                    nodes_to_add_source_field
+                    nodes_to_add_source_field,
+                    profiles[nodes_to_add_field]
                 )
             )
             if not nodes_to_add_field_is_valid:
@@ -81,68 +167,234 @@ class ConeforInputsBase(base.Base):
                     f"values."
                 )
 
-    def _generate_node_file_by_attribute(
+    def _add_node_connection_parameters(self, default_value):
+        self.addParameter(
+            qgis.core.QgsProcessingParameterEnum(
+                name=self.INPUT_NODE_CONNECTION_DISTANCE_METHOD[0],
+                description=self.tr(
+                    self.INPUT_NODE_CONNECTION_DISTANCE_METHOD[1]),
+                options=self._NODE_DISTANCE_CHOICES,
+                defaultValue=default_value
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterEnum(
+                name=self.INPUT_ADDITIONAL_NODE_CONNECTION_DISTANCE_METHODS[0],
+                description=self.tr(
+                    self.INPUT_ADDITIONAL_NODE_CONNECTION_DISTANCE_METHODS[1]),
+                options=self._NODE_DISTANCE_CHOICES,
+                allowMultiple=True,
+                optional=True,
+            )
+        )
+
+    def _get_connection_methods(
+            self,
+            parameters,
+            context: qgis.core.QgsProcessingContext,
+    ) -> list[NodeConnectionType]:
+        """Return the main connection method followed by any additional ones."""
+        result = [
+            NodeConnectionType(
+                self._NODE_DISTANCE_CHOICES[
+                    self.parameterAsEnum(
+                        parameters, self.INPUT_NODE_CONNECTION_DISTANCE_METHOD[0], context
+                    )
+                ]
+            )
+        ]
+        additional_indexes = self.parameterAsEnums(
+            parameters, self.INPUT_ADDITIONAL_NODE_CONNECTION_DISTANCE_METHODS[0], context)
+        for index in additional_indexes:
+            connection_method = NodeConnectionType(self._NODE_DISTANCE_CHOICES[index])
+            if connection_method not in result:
+                result.append(connection_method)
+        return result
+
+    def _add_decay_parameters(self):
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_DECAY_DISTANCE[0],
+                description=self.tr(self.INPUT_DECAY_DISTANCE[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_DECAY_PROBABILITY[0],
+                description=self.tr(self.INPUT_DECAY_PROBABILITY[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Double,
+                defaultValue=0.5,
+                minValue=0,
+                maxValue=1,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_PROBABILITY_DECIMAL_PLACES[0],
+                description=self.tr(self.INPUT_PROBABILITY_DECIMAL_PLACES[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Integer,
+                defaultValue=-1,
+                minValue=-1,
+            )
+        )
+
+    def _get_decay_parameters(
+            self,
+            parameters,
+            context: qgis.core.QgsProcessingContext,
+    ) -> tuple[Optional[float], Optional[float]]:
+        decay_distance = self.parameterAsDouble(
+            parameters, self.INPUT_DECAY_DISTANCE[0], context)
+        decay_probability = self.parameterAsDouble(
+            parameters, self.INPUT_DECAY_PROBABILITY[0], context)
+        if decay_distance > 0:
+            if not 0 < decay_probability < 1:
+                raise qgis.core.QgsProcessingException(
+                    f"Decay probability must be between zero and one - "
+                    f"found a value of {decay_probability!r}"
+                )
+            result = decay_distance, decay_probability
+        else:
+            result = None, None
+        return result
+
+    def _get_connection_file_specs(
+            self,
+            connection_methods: list[NodeConnectionType],
+            output_dir: Path,
+            filename_fragment: str,
+            max_distance: Optional[float] = None,
+            num_nearest_neighbours: Optional[int] = None,
+            use_geodesic_kernel: bool = False,
+            num_workers: int = 1,
+            decimal_places: Optional[int] = None,
+            decay_distance: Optional[float] = None,
+            decay_probability: Optional[float] = None,
+            probability_decimal_places: Optional[int] = None,
+    ) -> list:
+        """Return the connection files to generate, a distance file for each method.
+
+        When a decay distance is given, each method also gets a probability file.
+        Distances are written with `decimal_places` decimals and probabilities
+        with `probability_decimal_places`, each with full precision when `None`.
+
+        Edge distances use `num_workers` worker processes, while centroid
+        distances use the number that is set in the plugin settings.
+        """
+        from ... import (
+            coneforinputsprocessor,
+            parallel,
+        )
+
+        centroid_num_workers = parallel.get_centroid_distance_workers()
+        result = []
+        for connection_method in connection_methods:
+            uses_edges = connection_method in (
+                NodeConnectionType.EDGE_DISTANCE,
+                NodeConnectionType.EDGE_DISTANCE_NEAREST_NEIGHBOURS,
+            )
+            uses_nearest_neighbours = connection_method in (
+                NodeConnectionType.EDGE_DISTANCE_NEAREST_NEIGHBOURS,
+                NodeConnectionType.CENTROID_DISTANCE_NEAREST_NEIGHBOURS,
+            )
+            method_fragment = "edges" if uses_edges else "centroids"
+            if uses_nearest_neighbours:
+                method_fragment = f"{method_fragment}_{num_nearest_neighbours}nn"
+            spec = coneforinputsprocessor.ConnectionFileSpec(
+                connection_method=connection_method,
+                output_path=output_dir / f"distances_{method_fragment}_{filename_fragment}.txt",
+                max_distance=max_distance,
+                num_nearest_neighbours=num_nearest_neighbours,
+                use_geodesic_kernel=use_geodesic_kernel,
+                num_workers=num_workers if uses_edges else centroid_num_workers,
+                decimal_places=decimal_places,
+            )
+            result.append(spec)
+            if decay_distance is not None:
+                result.append(
+                    dataclasses.replace(
+                        spec,
+                        output_path=(
+                            output_dir /
+                            f"probabilities_{method_fragment}_{filename_fragment}.txt"
+                        ),
+                        decimal_places=probability_decimal_places,
+                        decay_distance=decay_distance,
+                        decay_probability=decay_probability,
+                    )
+                )
+        return result
+
+    def _generate_conefor_files(
         self,
-        node_id_field: str,
-        node_attribute_field: str,
+        node_id_field: Optional[str],
+        node_attribute_field: Optional[str],
         nodes_to_add_field: Optional[str],
         source: qgis.core.QgsProcessingFeatureSource,
         output_dir: Path,
         filename_fragment: str,
+        connection_files: list,
         feedback: qgis.core.QgsProcessingFeedback,
-        start_progress: int,
-        progress_step: float,
-    ) -> Path:
-        node_attribute_fragment = (
-            node_attribute_field
-            if node_attribute_field != self._autogenerated_node_attribute_field_name
-            else "calculated_area"
-        )
-        return coneforinputsprocessor.generate_node_file_by_attribute(
+        area_unit: Optional[qgis.core.Qgis.AreaUnit] = None,
+        autogenerated_node_ids: Optional[nodeids.AutogeneratedNodeIds] = None,
+        layer_sink=None,
+    ):
+        """Generate the node file and all connection files, reading the features only once.
+
+        Each feature's area is used as the node attribute when there is no node
+        attribute field. Copies of the features are added to `layer_sink`, if
+        it is given.
+        """
+        from ... import coneforinputsprocessor
+
+        if node_attribute_field is None:
+            node_attribute_fragment = "calculated_area"
+            area_calculator = coneforinputsprocessor.get_area_calculator(
+                source.sourceCrs(), area_unit)
+        else:
+            node_attribute_fragment = node_attribute_field
+            area_calculator = None
+        return coneforinputsprocessor.generate_conefor_files(
             node_id_field_name=node_id_field,
             node_attribute_field_name=node_attribute_field,
             nodes_to_add_field_name=nodes_to_add_field,
+            crs=source.sourceCrs(),
             feature_iterator_factory=source.getFeatures,
-            output_path=(
+            fields=source.fields(),
+            num_features=source.featureCount(),
+            nodes_output_path=(
                     output_dir / f"nodes_{node_attribute_fragment}_{filename_fragment}.txt"
             ),
+            connection_files=connection_files,
             progress_callback=feedback.setProgress,
-            start_progress=start_progress,
-            progress_step=progress_step,
             info_callback=feedback.pushInfo,
+            cancelled_callback=feedback.isCanceled,
+            writer_memory_budget=coneforinputsprocessor.get_writer_memory_budget(),
+            area_calculator=area_calculator,
+            autogenerated_node_ids=autogenerated_node_ids,
+            layer_sink=layer_sink,
         )
 
-    def _generate_connection_file_by_centroid_distance(
-        self,
-        node_id_field: str,
-        source: qgis.core.QgsProcessingFeatureSource,
-        output_dir: Path,
-        filename_fragment: str,
-        feedback: qgis.core.QgsProcessingFeedback,
-        progress_step: float,
-        start_progress: int = 0,
-    ) -> Optional[Path]:
-        return (
-            coneforinputsprocessor.generate_connection_file_with_centroid_distances(
-                node_id_field_name=node_id_field,
-                crs=source.sourceCrs(),
-                feature_iterator_factory=source.getFeatures,
-                num_features=source.featureCount(),
-                output_path=(
-                        output_dir / f"distances_centroids_{filename_fragment}.txt"
-                ),
-                progress_callback=feedback.setProgress,
-                start_progress=start_progress,
-                progress_step=progress_step,
-                info_callback=feedback.pushInfo,
-                cancelled_callback=feedback.isCanceled,
-            )
-        )
+    def _set_generated_files_results(self, result: dict, generated_files) -> None:
+        result[self.OUTPUT_CONEFOR_NODES_FILE_PATH[0]] = generated_files.nodes_path
+        connections_paths = generated_files.connections_paths
+        result[self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH[0]] = (
+            connections_paths[0] if len(connections_paths) > 0 else None)
+        result[self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS[0]] = [
+            str(path) for path in connections_paths if path is not None]
 
 
 class ConeforInputsPoint(ConeforInputsBase):
     INPUT_POINT_LAYER = ("vector_layer", "Point layer",)
     INPUT_NODE_ATTRIBUTE_NAME = ("node_attribute", "Node attribute")
+    INPUT_NODE_CONNECTION_DISTANCE_METHOD = ("node_connection", "Node connection distance method")
+    _NODE_DISTANCE_CHOICES = [
+        NodeConnectionType.CENTROID_DISTANCE.value,
+        NodeConnectionType.CENTROID_DISTANCE_NEAREST_NEIGHBOURS.value,
+    ]
 
     def name(self):
         return "inputsfrompoint"
@@ -187,6 +439,49 @@ class ConeforInputsPoint(ConeforInputsBase):
                 optional=True,
             )
         )
+        self._add_node_connection_parameters(default_value=0)
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_NUM_NEAREST_NEIGHBOURS[0],
+                description=self.tr(self.INPUT_NUM_NEAREST_NEIGHBOURS[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Integer,
+                defaultValue=5,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterBoolean(
+                name=self.INPUT_USE_GEODESIC_KERNEL[0],
+                description=self.tr(self.INPUT_USE_GEODESIC_KERNEL[1]),
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_MAX_CONNECTION_DISTANCE[0],
+                description=self.tr(self.INPUT_MAX_CONNECTION_DISTANCE[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_DISTANCE_DECIMAL_PLACES[0],
+                description=self.tr(self.INPUT_DISTANCE_DECIMAL_PLACES[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Integer,
+                defaultValue=-1,
+                minValue=-1,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterBoolean(
+                name=self.INPUT_GENERATE_LAYER[0],
+                description=self.tr(self.INPUT_GENERATE_LAYER[1]),
+                defaultValue=False,
+            )
+        )
+        self._add_decay_parameters()
         self.addParameter(
             qgis.core.QgsProcessingParameterFolderDestination(
                 name=self.INPUT_OUTPUT_DIRECTORY[0],
@@ -207,8 +502,15 @@ class ConeforInputsPoint(ConeforInputsBase):
                 description=self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH[1],
             )
         )
+        self.addOutput(
+            qgis.core.QgsProcessingOutputVariant(
+                name=self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS[0],
+                description=self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS[1],
+            )
+        )
 
     def processAlgorithm(self, parameters, context, feedback):
+        refresh_log_verbosity()
         source = self.parameterAsSource(
             parameters,
             self.INPUT_POINT_LAYER[0],
@@ -222,6 +524,7 @@ class ConeforInputsPoint(ConeforInputsBase):
             node_id_field_name = None
         else:
             node_id_field_name = raw_node_id_field_name
+        connection_methods = self._get_connection_methods(parameters, context)
         output_dir = Path(
             self.parameterAsFile(
                 parameters,
@@ -241,81 +544,89 @@ class ConeforInputsPoint(ConeforInputsBase):
             nodes_to_add_field_name = None
         else:
             nodes_to_add_field_name = raw_nodes_to_add_field_name
-
-        feedback.pushInfo(f"{source=}")
-        feedback.pushInfo(f"{node_id_field_name=}")
-        feedback.pushInfo(f"{node_attribute_field_name=}")
-        feedback.pushInfo(f"{nodes_to_add_field_name=}")
-        feedback.pushInfo(f"{output_dir=}")
+        use_geodesic_kernel = self.parameterAsBoolean(
+            parameters, self.INPUT_USE_GEODESIC_KERNEL[0], context)
+        raw_max_connection_distance = self.parameterAsDouble(
+            parameters, self.INPUT_MAX_CONNECTION_DISTANCE[0], context)
+        if raw_max_connection_distance > 0:
+            max_connection_distance = raw_max_connection_distance
+        else:
+            max_connection_distance = None
+        num_nearest_neighbours = self.parameterAsInt(
+            parameters, self.INPUT_NUM_NEAREST_NEIGHBOURS[0], context)
+        raw_decimal_places = self.parameterAsInt(
+            parameters, self.INPUT_DISTANCE_DECIMAL_PLACES[0], context)
+        decimal_places = raw_decimal_places if raw_decimal_places >= 0 else None
+        raw_probability_decimal_places = self.parameterAsInt(
+            parameters, self.INPUT_PROBABILITY_DECIMAL_PLACES[0], context)
+        probability_decimal_places = (
+            raw_probability_decimal_places if raw_probability_decimal_places >= 0 else None)
+        generate_layer = self.parameterAsBoolean(
+            parameters, self.INPUT_GENERATE_LAYER[0], context)
+        decay_distance, decay_probability = self._get_decay_parameters(parameters, context)
+
+        log(
+            f"Generating Conefor inputs from point layer {source.sourceName()!r} with "
+            f"{node_id_field_name=}, {node_attribute_field_name=}, "
+            f"{nodes_to_add_field_name=}, {connection_methods=}, "
+            f"{max_connection_distance=}, {output_dir=}",
+            verbosity=LogVerbosity.DEBUG
+        )
 
         result = {
             self.OUTPUT_CONEFOR_NODES_FILE_PATH[0]: None,
             self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH[0]: None,
+            self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS[0]: [],
             self.OUTPUT_GENERATED_CONEFOR_LAYER[0]: None,
         }
 
         if source.featureCount() > 0:
             results_name_fragment = source.sourceName()
-            if node_id_field_name is None:  # will be generating a new layer
-                feedback.pushInfo(
-                    "No node identifier specified - adding a new field to a copy of "
-                    "the layer"
-                )
-                final_layer_path = self._generate_layer_with_node_id(
-                    parameters, feedback, context)
-                layer_with_node_id = qgis.core.QgsProcessingUtils.mapLayerFromString(
-                    final_layer_path, context)
-                source = qgis.core.QgsProcessingFeatureSource(
-                    layer_with_node_id,
-                    context,
-                    ownsOriginalSource=False,
-                )
-                node_id_field_name = self._autogenerated_node_id_field_name
-
-                result[self.OUTPUT_GENERATED_CONEFOR_LAYER[0]] = final_layer_path
-                relevant_details = context.layerToLoadOnCompletionDetails(final_layer_path)
-                relevant_details.name = f"{source.sourceName()}_conefor_generated"
-                context.setLayersToLoadOnCompletion({final_layer_path: relevant_details})
+            autogenerated_node_ids = None
+            if node_id_field_name is None:
+                feedback.pushInfo("No node identifier specified - autogenerating node ids")
+                autogenerated_node_ids = nodeids.AutogeneratedNodeIds.from_feature_source(source)
+                if generate_layer:
+                    feedback.pushInfo("Adding the node ids to a copy of the layer")
+                    final_layer_path = self._generate_layer_with_node_id(
+                        parameters, feedback, context)
+                    result[self.OUTPUT_GENERATED_CONEFOR_LAYER[0]] = final_layer_path
+                    relevant_details = context.layerToLoadOnCompletionDetails(final_layer_path)
+                    relevant_details.name = f"{source.sourceName()}_conefor_generated"
+                    context.setLayersToLoadOnCompletion({final_layer_path: relevant_details})
 
             self._validate_node_attributes(
                 source,
                 node_id_field=node_id_field_name,
                 nodes_to_add_field=nodes_to_add_field_name,
                 node_attribute_field=node_attribute_field_name,
+                layer=self._get_profiled_layer(parameters, self.INPUT_POINT_LAYER[0], context),
             )
 
-            num_features_to_process = source.featureCount()
-            node_file_lines = num_features_to_process
-            connection_file_lines = num_features_to_process * (num_features_to_process - 1) // 2
-            remaining_progress = 100
-            progress_step = remaining_progress / (node_file_lines + connection_file_lines)
-            node_file_progress_portion = progress_step * node_file_lines
-
-            node_file_output_path = (
-                self._generate_node_file_by_attribute(
-                    node_id_field_name,
-                    node_attribute_field_name,
-                    nodes_to_add_field_name,
-                    source,
-                    output_dir,
-                    filename_fragment=results_name_fragment,
-                    feedback=feedback,
-                    start_progress=remaining_progress,
-                    progress_step=progress_step,
-                )
+            connection_files = self._get_connection_file_specs(
+                connection_methods,
+                output_dir,
+                results_name_fragment,
+                max_distance=max_connection_distance,
+                num_nearest_neighbours=num_nearest_neighbours,
+                use_geodesic_kernel=use_geodesic_kernel,
+                decimal_places=decimal_places,
+                decay_distance=decay_distance,
+                decay_probability=decay_probability,
+                probability_decimal_places=probability_decimal_places,
             )
-            remaining_progress -= node_file_progress_portion
-            result[self.OUTPUT_CONEFOR_NODES_FILE_PATH[0]] = node_file_output_path
-            connections_file_output_path = self._generate_connection_file_by_centroid_distance(
+            generated_files = self._generate_conefor_files(
                 node_id_field_name,
+                node_attribute_field_name,
+                nodes_to_add_field_name,
                 source,
                 output_dir,
-                results_name_fragment,
-                feedback,
-                start_progress=(100 - remaining_progress),
-                progress_step=progress_step,
+                filename_fragment=results_name_fragment,
+                connection_files=connection_files,
+                feedback=feedback,
+                autogenerated_node_ids=autogenerated_node_ids,
             )
-            result[self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH[0]] = connections_file_output_path
+            self._set_generated_files_results(result, generated_files)
         else:
             feedback.pushInfo("The selected source has no features to process")
         feedback.setProgress(100)
@@ -335,6 +646,9 @@ class ConeforInputsPoint(ConeforInputsBase):
                 "INPUT": parameters[self.INPUT_POINT_LAYER[0]],
                 "FIELD_NAME": self._autogenerated_node_id_field_name,
                 "START": 1,
+                # same numbering as nodeids.AutogeneratedNodeIds
+                "SORT_EXPRESSION": "$id",
+                "SORT_ASCENDING": True,
                 "OUTPUT": qgis.core.QgsProcessingOutputLayerDefinition(
                     "memory:",
                     qgis.core.QgsProject.instance()
@@ -353,6 +667,8 @@ class ConeforInputsPolygon(ConeforInputsBase):
     _NODE_DISTANCE_CHOICES = [
         NodeConnectionType.EDGE_DISTANCE.value,
         NodeConnectionType.CENTROID_DISTANCE.value,
+        NodeConnectionType.EDGE_DISTANCE_NEAREST_NEIGHBOURS.value,
+        NodeConnectionType.CENTROID_DISTANCE_NEAREST_NEIGHBOURS.value,
     ]
 
     def name(self):
@@ -398,15 +714,59 @@ class ConeforInputsPolygon(ConeforInputsBase):
                 optional=True,
             )
         )
+        self._add_node_connection_parameters(
+            default_value=NodeConnectionType.EDGE_DISTANCE.value)
         self.addParameter(
-            qgis.core.QgsProcessingParameterEnum(
-                name=self.INPUT_NODE_CONNECTION_DISTANCE_METHOD[0],
-                description=self.tr(
-                    self.INPUT_NODE_CONNECTION_DISTANCE_METHOD[1]),
-                options=self._NODE_DISTANCE_CHOICES,
-                defaultValue=NodeConnectionType.EDGE_DISTANCE.value
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_NUM_NEAREST_NEIGHBOURS[0],
+                description=self.tr(self.INPUT_NUM_NEAREST_NEIGHBOURS[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Integer,
+                defaultValue=5,
+                minValue=1,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterBoolean(
+                name=self.INPUT_USE_GEODESIC_KERNEL[0],
+                description=self.tr(self.INPUT_USE_GEODESIC_KERNEL[1]),
+                defaultValue=False,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_MAX_CONNECTION_DISTANCE[0],
+                description=self.tr(self.INPUT_MAX_CONNECTION_DISTANCE[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Double,
+                defaultValue=0,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_NUM_WORKERS[0],
+                description=self.tr(self.INPUT_NUM_WORKERS[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Integer,
+                defaultValue=1,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterNumber(
+                name=self.INPUT_DISTANCE_DECIMAL_PLACES[0],
+                description=self.tr(self.INPUT_DISTANCE_DECIMAL_PLACES[1]),
+                type=qgis.core.QgsProcessingParameterNumber.Integer,
+                defaultValue=-1,
+                minValue=-1,
             )
         )
+        self.addParameter(
+            qgis.core.QgsProcessingParameterBoolean(
+                name=self.INPUT_GENERATE_LAYER[0],
+                description=self.tr(self.INPUT_GENERATE_LAYER[1]),
+                defaultValue=False,
+            )
+        )
+        self._add_decay_parameters()
         self.addParameter(
             qgis.core.QgsProcessingParameterFolderDestination(
                 name=self.INPUT_OUTPUT_DIRECTORY[0],
@@ -427,6 +787,12 @@ class ConeforInputsPolygon(ConeforInputsBase):
                 description=self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH[1],
             )
         )
+        self.addOutput(
+            qgis.core.QgsProcessingOutputVariant(
+                name=self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS[0],
+                description=self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS[1],
+            )
+        )
         self.addOutput(
             qgis.core.QgsProcessingOutputVectorLayer(
                 name=self.OUTPUT_GENERATED_CONEFOR_LAYER[0],
@@ -435,6 +801,7 @@ class ConeforInputsPolygon(ConeforInputsBase):
         )
 
     def processAlgorithm(self, parameters, context, feedback):
+        refresh_log_verbosity()
         source = self.parameterAsSource(
             parameters,
             self.INPUT_POLYGON_LAYER[0],
@@ -448,14 +815,7 @@ class ConeforInputsPolygon(ConeforInputsBase):
             node_id_field_name = None
         else:
             node_id_field_name = raw_node_id_field_name
-        connections_distance_method = NodeConnectionType(
-            self._NODE_DISTANCE_CHOICES[
-                self.parameterAsEnum(
-                    parameters, self.INPUT_NODE_CONNECTION_DISTANCE_METHOD[0], context
-                )
-            ]
-        )
-        feedback.pushInfo(f"{connections_distance_method.value=} ")
+        connection_methods = self._get_connection_methods(parameters, context)
         output_dir = Path(
             self.parameterAsFile(
                 parameters,
@@ -479,61 +839,67 @@ class ConeforInputsPolygon(ConeforInputsBase):
             nodes_to_add_field_name = None
         else:
             nodes_to_add_field_name = raw_nodes_to_add_field_name
-
-        feedback.pushInfo(f"{source=}")
-        feedback.pushInfo(f"{node_id_field_name=}")
-        feedback.pushInfo(f"{nodes_to_add_field_name=}")
-        feedback.pushInfo(f"{connections_distance_method=}")
-        feedback.pushInfo(f"{output_dir=}")
+        use_geodesic_kernel = self.parameterAsBoolean(
+            parameters, self.INPUT_USE_GEODESIC_KERNEL[0], context)
+        raw_max_connection_distance = self.parameterAsDouble(
+            parameters, self.INPUT_MAX_CONNECTION_DISTANCE[0], context)
+        if raw_max_connection_distance > 0:
+            max_connection_distance = raw_max_connection_distance
+        else:
+            max_connection_distance = None
+        num_nearest_neighbours = self.parameterAsInt(
+            parameters, self.INPUT_NUM_NEAREST_NEIGHBOURS[0], context)
+        from ... import parallel
+
+        num_workers = parallel.get_num_workers(
+            self.parameterAsInt(parameters, self.INPUT_NUM_WORKERS[0], context))
+        raw_decimal_places = self.parameterAsInt(
+            parameters, self.INPUT_DISTANCE_DECIMAL_PLACES[0], context)
+        decimal_places = raw_decimal_places if raw_decimal_places >= 0 else None
+        raw_probability_decimal_places = self.parameterAsInt(
+            parameters, self.INPUT_PROBABILITY_DECIMAL_PLACES[0], context)
+        probability_decimal_places = (
+            raw_probability_decimal_places if raw_probability_decimal_places >= 0 else None)
+        generate_layer = self.parameterAsBoolean(
+            parameters, self.INPUT_GENERATE_LAYER[0], context)
+        decay_distance, decay_probability = self._get_decay_parameters(parameters, context)
+
+        log(
+            f"Generating Conefor inputs from polygon layer {source.sourceName()!r} with "
+            f"{node_id_field_name=}, {node_attribute_field_name=}, "
+            f"{nodes_to_add_field_name=}, {connection_methods=}, "
+            f"{max_connection_distance=}, {num_workers=}, {output_dir=}",
+            verbosity=LogVerbosity.DEBUG
+        )
 
         result = {
             self.OUTPUT_CONEFOR_NODES_FILE_PATH[0]: None,
             self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH[0]: None,
+            self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATHS[0]: [],
             self.OUTPUT_GENERATED_CONEFOR_LAYER[0]: None,
         }
         if source.featureCount() > 0:
             results_name_fragment = source.sourceName()
+            autogenerated_node_ids = None
+            layer_sink = None
             if not all((node_id_field_name, node_attribute_field_name)):  # will be generating a new layer
-                final_layer_path = None
+                # node ids and areas are computed while generating the files, a
+                # layer with them is only generated when requested
                 if node_id_field_name is None:
-                    feedback.pushInfo(
-                        "No node identifier specified - adding a new field to a copy of "
-                        "the layer"
-                    )
-                    final_layer_path = self._generate_layer_with_node_id(
-                        parameters, feedback, context)
-                    layer_with_node_id = qgis.core.QgsProcessingUtils.mapLayerFromString(
-                        final_layer_path, context)
-                    source = qgis.core.QgsProcessingFeatureSource(
-                        layer_with_node_id,
-                        context,
-                        ownsOriginalSource=False,
-                    )
-                    node_id_field_name = self._autogenerated_node_id_field_name
-
+                    feedback.pushInfo("No node identifier specified - autogenerating node ids")
+                    autogenerated_node_ids = (
+                        nodeids.AutogeneratedNodeIds.from_feature_source(source))
                 if node_attribute_field_name is None:  # being asked to use the area as the attribute
-                    feedback.pushInfo(
-                        "Using features' area as the node attribute - adding to a "
-                        "copy of the layer"
+                    feedback.pushInfo("Using features' ellipsoidal area as the node attribute")
+                if generate_layer:
+                    feedback.pushInfo("Adding the generated attributes to a copy of the layer")
+                    layer_sink, generated_layer_id = self._create_generated_layer_sink(
+                        source,
+                        add_node_ids=node_id_field_name is None,
+                        add_node_attributes=node_attribute_field_name is None,
+                        context=context,
                     )
-                    final_layer_path = self._generate_layer_with_area_as_node_attribute(
-                        source, feedback, context)
-                    node_attribute_field_name = self._autogenerated_node_attribute_field_name
-                    layer_with_node_id_and_area = qgis.core.QgsProcessingUtils.mapLayerFromString(
-                        final_layer_path, context)
-                    source = qgis.core.QgsProcessingFeatureSource(
-                        layer_with_node_id_and_area,
-                        context,
-                        ownsOriginalSource=False,
-                    )
-                result[self.OUTPUT_GENERATED_CONEFOR_LAYER[0]] = final_layer_path
-                # we do not want QGIS to try to automatically load the intermediate
-                # layers, which will happen when calling this algorithm from the
-                # Processing toolbox - as such, we tell the context to only load the
-                # final layer
-                relevant_details = context.layerToLoadOnCompletionDetails(final_layer_path)
-                relevant_details.name = f"{source.sourceName()}_conefor_generated"
-                context.setLayersToLoadOnCompletion({final_layer_path: relevant_details})
+                    result[self.OUTPUT_GENERATED_CONEFOR_LAYER[0]] = generated_layer_id
 
 
             self._validate_node_attributes(
@@ -541,155 +907,75 @@ class ConeforInputsPolygon(ConeforInputsBase):
                 node_id_field=node_id_field_name,
                 nodes_to_add_field=nodes_to_add_field_name,
                 node_attribute_field=node_attribute_field_name,
+                layer=self._get_profiled_layer(parameters, self.INPUT_POLYGON_LAYER[0], context),
             )
-            num_features_to_process = source.featureCount()
-            node_file_lines = num_features_to_process
-            connection_file_lines = num_features_to_process * (num_features_to_process - 1) // 2
-            remaining_progress = 100
-            progress_step = remaining_progress / (node_file_lines + connection_file_lines)
-            node_file_progress_portion = progress_step * node_file_lines
-            node_file_output_path = (
-                self._generate_node_file_by_attribute(
-                    node_id_field_name,
-                    node_attribute_field_name,
-                    nodes_to_add_field_name,
-                    source,
-                    output_dir,
-                    filename_fragment=results_name_fragment,
-                    feedback=feedback,
-                    start_progress=remaining_progress,
-                    progress_step=progress_step,
-                )
+            connection_files = self._get_connection_file_specs(
+                connection_methods,
+                output_dir,
+                results_name_fragment,
+                max_distance=max_connection_distance,
+                num_nearest_neighbours=num_nearest_neighbours,
+                use_geodesic_kernel=use_geodesic_kernel,
+                num_workers=num_workers,
+                decimal_places=decimal_places,
+                decay_distance=decay_distance,
+                decay_probability=decay_probability,
+                probability_decimal_places=probability_decimal_places,
             )
-            remaining_progress -= node_file_progress_portion
-            result[self.OUTPUT_CONEFOR_NODES_FILE_PATH[0]] = node_file_output_path
-            if connections_distance_method == NodeConnectionType.EDGE_DISTANCE:
-                connections_file_output_path = self._generate_connection_file_by_edge_distance(
-                    node_id_field_name,
-                    source,
-                    output_dir,
-                    results_name_fragment,
-                    feedback,
-                    start_progress=(100 - remaining_progress),
-                    progress_step=progress_step,
-                )
-            elif connections_distance_method == NodeConnectionType.CENTROID_DISTANCE:
-                connections_file_output_path = self._generate_connection_file_by_centroid_distance(
-                    node_id_field_name,
-                    source,
-                    output_dir,
-                    results_name_fragment,
-                    feedback,
-                    start_progress=(100 - remaining_progress),
-                    progress_step=progress_step,
-                )
-            else:
-                raise NotImplementedError
-            result[self.OUTPUT_CONEFOR_CONNECTIONS_FILE_PATH[0]] = connections_file_output_path
+            generated_files = self._generate_conefor_files(
+                node_id_field_name,
+                node_attribute_field_name,
+                nodes_to_add_field_name,
+                source,
+                output_dir,
+                filename_fragment=results_name_fragment,
+                connection_files=connection_files,
+                feedback=feedback,
+                area_unit=context.areaUnit(),
+                autogenerated_node_ids=autogenerated_node_ids,
+                layer_sink=layer_sink,
+            )
+            if layer_sink is not None:
+                layer_sink.sink.flushBuffer()
+            self._set_generated_files_results(result, generated_files)
         else:
             feedback.pushInfo("The selected source has no features to process")
         feedback.setProgress(100)
         return result
 
-    def _generate_connection_file_by_edge_distance(
-        self,
-        node_id_field: Optional[str],
-        source: qgis.core.QgsProcessingFeatureSource,
-        output_dir: Path,
-        filename_fragment: str,
-        feedback: qgis.core.QgsProcessingFeedback,
-        start_progress: float,
-        progress_step: float,
-    ) -> Optional[Path]:
-        return (
-            coneforinputsprocessor.generate_connection_file_with_edge_distances(
-                node_id_field_name=node_id_field,
-                crs=source.sourceCrs(),
-                feature_iterator_factory=source.getFeatures,
-                num_features=source.featureCount(),
-                output_path=output_dir / f"distances_edges_{filename_fragment}.txt",
-                progress_callback=feedback.setProgress,
-                start_progress=int(start_progress),
-                progress_step=progress_step,
-                info_callback=feedback.pushInfo,
-                cancelled_callback=feedback.isCanceled,
-            )
-        )
-
-    def _generate_layer_with_node_id(
-            self,
-            parameters,
-            feedback,
-            context
-    ):
-        # check docs on this processing algorithm here:
-        # https://docs.qgis.org/testing/en/docs/user_manual/processing_algs/qgis/vectortable.html#qgisaddautoincrementalfield
-        layer_with_node_id = processing.run(
-            "native:addautoincrementalfield",
-            {
-                "INPUT": parameters[self.INPUT_POLYGON_LAYER[0]],
-                "FIELD_NAME": self._autogenerated_node_id_field_name,
-                "START": 1,
-                "OUTPUT": qgis.core.QgsProcessingOutputLayerDefinition(
-                    "memory:",
-                    qgis.core.QgsProject.instance()
-                )
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True
-        )["OUTPUT"]
-        return layer_with_node_id
-
-    def _generate_layer_with_area_as_node_attribute(
+    def _create_generated_layer_sink(
             self,
             source: qgis.core.QgsProcessingFeatureSource,
-            feedback: qgis.core.QgsProcessingFeedback,
+            add_node_ids: bool,
+            add_node_attributes: bool,
             context: qgis.core.QgsProcessingContext
     ):
-        # check docs on this processing algorithm here:
-        # https://docs.qgis.org/testing/en/docs/user_manual/processing_algs/qgis/vectorgeometry.html#qgisexportaddgeometrycolumns
-        layer_with_geom_properties_added = processing.run(
-            "qgis:exportaddgeometrycolumns",
-            {
-                "INPUT": source.sourceName(),
-                "CALC_METHOD": 2,  # ELLIPSOIDAL
-                "OUTPUT": qgis.core.QgsProcessingOutputLayerDefinition(
-                    "memory:",
-                    qgis.core.QgsProject.instance()
-                )
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True
-        )["OUTPUT"]
-        layer_without_perimeter_attribute = processing.run(
-            "native:deletecolumn",
-            {
-                "INPUT": layer_with_geom_properties_added,
-                "COLUMN": "perimeter",
-                "OUTPUT": qgis.core.QgsProcessingOutputLayerDefinition(
-                    "memory:",
-                    qgis.core.QgsProject.instance()
-                )
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True
-        )["OUTPUT"]
-        layer_with_renamed_area_attribute = processing.run(
-            "native:renametablefield",
-            {
-                "INPUT": layer_without_perimeter_attribute,
-                "FIELD": "area",
-                "NEW_NAME": self._autogenerated_node_attribute_field_name,
-                "OUTPUT": qgis.core.QgsProcessingOutputLayerDefinition(
-                    "memory:",
-                    qgis.core.QgsProject.instance()
-                )
-            },
-            context=context,
-            feedback=feedback,
-            is_child_algorithm=True
-        )["OUTPUT"]
-        return layer_with_renamed_area_attribute
+        """Create a memory layer for copies of the features with their generated attributes.
+
+        The layer is filled while the features are read for the node file, and
+        it is loaded when the algorithm finishes.
+        """
+        from ... import nodestore
+
+        node_id_field_name = self._autogenerated_node_id_field_name if add_node_ids else None
+        node_attribute_field_name = (
+            self._autogenerated_node_attribute_field_name if add_node_attributes else None)
+        fields = nodestore.GeneratedLayerSink.get_fields(
+            source.fields(), node_id_field_name, node_attribute_field_name)
+        sink, layer_id = qgis.core.QgsProcessingUtils.createFeatureSink(
+            "memory:", context, fields, source.wkbType(), source.sourceCrs())
+        context.addLayerToLoadOnCompletion(
+            layer_id,
+            qgis.core.QgsProcessingContext.LayerDetails(
+                f"{source.sourceName()}_conefor_generated",
+                qgis.core.QgsProject.instance(),
+                self.OUTPUT_GENERATED_CONEFOR_LAYER[0],
+            )
+        )
+        layer_sink = nodestore.GeneratedLayerSink(
+            sink=sink,
+            fields=fields,
+            node_id_field_name=node_id_field_name,
+            node_attribute_field_name=node_attribute_field_name,
+        )
+        return layer_sink, layer_id
@@ -0,0 +1,155 @@
+"""Throttled reporting of progress and cancellation for long running generators."""
+
+import time
+from typing import (
+    Callable,
+    Optional,
+)
+
+# minimum time, in seconds, between two progress updates with the same percentage
+_DEFAULT_PROGRESS_INTERVAL = 1.0
+
+# minimum time, in seconds, between two polls of the cancellation callback
+_DEFAULT_CANCELLATION_POLL_INTERVAL = 0.1
+
+# minimum time, in seconds, between two throughput and remaining time messages
+_DEFAULT_THROUGHPUT_REPORT_INTERVAL = 10.0
+
+
+class ProgressReporter:
+    """Coalesce progress updates and cancellation checks of a generator.
+
+    Generators advance the reporter by the number of items (features or pairs
+    of nodes) that they have processed. The progress callback is only called
+    when the integer percentage changes, or when `progress_interval` seconds
+    have passed since the last update. The cancellation callback is polled at
+    most once every `cancellation_poll_interval` seconds, and once it reports
+    cancellation the reporter remembers it.
+
+    When `total_items` is known, the throughput and the estimated remaining time
+    are sent to the info callback every `throughput_report_interval` seconds.
+    """
+
+    progress: float
+    items_done: int
+    total_items: Optional[int]
+    unit: str
+    _progress_callback: Optional[Callable[[int], None]]
+    _cancelled_callback: Optional[Callable[[], bool]]
+    _info_callback: Optional[Callable[[str], None]]
+    _progress_step: float
+    _progress_interval: float
+    _cancellation_poll_interval: float
+    _throughput_report_interval: float
+    _start_time: float
+    _last_emitted_progress: Optional[int]
+    _last_progress_time: float
+    _last_cancellation_poll_time: Optional[float]
+    _last_throughput_report_time: float
+    _cancelled: bool
+
+    def __init__(
+            self,
+            progress_callback: Optional[Callable[[int], None]],
+            cancelled_callback: Optional[Callable[[], bool]] = None,
+            info_callback: Optional[Callable[[str], None]] = None,
+            start_progress: float = 0,
+            progress_step: float = 0,
+            total_items: Optional[int] = None,
+            unit: str = "items",
+            progress_interval: float = _DEFAULT_PROGRESS_INTERVAL,
+            cancellation_poll_interval: float = _DEFAULT_CANCELLATION_POLL_INTERVAL,
+            throughput_report_interval: float = _DEFAULT_THROUGHPUT_REPORT_INTERVAL,
+    ):
+        self.progress = start_progress
+        self.items_done = 0
+        self.total_items = total_items
+        self.unit = unit
+        self._progress_callback = progress_callback
+        self._cancelled_callback = cancelled_callback
+        self._info_callback = info_callback
+        self._progress_step = progress_step
+        self._progress_interval = progress_interval
+        self._cancellation_poll_interval = cancellation_poll_interval
+        self._throughput_report_interval = throughput_report_interval
+        self._start_time = time.monotonic()
+        self._last_emitted_progress = None
+        self._last_progress_time = self._start_time
+        self._last_cancellation_poll_time = None
+        self._last_throughput_report_time = self._start_time
+        self._cancelled = False
+
+    @property
+    def elapsed_time(self) -> float:
+        return time.monotonic() - self._start_time
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """Number of items processed per second."""
+        elapsed = self.elapsed_time
+        return self.items_done / elapsed if elapsed > 0 else None
+
+    @property
+    def remaining_time(self) -> Optional[float]:
+        """Estimated number of seconds until all items are processed."""
+        throughput = self.throughput
+        if self.total_items is None or not throughput:
+            result = None
+        else:
+            result = max(self.total_items - self.items_done, 0) / throughput
+        return result
+
+    def advance(self, num_items: int = 1) -> None:
+        self.items_done += num_items
+        self.progress += self._progress_step * num_items
+        now = time.monotonic()
+        current = int(self.progress)
+        if (
+                self._progress_callback is not None and (
+                    current != self._last_emitted_progress or
+                    now - self._last_progress_time >= self._progress_interval
+                )
+        ):
+            self._progress_callback(current)
+            self._last_emitted_progress = current
+            self._last_progress_time = now
+        if (
+                self._info_callback is not None and
+                self.total_items is not None and
+                now - self._last_throughput_report_time >= self._throughput_report_interval
+        ):
+            self._info_callback(self._get_throughput_message())
+            self._last_throughput_report_time = now
+
+    def is_cancelled(self, force_poll: bool = False) -> bool:
+        """Check whether processing has been cancelled, polling the callback at a bounded rate."""
+        if not self._cancelled and self._cancelled_callback is not None:
+            now = time.monotonic()
+            should_poll = (
+                force_poll or
+                self._last_cancellation_poll_time is None or
+                now - self._last_cancellation_poll_time >= self._cancellation_poll_interval
+            )
+            if should_poll:
+                self._cancelled = bool(self._cancelled_callback())
+                self._last_cancellation_poll_time = now
+        return self._cancelled
+
+    def finish(self) -> None:
+        """Emit the final progress and a summary of the processed items."""
+        if self._progress_callback is not None:
+            self._progress_callback(int(self.progress))
+        if self._info_callback is not None:
+            self._info_callback(
+                f"Processed {self.items_done:,} {self.unit} in {self.elapsed_time:.1f} s")
+
+    def _get_throughput_message(self) -> str:
+        throughput = self.throughput or 0
+        message = (
+            f"Processed {self.items_done:,} of {self.total_items:,} {self.unit} "
+            f"({throughput:,.0f} {self.unit}/s)"
+        )
+        remaining_time = self.remaining_time
+        if remaining_time is not None:
+            message = f"{message} - about {remaining_time:.0f} s remaining"
+        return message
@@ -15,6 +15,8 @@ PROCESSING_TASK_ID_SEPARATOR = "*_*_*_"
 class NodeConnectionType(enum.Enum):
     EDGE_DISTANCE = "edge distance"
     CENTROID_DISTANCE = "centroid distance"
+    EDGE_DISTANCE_NEAREST_NEIGHBOURS = "edge distance (k nearest neighbours)"
+    CENTROID_DISTANCE_NEAREST_NEIGHBOURS = "centroid distance (k nearest neighbours)"
 
 
 class ConeforNodeConnectionType(enum.Enum):
@@ -30,6 +32,18 @@ class ConeforProcessingSetting(enum.Enum):
 class QgisConeforSettingsKey(enum.Enum):
     OUTPUT_DIR = "PythonPlugins/qgisconefor/output_dir"
     USE_SELECTED = "PythonPlugins/qgisconefor/use_selected_features"
+    LOG_VERBOSITY = "PythonPlugins/qgisconefor/log_verbosity"
+    PERSIST_LAYER_ANALYSIS = "PythonPlugins/qgisconefor/persist_layer_analysis"
+    LAZY_STARTUP = "PythonPlugins/qgisconefor/lazy_startup"
+    CENTROID_DISTANCE_WORKERS = "PythonPlugins/qgisconefor/centroid_distance_workers"
+    WRITER_MEMORY_BUDGET = "PythonPlugins/qgisconefor/writer_memory_budget"
+
+
+class LogVerbosity(enum.IntEnum):
+    QUIET = 0  # only warnings
+    NORMAL = 1  # processing stages and summaries
+    VERBOSE = 2  # also a rate limited message per processed item
+    DEBUG = 3  # also internal state, useful when debugging the plugin
 
 
 @dataclasses.dataclass
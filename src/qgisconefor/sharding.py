@@ -0,0 +1,540 @@
+"""Headless generation of Conefor connection files in shards, which may run on different machines.
+
+The upper triangle of the pairs matrix is split into `num_shards` contiguous
+row blocks with similar numbers of pairs. Each shard is computed on its own,
+with only QGIS Python and local files, and produces a partial connection file
+together with a JSON manifest. Once all shards are done, their manifests are
+given to the merge command, which validates them and combines the partial
+files into the final connection file. This file is identical to the one
+generated in a single run with the same parameters.
+
+Usage:
+
+    python -m qgisconefor.sharding shard LAYER OUTPUT_DIR --shard-index I --num-shards N
+    python -m qgisconefor.sharding merge OUTPUT_PATH MANIFEST [MANIFEST ...]
+
+Run with `--help` for the full list of options.
+"""
+
+import argparse
+import dataclasses
+import hashlib
+import json
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Union,
+)
+
+import numpy as np
+import qgis.core
+
+from . import (
+    coneforinputsprocessor,
+    distances,
+    edgedistances,
+    nodeids,
+    nodestore,
+    progress,
+    textfiles,
+)
+from .schemas import NodeConnectionType
+from .utilities import log
+
+MANIFEST_FORMAT_VERSION = 1
+
+_CONNECTION_METHODS = {
+    "centroids": NodeConnectionType.CENTROID_DISTANCE,
+    "edges": NodeConnectionType.EDGE_DISTANCE,
+}
+
+# default ellipsoid, which is also the default of new QGIS projects
+_DEFAULT_ELLIPSOID = "EPSG:7030"
+
+# data provider used for loading layers when none is given
+_DEFAULT_PROVIDER = "ogr"
+
+_DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+class ShardValidationError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class ShardManifest:
+    """Description of a computed shard, written next to its partial connection file.
+
+    `run_parameters` holds everything that must be the same for all the shards
+    of a connection file, including a digest of the input nodes.
+    `partial_file_name` is relative to the manifest's directory and is `None`
+    when the shard has no connections.
+    """
+
+    shard_index: int
+    num_shards: int
+    row_start: int
+    row_end: int
+    num_rows: int
+    run_parameters: dict
+    partial_file_name: Optional[str]
+    partial_file_digest: Optional[str]
+    format_version: int = MANIFEST_FORMAT_VERSION
+
+    def to_json(self) -> str:
+        return json.dumps(dataclasses.asdict(self), indent=2)
+
+    @classmethod
+    def from_json(cls, raw: str) -> "ShardManifest":
+        return cls(**json.loads(raw))
+
+
+def get_shard_boundaries(num_nodes: int, num_shards: int) -> list[int]:
+    """Split the rows of the pairs matrix into `num_shards` blocks with similar numbers of pairs.
+
+    Returns the `num_shards + 1` row boundaries, so that shard `i` covers the
+    rows from `boundaries[i]` up to, but not including, `boundaries[i + 1]`.
+    Shards may be empty when there are fewer rows than shards.
+    """
+    num_pairs = num_nodes * (num_nodes - 1) // 2
+    rows = np.arange(num_nodes, dtype=np.int64)
+    pairs_before_row = rows * (num_nodes - 1) - rows * (rows - 1) // 2
+    targets = [shard_index * num_pairs // num_shards for shard_index in range(1, num_shards)]
+    inner_boundaries = np.searchsorted(pairs_before_row, targets, side="left").tolist()
+    return [0, *inner_boundaries, num_nodes]
+
+
+def count_pairs(num_nodes: int, row_start: int, row_end: int) -> int:
+    """Number of pairs of the upper triangle in the rows from `row_start` up to `row_end`."""
+    num_rows = max(row_end - row_start, 0)
+    return num_rows * (num_nodes - 1) - (row_start + row_end - 1) * num_rows // 2
+
+
+def get_file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open("rb") as fh:
+        for chunk in iter(lambda: fh.read(_DIGEST_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_nodes_digest(node_ids: list, coordinates: Optional[np.ndarray] = None) -> str:
+    """Return a digest of the input nodes, which all shards must share."""
+    digest = hashlib.sha256("\n".join(repr(node_id) for node_id in node_ids).encode("utf-8"))
+    if coordinates is not None:
+        digest.update(np.ascontiguousarray(coordinates, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def get_shard_stem(filename_fragment: str, shard_index: int, num_shards: int) -> str:
+    return f"{filename_fragment}.shard-{shard_index:04d}-of-{num_shards:04d}"
+
+
+def _write_manifest(manifest: ShardManifest, path: Path) -> None:
+    # the manifest is written last, and atomically, so that its presence means
+    # that the shard is complete
+    file_descriptor, partial_path = tempfile.mkstemp(
+        prefix=f".{path.stem}-", suffix=".partial", dir=path.parent)
+    with os.fdopen(file_descriptor, "w", encoding="utf-8") as fh:
+        fh.write(manifest.to_json())
+    os.replace(partial_path, path)
+
+
+def get_layer_name(uri: str, provider: str = _DEFAULT_PROVIDER) -> str:
+    """Return the name of a layer, as used in the names of the generated files.
+
+    This is the name of the file for OGR data sources and the name of the table
+    for other providers.
+    """
+    if provider == "ogr":
+        result = Path(uri.split("|")[0]).stem
+    else:
+        uri_parts = qgis.core.QgsProviderRegistry.instance().decodeUri(provider, uri)
+        result = uri_parts.get("table") or uri_parts.get("layerName") or provider
+    return result
+
+
+def load_layer(uri: str, provider: str = _DEFAULT_PROVIDER) -> qgis.core.QgsVectorLayer:
+    layer = qgis.core.QgsVectorLayer(uri, get_layer_name(uri, provider), provider)
+    if not layer.isValid():
+        raise qgis.core.QgsProcessingException(
+            f"Could not load layer {uri!r} with the {provider!r} provider")
+    return layer
+
+
+def generate_shard(
+        layer: qgis.core.QgsVectorLayer,
+        output_dir: Path,
+        shard_index: int,
+        num_shards: int,
+        spec: coneforinputsprocessor.ConnectionFileSpec,
+        node_id_field_name: Optional[str] = None,
+        ellipsoid: str = _DEFAULT_ELLIPSOID,
+        writer_memory_budget: int = textfiles.DEFAULT_WRITER_MEMORY_BUDGET,
+        info_callback: Callable[[str], None] = log,
+) -> Path:
+    """Compute a shard of a connection file and write its partial file and manifest.
+
+    All features are read, but only the pairs whose row belongs to the shard
+    are measured. The connection method, output file name, maximum distance,
+    decimal places and decay are taken from `spec`. Nearest neighbours are not
+    supported, as a node's neighbours may belong to any shard.
+
+    Returns the path of the manifest. Existing files of the same shard are
+    replaced.
+    """
+    if spec.uses_nearest_neighbours:
+        raise ValueError("Nearest neighbours connection files cannot be sharded")
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(
+            f"Shard index must be between 0 and {num_shards - 1} - got {shard_index!r}")
+    distance_transform = spec.get_distance_transform()
+    qgis.core.QgsProject.instance().setEllipsoid(ellipsoid)
+    crs = layer.crs()
+    autogenerated_node_ids = (
+        nodeids.AutogeneratedNodeIds.from_feature_source(layer)
+        if node_id_field_name is None else None
+    )
+    info_callback(f"Reading {layer.featureCount()} features...")
+    nodes = nodestore.extract_nodes(
+        node_id_field_name,
+        None,
+        None,
+        layer.getFeatures,
+        layer.fields(),
+        autogenerated_node_ids=autogenerated_node_ids,
+        keep_centroids=not spec.uses_edges,
+        keep_geometries=spec.uses_edges,
+    )
+    node_ids = nodes.node_ids
+    if spec.uses_edges:
+        store = nodes.get_geometry_store()
+        nodes_digest = get_nodes_digest(node_ids)
+    else:
+        store = nodes.get_centroid_store()
+        nodes_digest = get_nodes_digest(node_ids, store.coordinates)
+    num_nodes = len(node_ids)
+    boundaries = get_shard_boundaries(num_nodes, num_shards)
+    row_start = boundaries[shard_index]
+    row_end = boundaries[shard_index + 1]
+    stem = get_shard_stem(spec.output_path.stem, shard_index, num_shards)
+    manifest_path = output_dir / f"{stem}.json"
+    tentative_partial_path = output_dir / f"{stem}.txt"
+    for path in (manifest_path, tentative_partial_path):
+        if path.exists():
+            info_callback(f"Replacing existing shard file {str(path)!r}")
+            path.unlink()
+
+    num_pairs = count_pairs(num_nodes, row_start, row_end)
+    info_callback(
+        f"Computing shard {shard_index} of {num_shards}: rows {row_start} to {row_end - 1}, "
+        f"{num_pairs} pairs..."
+    )
+    reporter = progress.ProgressReporter(
+        None, info_callback=info_callback, total_items=num_pairs, unit="pairs")
+    node_ids = np.asarray(node_ids)
+    writer = textfiles.ConeforTextFileWriter(
+        tentative_partial_path,
+        memory_budget=writer_memory_budget,
+        decimal_places=spec.decimal_places
+    )
+    with writer:
+        for block in _iter_shard_blocks(
+                store, crs, spec, row_start, row_end, info_callback):
+            writer.write_buffer(
+                textfiles.ConeforRecordBuffer.from_columns(
+                    node_ids[block.rows],
+                    node_ids[block.cols],
+                    (
+                        distance_transform(block.distances) if distance_transform is not None
+                        else block.distances
+                    )
+                )
+            )
+            reporter.advance(block.num_triangle_pairs(num_nodes))
+        reporter.finish()
+        num_rows = writer.num_rows
+        partial_path = writer.close()
+    manifest = ShardManifest(
+        shard_index=shard_index,
+        num_shards=num_shards,
+        row_start=row_start,
+        row_end=row_end,
+        num_rows=num_rows,
+        run_parameters={
+            "connection_method": spec.connection_method.value,
+            "connection_type": spec.connection_type.value,
+            "max_distance": spec.max_distance,
+            "use_geodesic_kernel": spec.use_geodesic_kernel,
+            "decimal_places": spec.decimal_places,
+            "decay_distance": spec.decay_distance,
+            "decay_probability": spec.decay_probability,
+            "node_id_field": node_id_field_name,
+            "ellipsoid": ellipsoid,
+            "crs": crs.authid() or crs.toWkt(),
+            "num_nodes": num_nodes,
+            "nodes_digest": nodes_digest,
+            "output_name": spec.output_path.name,
+        },
+        partial_file_name=partial_path.name if partial_path is not None else None,
+        partial_file_digest=get_file_digest(partial_path) if partial_path is not None else None,
+    )
+    _write_manifest(manifest, manifest_path)
+    info_callback(f"Wrote {num_rows} connections and manifest {str(manifest_path)!r}")
+    return manifest_path
+
+
+def _iter_shard_blocks(
+        store: Union[distances.CentroidStore, edgedistances.GeometryStore],
+        crs: qgis.core.QgsCoordinateReferenceSystem,
+        spec: coneforinputsprocessor.ConnectionFileSpec,
+        row_start: int,
+        row_end: int,
+        info_callback: Callable[[str], None],
+) -> Iterator[distances.DistanceBlock]:
+    if spec.uses_edges:
+        if crs.isGeographic():
+            projected_crs = edgedistances.get_local_projected_crs(store.extent())
+            info_callback(
+                f"Layer has a geographic CRS - measuring edge distances in "
+                f"{projected_crs.description() or projected_crs.toProj()!r}..."
+            )
+            edgedistances.reproject_geometries(store, crs, projected_crs)
+        measurer = edgedistances.RowBlockMeasurer(store.geometries, spec.max_distance)
+        row_blocks = distances.iter_upper_triangle_row_blocks(
+            len(store), distances.DEFAULT_MAX_PAIRS_PER_MEASURER_BLOCK, row_start, row_end)
+        for block_start, block_end in row_blocks:
+            block, _ = measurer.measure(block_start, block_end)
+            yield block
+    else:
+        engine = distances.CentroidDistanceEngine(
+            store.coordinates,
+            coneforinputsprocessor.get_measurer(crs),
+            use_geodesic_kernel=spec.use_geodesic_kernel
+        )
+        yield from engine.iter_blocks(
+            max_distance=spec.max_distance, start_row=row_start, stop_row=row_end)
+
+
+def load_manifests(manifest_paths: Iterable[Path]) -> list[tuple[Path, ShardManifest]]:
+    result = []
+    for path in manifest_paths:
+        try:
+            manifest = ShardManifest.from_json(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError, TypeError) as err:
+            raise ShardValidationError(f"Could not read manifest {str(path)!r}: {err}")
+        result.append((path, manifest))
+    return result
+
+
+def validate_manifests(
+        manifests: list[tuple[Path, ShardManifest]]
+) -> list[tuple[Path, ShardManifest]]:
+    """Check that the manifests describe all the shards of the same connection file.
+
+    Returns the manifests ordered by their shard index.
+    """
+    if len(manifests) == 0:
+        raise ShardValidationError("No shard manifests were given")
+    _, first = manifests[0]
+    for path, manifest in manifests:
+        if manifest.format_version != MANIFEST_FORMAT_VERSION:
+            raise ShardValidationError(
+                f"Manifest {str(path)!r} has unsupported format version "
+                f"{manifest.format_version!r}"
+            )
+        if (manifest.num_shards, manifest.run_parameters) != (
+                first.num_shards, first.run_parameters):
+            raise ShardValidationError(
+                f"Manifest {str(path)!r} does not belong to the same run as "
+                f"{str(manifests[0][0])!r} - its parameters or input nodes differ"
+            )
+    by_index = {}
+    for path, manifest in manifests:
+        if manifest.shard_index in by_index:
+            raise ShardValidationError(
+                f"Shard {manifest.shard_index} is given twice: "
+                f"{str(by_index[manifest.shard_index][0])!r} and {str(path)!r}"
+            )
+        by_index[manifest.shard_index] = (path, manifest)
+    missing = sorted(set(range(first.num_shards)) - set(by_index))
+    if len(missing) > 0:
+        raise ShardValidationError(
+            f"Missing shards: {', '.join(str(index) for index in missing)}")
+    unexpected = sorted(set(by_index) - set(range(first.num_shards)))
+    if len(unexpected) > 0:
+        raise ShardValidationError(
+            f"Unexpected shards: {', '.join(str(index) for index in unexpected)}")
+    boundaries = get_shard_boundaries(first.run_parameters["num_nodes"], first.num_shards)
+    result = []
+    for shard_index in range(first.num_shards):
+        path, manifest = by_index[shard_index]
+        expected_rows = boundaries[shard_index], boundaries[shard_index + 1]
+        if (manifest.row_start, manifest.row_end) != expected_rows:
+            raise ShardValidationError(
+                f"Shard {shard_index} covers rows {manifest.row_start} to {manifest.row_end}, "
+                f"but rows {expected_rows[0]} to {expected_rows[1]} were expected"
+            )
+        if manifest.partial_file_name is not None:
+            partial_path = path.parent / manifest.partial_file_name
+            if not partial_path.is_file():
+                raise ShardValidationError(
+                    f"Partial file of shard {shard_index} is missing: {str(partial_path)!r}")
+            if get_file_digest(partial_path) != manifest.partial_file_digest:
+                raise ShardValidationError(
+                    f"Partial file of shard {shard_index} does not match its manifest: "
+                    f"{str(partial_path)!r}"
+                )
+        result.append((path, manifest))
+    return result
+
+
+def merge_shards(
+        manifest_paths: Iterable[Path],
+        output_path: Path,
+        info_callback: Callable[[str], None] = log,
+) -> Optional[Path]:
+    """Validate the manifests of all shards and merge their partial files into a connection file.
+
+    Returns the path of the connection file, or `None` if no shard has any
+    connections.
+    """
+    manifests = validate_manifests(load_manifests(manifest_paths))
+    partial_files = [
+        (path.parent / manifest.partial_file_name, manifest.num_rows)
+        for path, manifest in manifests if manifest.partial_file_name is not None
+    ]
+    num_rows = sum(manifest.num_rows for _, manifest in manifests)
+    if len(partial_files) == 0:
+        info_callback("Shards have no connections - did not write any output file")
+        return None
+    info_callback(f"Merging {num_rows} connections from {len(manifests)} shards...")
+    # partial files are sorted runs, which the writer merges in the order of the shards
+    with textfiles.ConeforTextFileWriter(output_path) as writer:
+        for partial_path, partial_num_rows in partial_files:
+            writer.add_sorted_file(partial_path, partial_num_rows)
+        result = writer.close()
+    info_callback(f"Wrote {str(result)!r}")
+    return result
+
+
+def _get_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="python -m qgisconefor.sharding",
+        description="Generate Conefor connection files in shards and merge them.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    shard_parser = subparsers.add_parser(
+        "shard", help="compute one shard of a connection file")
+    shard_parser.add_argument(
+        "layer", help="path or data source URI of the polygon or point layer")
+    shard_parser.add_argument(
+        "output_dir", type=Path, help="directory where the shard files are written")
+    shard_parser.add_argument(
+        "--provider", default=_DEFAULT_PROVIDER,
+        help="QGIS data provider used for loading the layer, such as ogr, postgres or "
+             "spatialite (default: %(default)s)")
+    shard_parser.add_argument(
+        "--shard-index", type=int, required=True, help="index of the shard, starting at 0")
+    shard_parser.add_argument(
+        "--num-shards", type=int, required=True, help="total number of shards")
+    shard_parser.add_argument(
+        "--method", choices=sorted(_CONNECTION_METHODS), default="centroids",
+        help="distances between feature centroids or edges (default: %(default)s)")
+    shard_parser.add_argument(
+        "--node-id-field", help="field with the node identifiers (autogenerated if not set)")
+    shard_parser.add_argument(
+        "--max-distance", type=float,
+        help="only connect pairs of nodes whose distance is not greater than this")
+    shard_parser.add_argument(
+        "--geodesic-kernel", action="store_true",
+        help="compute centroid distances with the batched geodesic kernel (geographic CRS only)")
+    shard_parser.add_argument(
+        "--ellipsoid", default=_DEFAULT_ELLIPSOID,
+        help="ellipsoid used for centroid distances, or NONE for planar distances "
+             "(default: %(default)s)")
+    shard_parser.add_argument(
+        "--decimal-places", type=int, default=-1,
+        help="decimal places of the distances, -1 means full precision (default: %(default)s)")
+    shard_parser.add_argument(
+        "--decay-distance", type=float,
+        help="write direct dispersal probabilities, which equal the decay probability at this "
+             "distance, instead of distances")
+    shard_parser.add_argument(
+        "--decay-probability", type=float, default=0.5,
+        help="direct dispersal probability at the decay distance (default: %(default)s)")
+    shard_parser.add_argument(
+        "--memory-budget", type=int,
+        default=textfiles.DEFAULT_WRITER_MEMORY_BUDGET // (1024 * 1024),
+        help="memory used for sorting the partial file, in MiB (default: %(default)s)")
+
+    merge_parser = subparsers.add_parser(
+        "merge", help="validate all shards and merge them into the final connection file")
+    merge_parser.add_argument("output_path", type=Path, help="path of the connection file")
+    merge_parser.add_argument(
+        "manifests", type=Path, nargs="+", help="manifests of all the shards")
+    return parser
+
+
+def _get_connection_file_spec(
+        args: argparse.Namespace
+) -> coneforinputsprocessor.ConnectionFileSpec:
+    connection_method = _CONNECTION_METHODS[args.method]
+    layer_name = get_layer_name(args.layer, args.provider)
+    if args.decay_distance is not None:
+        output_name = f"probabilities_{args.method}_{layer_name}.txt"
+        decimal_places = None
+    else:
+        output_name = f"distances_{args.method}_{layer_name}.txt"
+        decimal_places = args.decimal_places if args.decimal_places >= 0 else None
+    return coneforinputsprocessor.ConnectionFileSpec(
+        connection_method=connection_method,
+        output_path=args.output_dir / output_name,
+        max_distance=args.max_distance,
+        use_geodesic_kernel=args.geodesic_kernel,
+        decimal_places=decimal_places,
+        decay_distance=args.decay_distance,
+        decay_probability=args.decay_probability if args.decay_distance is not None else None,
+    )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = _get_argument_parser().parse_args(argv)
+    if args.command == "merge":
+        try:
+            merge_shards(args.manifests, args.output_path, info_callback=print)
+        except ShardValidationError as err:
+            print(f"Cannot merge shards: {err}", file=sys.stderr)
+            return 1
+        return 0
+    app = qgis.core.QgsApplication([], False)
+    app.initQgis()
+    try:
+        generate_shard(
+            load_layer(args.layer, args.provider),
+            args.output_dir,
+            args.shard_index,
+            args.num_shards,
+            _get_connection_file_spec(args),
+            node_id_field_name=args.node_id_field,
+            ellipsoid=args.ellipsoid,
+            writer_memory_budget=max(args.memory_budget, 1) * 1024 * 1024,
+            info_callback=print,
+        )
+    except (qgis.core.QgsProcessingException, ValueError) as err:
+        print(f"Cannot generate shard: {err}", file=sys.stderr)
+        return 1
+    finally:
+        app.exitQgis()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
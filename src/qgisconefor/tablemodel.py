@@ -202,6 +202,34 @@ class ProcessLayerTableModel(QtCore.QAbstractTableModel):
             result = True
         return result
 
+    def update_layers(
+            self,
+            analyzed_layers: dict[qgis.core.QgsVectorLayer, Optional[schemas.LayerRelevantFields]],
+    ):
+        """Merge the results of analyzing some layers into the known layers.
+
+        Layers with a result of `None` are no longer usable and their rows are
+        removed.
+        """
+        for layer, relevant_fields in analyzed_layers.items():
+            if relevant_fields is None:
+                self.data_.pop(layer, None)
+            else:
+                self.data_[layer] = relevant_fields
+        self._remove_unknown_layer_rows()
+
+    def remove_layers(self, layer_ids: list[str]):
+        self.data_ = {
+            layer: relevant_fields for layer, relevant_fields in self.data_.items()
+            if layer.id() not in layer_ids
+        }
+        self._remove_unknown_layer_rows()
+
+    def _remove_unknown_layer_rows(self):
+        for row in reversed(range(len(self.layers_to_process))):
+            if self.layers_to_process[row].layer not in self.data_:
+                self.removeRows(row)
+
     def get_field_names(self, layer_name: str) -> schemas.LayerRelevantFields:
         layer = self.get_qgis_layer(layer_name)
         return self.data_[layer]
@@ -1,22 +1,96 @@
+from typing import Optional
+
 import qgis.core
 from qgis.PyQt import QtCore
 
 from . import schemas
 from .utilities import log
-from .coneforinputsprocessor import (
-    validate_node_identifier_attribute,
-    validate_node_attribute,
-    validate_node_to_add_attribute,
-)
+
+
+def analyze_layer(layer: qgis.core.QgsMapLayer) -> Optional[schemas.LayerRelevantFields]:
+    """Find out which fields of a layer can be used as Conefor inputs.
+
+    Returns `None` if the layer cannot be used as an input.
+    """
+    # imported here, rather than at module level, in order to keep the plugin's
+    # startup light
+    from .coneforinputsprocessor import (
+        profile_candidate_fields,
+        validate_node_identifier_attribute,
+        validate_node_attribute,
+        validate_node_to_add_attribute,
+    )
+
+    result = None
+    if layer.type() == qgis.core.QgsMapLayer.LayerType.Vector:
+        layer: qgis.core.QgsVectorLayer
+        if layer.geometryType() == qgis.core.Qgis.GeometryType.Polygon:
+            unique_fields = []
+            numeric_fields = []
+            binary_fields = []
+            profiles = profile_candidate_fields(layer)
+            for field in layer.fields():
+                name = field.name()
+                profile = profiles.get(name)
+                if profile is not None:
+                    if validate_node_identifier_attribute(layer, field, profile):
+                        unique_fields.append(name)
+                    if validate_node_to_add_attribute(layer, field, profile):
+                        binary_fields.append(name)
+                if validate_node_attribute(layer, field):
+                    numeric_fields.append(name)
+            if any(numeric_fields):
+                result = schemas.LayerRelevantFields(
+                    numerical_field_names=numeric_fields,
+                    unique_field_names=unique_fields,
+                    binary_value_field_names=binary_fields
+                )
+    return result
+
+
+class SingleLayerAnalyzerTask(qgis.core.QgsTask):
+    """Collects useful info about a single qGIS layer."""
+
+    layer_analyzed = QtCore.pyqtSignal(str, object)
+
+    layer_id: str
+    layer: qgis.core.QgsMapLayer
+    relevant_fields: Optional[schemas.LayerRelevantFields]
+
+    def __init__(self, layer_id: str, layer: qgis.core.QgsMapLayer):
+        super().__init__(f"analyze layer {layer.name()!r}")
+        self.layer_id = layer_id
+        self.layer = layer
+        self.relevant_fields = None
+
+    def run(self):
+        if not self.isCanceled():
+            log(f"Analyzing layer {self.layer.name()!r}...")
+            self.relevant_fields = analyze_layer(self.layer)
+        self.setProgress(100)
+        return not self.isCanceled()
+
+    def finished(self, result):
+        if result:
+            self.layer_analyzed.emit(self.layer_id, self.relevant_fields)
 
 
 class LayerAnalyzerTask(qgis.core.QgsTask):
-    """Collects useful info about input qGIS layers."""
+    """Collects useful info about input qGIS layers.
+
+    Each layer is analyzed by its own subtask, which allows QGIS to analyze
+    several layers in parallel. The result of each layer is emitted as soon as
+    its subtask finishes and, when all are done, the results of all analyzed
+    layers are emitted together, keyed by their id. Layers which cannot be used
+    as inputs have a result of `None`.
+    """
 
+    layer_analyzed = QtCore.pyqtSignal(str, object)
     layers_analyzed = QtCore.pyqtSignal(dict)
 
     layers_to_analyze: dict[str, qgis.core.QgsMapLayer]
-    relevant_layers: dict[qgis.core.QgsVectorLayer, schemas.LayerRelevantFields]
+    relevant_layers: dict[str, Optional[schemas.LayerRelevantFields]]
+    _subtasks: list[SingleLayerAnalyzerTask]
 
     def __init__(
             self,
@@ -26,38 +100,34 @@ class LayerAnalyzerTask(qgis.core.QgsTask):
         super().__init__(description)
         self.layers_to_analyze = layers_to_analyze
         self.relevant_layers = {}
+        # references to the subtasks are kept so that Python does not garbage
+        # collect them while they are owned by the task manager
+        self._subtasks = []
+        for layer_id, layer in layers_to_analyze.items():
+            subtask = SingleLayerAnalyzerTask(layer_id, layer)
+            subtask.layer_analyzed.connect(self._handle_layer_analyzed)
+            self._subtasks.append(subtask)
+            self.addSubTask(
+                subtask,
+                subTaskDependency=qgis.core.QgsTask.SubTaskDependency.ParentDependsOnSubTask
+            )
+
+    @property
+    def pending_layer_ids(self) -> list[str]:
+        return [id_ for id_ in self.layers_to_analyze if id_ not in self.relevant_layers]
 
     def run(self):
-        if len(self.layers_to_analyze) > 0:
-            progress_step = 100 / len(self.layers_to_analyze)
-            for index, layer_id in enumerate(self.layers_to_analyze.keys()):
-                layer = self.layers_to_analyze[layer_id]
-                log(f"Analyzing layer {layer.name()!r}...")
-                if layer.type() == qgis.core.QgsMapLayer.LayerType.Vector:
-                    layer: qgis.core.QgsVectorLayer
-                    if layer.geometryType() == qgis.core.Qgis.GeometryType.Polygon:
-                        unique_fields = []
-                        numeric_fields = []
-                        binary_fields = []
-                        for field_index, field in enumerate(layer.fields()):
-                            name = field.name()
-                            if validate_node_identifier_attribute(layer, field):
-                                unique_fields.append(name)
-                            if validate_node_attribute(layer, field):
-                                numeric_fields.append(name)
-                            if validate_node_to_add_attribute(layer, field):
-                                binary_fields.append(name)
-                        if any(numeric_fields):
-                            self.relevant_layers[layer] = schemas.LayerRelevantFields(
-                                numerical_field_names=numeric_fields,
-                                unique_field_names=unique_fields,
-                                binary_value_field_names=binary_fields
-                            )
-                percent_done = progress_step + index * progress_step
-                self.setProgress(percent_done)
-        else:
-            self.setProgress(100)
+        # all subtasks have already finished by the time the parent task runs
+        self.setProgress(100)
         return True
 
     def finished(self, result):
         self.layers_analyzed.emit(self.relevant_layers)
+
+    def _handle_layer_analyzed(
+            self,
+            layer_id: str,
+            relevant_fields: Optional[schemas.LayerRelevantFields]
+    ):
+        self.relevant_layers[layer_id] = relevant_fields
+        self.layer_analyzed.emit(layer_id, relevant_fields)
@@ -0,0 +1,401 @@
+"""Writing of Conefor node and connection text files."""
+
+import array
+import heapq
+import itertools
+import os
+import tempfile
+from pathlib import Path
+from typing import (
+    Callable,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    TextIO,
+    Union,
+)
+
+import numpy as np
+
+# typecodes of the arrays that store integer and floating point columns
+_INTEGER_TYPECODE = "q"
+_FLOAT_TYPECODE = "d"
+
+# rows are formatted in chunks of this size, each with a single `%` operation
+_FORMAT_CHUNK_ROWS = 65_536
+
+# size of the buffer of file handles, which keeps the number of writes low
+_FILE_BUFFER_SIZE = 1024 * 1024
+
+# maximum number of sorted runs that are merged at once, which keeps the number
+# of simultaneously open files well below the limits of the operating system
+_MAX_MERGE_FAN_IN = 64
+
+DEFAULT_WRITER_MEMORY_BUDGET = 256 * 1024 * 1024
+
+
+def get_output_path(tentative_path: Path) -> Path:
+    """
+    Rename the output name if it is already present in the directory.
+    """
+
+    index = 1
+    while True:
+        if index == 1:
+            to_check = tentative_path
+        else:
+            original_file_name = tentative_path.stem
+            suffix = tentative_path.suffix
+            new_name = f"{original_file_name}_{index}{suffix}"
+            to_check = tentative_path.parent / new_name
+        if not to_check.exists():
+            return to_check
+        else:
+            index += 1
+
+
+class ConeforRecordBuffer:
+    """Rows of a Conefor node or connection file, stored column by column in typed arrays.
+
+    Each value takes eight bytes, instead of the hundred or so bytes taken by a
+    tuple of Python numbers. Columns start out as integer columns and switch to
+    floating point as soon as they get a non integer value.
+    """
+
+    columns: list[array.array]
+
+    def __init__(self, num_columns: int):
+        self.columns = [array.array(_INTEGER_TYPECODE) for _ in range(num_columns)]
+
+    @classmethod
+    def from_columns(cls, *columns: Sequence) -> "ConeforRecordBuffer":
+        result = cls(len(columns))
+        result.extend_columns(*columns)
+        return result
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.itemsize * len(column) for column in self.columns)
+
+    def append(self, row: tuple) -> None:
+        for index, value in enumerate(row):
+            self.append_value(index, value)
+
+    def extend(self, rows: Iterable[tuple]) -> None:
+        for row in rows:
+            self.append(row)
+
+    def extend_columns(self, *columns: Sequence) -> None:
+        """Append whole columns of values at once, typically NumPy arrays."""
+        for index, values in enumerate(columns):
+            values = np.asarray(values)
+            if values.dtype.kind in "iub":
+                if self.columns[index].typecode == _INTEGER_TYPECODE:
+                    values = values.astype(np.int64, copy=False)
+                else:
+                    values = values.astype(np.float64)
+            elif values.dtype.kind == "f":
+                self._convert_to_float(index)
+                values = values.astype(np.float64, copy=False)
+            else:
+                for value in values.tolist():
+                    self.append_value(index, value)
+                continue
+            self.columns[index].frombytes(np.ascontiguousarray(values).tobytes())
+
+    def append_value(self, index: int, value) -> None:
+        column = self.columns[index]
+        if column.typecode == _INTEGER_TYPECODE and not isinstance(value, (int, np.integer)):
+            column = self._convert_to_float(index)
+        column.append(value)
+
+    def get_column(self, index: int) -> np.ndarray:
+        """Return a NumPy view of a column, which is only valid until the buffer changes."""
+        column = self.columns[index]
+        dtype = np.int64 if column.typecode == _INTEGER_TYPECODE else np.float64
+        return np.frombuffer(column, dtype=dtype) if len(column) > 0 else np.empty(0, dtype)
+
+    def sort_by_first_column(self) -> None:
+        """Sort the rows by their first column, keeping the order of rows with equal keys."""
+        order = np.argsort(self.get_column(0), kind="stable")
+        self.columns = [
+            array.array(column.typecode, self.get_column(index)[order].tobytes())
+            for index, column in enumerate(self.columns)
+        ]
+
+    def clear(self) -> None:
+        self.columns = [array.array(_INTEGER_TYPECODE) for _ in self.columns]
+
+    def format_lines(
+            self,
+            start: int = 0,
+            stop: Optional[int] = None,
+            decimal_places: Optional[int] = None,
+    ) -> Iterator[str]:
+        """Yield the rows as tab separated text, in chunks of many lines at once.
+
+        Floating point columns are written with `decimal_places` decimals, or
+        with as many as needed to represent them exactly when it is `None`.
+        """
+        value_formats = []
+        for column in self.columns:
+            if column.typecode == _INTEGER_TYPECODE:
+                value_formats.append("%d")
+            elif decimal_places is None:
+                value_formats.append("%r")
+            else:
+                value_formats.append(f"%.{decimal_places}f")
+        line_format = "\t".join(value_formats) + "\n"
+        stop = len(self) if stop is None else stop
+        for chunk_start in range(start, stop, _FORMAT_CHUNK_ROWS):
+            chunk_stop = min(chunk_start + _FORMAT_CHUNK_ROWS, stop)
+            values = tuple(
+                itertools.chain.from_iterable(
+                    zip(*(column[chunk_start:chunk_stop].tolist() for column in self.columns))
+                )
+            )
+            yield (line_format * (chunk_stop - chunk_start)) % values
+
+    def _convert_to_float(self, index: int) -> array.array:
+        column = self.columns[index]
+        if column.typecode != _FLOAT_TYPECODE:
+            column = array.array(_FLOAT_TYPECODE, column)
+            self.columns[index] = column
+        return column
+
+
+def _get_integer_line_key(line: str) -> int:
+    return int(line.split("\t", 1)[0])
+
+
+def _get_float_line_key(line: str) -> float:
+    return float(line.split("\t", 1)[0])
+
+
+def _iter_lines(path: Path, encoding: Optional[str]) -> Iterator[str]:
+    """Yield the lines of a file, skipping the blank line that ends Conefor files."""
+    with path.open(encoding=encoding, buffering=_FILE_BUFFER_SIZE) as fh:
+        for line in fh:
+            if line != "\n":
+                yield line
+
+
+def _merge_files(
+        run_paths: list[Path],
+        output_path: Path,
+        encoding: Optional[str],
+        key: Callable[[str], Union[int, float]],
+) -> None:
+    runs = [_iter_lines(path, encoding) for path in run_paths]
+    # heapq.merge() favours earlier runs on ties
+    merged = heapq.merge(*runs, key=key)
+    with output_path.open(encoding=encoding, mode="w", buffering=_FILE_BUFFER_SIZE) as fh:
+        fh.writelines(merged)
+
+
+class ConeforTextFileWriter:
+    """Write Conefor text files, sorted by their first column, with bounded memory.
+
+    Rows are streamed straight to disk for as long as they arrive already sorted
+    by their first column, which is the usual case. As soon as a row arrives out
+    of order, the rows that follow are kept in a `ConeforRecordBuffer`. Whenever
+    the buffer grows past `memory_budget` bytes it is sorted and spilled to a
+    temporary file next to the output. When closing, the streamed rows and all sorted runs are merged into the
+    output file. The result is the same as a stable sort of all rows by their
+    first column.
+
+    Files that are already sorted, such as the partial files of shards, can be
+    added as runs with `add_sorted_file()`. They are merged in the same way,
+    without being modified.
+
+    Floating point values are written with `decimal_places` decimals, or with
+    full precision when it is `None`.
+
+    The output is written to a temporary file next to the final output path and
+    only renamed when closing, so that cancelled runs do not leave partial files
+    behind.
+    """
+
+    num_rows: int
+    _tentative_output_path: Path
+    _encoding: Optional[str]
+    _decimal_places: Optional[int]
+    _memory_budget: int
+    _partial_path: Path
+    _partial_handle: TextIO
+    _last_key: Optional[float]
+    _integer_keys: bool
+    _is_sorted: bool
+    _buffer: Optional[ConeforRecordBuffer]
+    _run_paths: list[Path]
+    _external_run_paths: set[Path]
+
+    def __init__(
+            self,
+            tentative_output_path: Path,
+            memory_budget: int = DEFAULT_WRITER_MEMORY_BUDGET,
+            encoding: Optional[str] = "utf-8",
+            decimal_places: Optional[int] = None,
+    ):
+        self.num_rows = 0
+        self._tentative_output_path = tentative_output_path
+        self._encoding = encoding
+        self._decimal_places = decimal_places
+        self._memory_budget = memory_budget
+        self._last_key = None
+        self._integer_keys = True
+        self._is_sorted = True
+        self._buffer = None
+        self._run_paths = []
+        self._external_run_paths = set()
+        tentative_output_path.parent.mkdir(parents=True, exist_ok=True)
+        file_descriptor, partial_path = tempfile.mkstemp(
+            prefix=f".{tentative_output_path.stem}-",
+            suffix=".partial",
+            dir=tentative_output_path.parent
+        )
+        os.close(file_descriptor)
+        self._partial_path = Path(partial_path)
+        self._partial_handle = self._partial_path.open(
+            encoding=encoding, mode="w", buffering=_FILE_BUFFER_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.discard()
+        return False
+
+    def write_rows(self, rows: Iterable[tuple]) -> None:
+        buffer = None
+        for row in rows:
+            if buffer is None:
+                buffer = ConeforRecordBuffer(len(row))
+            buffer.append(row)
+        if buffer is not None:
+            self.write_buffer(buffer)
+
+    def write_buffer(self, buffer: ConeforRecordBuffer) -> None:
+        num_rows = len(buffer)
+        if num_rows == 0:
+            return
+        self.num_rows += num_rows
+        if buffer.columns[0].typecode != _INTEGER_TYPECODE:
+            self._integer_keys = False
+        start = 0
+        if self._is_sorted:
+            keys = buffer.get_column(0)
+            if self._last_key is not None and keys[0] < self._last_key:
+                num_sorted = 0
+            else:
+                descending = np.flatnonzero(np.diff(keys) < 0)
+                num_sorted = descending[0] + 1 if len(descending) > 0 else num_rows
+            if num_sorted > 0:
+                self._partial_handle.writelines(
+                    buffer.format_lines(stop=num_sorted, decimal_places=self._decimal_places))
+                self._last_key = keys[num_sorted - 1].item()
+            self._is_sorted = num_sorted == num_rows
+            start = num_sorted
+        if start < num_rows:
+            if self._buffer is None:
+                self._buffer = ConeforRecordBuffer(len(buffer.columns))
+            self._buffer.extend_columns(
+                *(buffer.get_column(index)[start:] for index in range(len(buffer.columns))))
+            if self._buffer.nbytes >= self._memory_budget:
+                self._spill_buffer()
+
+    def add_sorted_file(self, path: Path, num_rows: int, integer_keys: bool = True) -> None:
+        """Add a file that is already sorted by its first column as a run to be merged.
+
+        Its `num_rows` rows come after all rows written so far, and before any
+        rows written later. The file must have been written with the same
+        encoding, and its first column holds integers when `integer_keys` is
+        set. It is read when closing the writer, and never modified.
+        """
+        if num_rows == 0:
+            return
+        self.num_rows += num_rows
+        if not integer_keys:
+            self._integer_keys = False
+        if self._buffer is not None and len(self._buffer) > 0:
+            self._spill_buffer()
+        self._run_paths.append(path)
+        self._external_run_paths.add(path)
+        # later rows must be merged after the rows of this file
+        self._is_sorted = False
+
+    def close(self) -> Optional[Path]:
+        """Finish writing the file and return its path, or `None` if no rows were written."""
+        self._partial_handle.close()
+        if self.num_rows == 0:
+            self.discard()
+            return None
+        if not self._is_sorted:
+            self._merge_runs()
+        with self._partial_path.open(encoding=self._encoding, mode="a") as fh:
+            # Conefor manual states that files should terminate with a blank line
+            fh.write("\n")
+        output_path = get_output_path(self._tentative_output_path)
+        os.replace(self._partial_path, output_path)
+        return output_path
+
+    def discard(self) -> None:
+        """Stop writing and remove all files created so far."""
+        self._partial_handle.close()
+        self._buffer = None
+        for path in (self._partial_path, *self._run_paths):
+            if path not in self._external_run_paths:
+                path.unlink(missing_ok=True)
+        self._run_paths = []
+
+    def _spill_buffer(self) -> None:
+        run_path = self._create_run_path()
+        self._buffer.sort_by_first_column()
+        with run_path.open(encoding=self._encoding, mode="w", buffering=_FILE_BUFFER_SIZE) as fh:
+            fh.writelines(self._buffer.format_lines(decimal_places=self._decimal_places))
+        self._buffer.clear()
+
+    def _create_run_path(self) -> Path:
+        # runs are kept next to the output, whose file system has room for it,
+        # rather than in the system's temporary directory
+        file_descriptor, run_path = tempfile.mkstemp(
+            prefix=f".{self._tentative_output_path.stem}-",
+            suffix=".run",
+            dir=self._tentative_output_path.parent
+        )
+        os.close(file_descriptor)
+        self._run_paths.append(Path(run_path))
+        return self._run_paths[-1]
+
+    def _merge_runs(self) -> None:
+        streamed_path = self._partial_path.with_suffix(".streamed")
+        os.replace(self._partial_path, streamed_path)
+        if self._buffer is not None and len(self._buffer) > 0:
+            self._spill_buffer()
+        # runs are only ever merged with their neighbours, in the order they were
+        # created, which keeps the merge stable
+        self._run_paths.insert(0, streamed_path)
+        run_paths = list(self._run_paths)
+        while len(run_paths) > _MAX_MERGE_FAN_IN:
+            merged_run_paths = []
+            for start in range(0, len(run_paths), _MAX_MERGE_FAN_IN):
+                group = run_paths[start:start + _MAX_MERGE_FAN_IN]
+                merged_path = self._create_run_path()
+                self._merge_files(group, merged_path)
+                merged_run_paths.append(merged_path)
+            run_paths = merged_run_paths
+        self._merge_files(run_paths, self._partial_path)
+
+    def _merge_files(self, run_paths: list[Path], output_path: Path) -> None:
+        # integer keys are parsed as such, so that large node ids compare exactly
+        key = _get_integer_line_key if self._integer_keys else _get_float_line_key
+        _merge_files(run_paths, output_path, self._encoding, key=key)
+        for path in run_paths:
+            if path not in self._external_run_paths:
+                path.unlink(missing_ok=True)
+        self._run_paths = [path for path in self._run_paths if path not in run_paths]
@@ -1,15 +1,159 @@
 import shutil
+import time
 from pathlib import Path
+from typing import (
+    Callable,
+    Optional,
+)
 
 import qgis.core
 import qgis.utils
 
-from .schemas import QgisConeforSettingsKey
+from .schemas import (
+    LogVerbosity,
+    QgisConeforSettingsKey,
+)
 
+# minimum time, in seconds, between two messages about similar items
+_RATE_LIMIT_INTERVAL = 1.0
 
-def log(message, level=qgis.core.Qgis.Info):
-    """Helper function to facilitate using QGIS' logging system."""
-    qgis.utils.QgsMessageLog.logMessage(message, "qgisconefor", level=level)
+# verbosity configured in the plugin settings, which is read once and then
+# cached until `refresh_log_verbosity()` is called
+_log_verbosity: Optional[LogVerbosity] = None
+
+
+def log(message, level=qgis.core.Qgis.Info, verbosity=LogVerbosity.NORMAL):
+    """Helper function to facilitate using QGIS' logging system.
+
+    Informative messages are dropped when their `verbosity` is higher than the
+    one configured in the plugin settings.
+    """
+    if level != qgis.core.Qgis.Info or is_log_enabled(verbosity):
+        qgis.utils.QgsMessageLog.logMessage(message, "qgisconefor", level=level)
+
+
+def is_log_enabled(verbosity: LogVerbosity) -> bool:
+    """Whether informative messages of `verbosity` are logged.
+
+    This allows skipping building messages that would be dropped anyway.
+    """
+    return verbosity <= get_log_verbosity()
+
+
+def get_log_verbosity() -> LogVerbosity:
+    global _log_verbosity
+    if _log_verbosity is None:
+        raw_verbosity = load_settings_key(
+            QgisConeforSettingsKey.LOG_VERBOSITY, default_to=LogVerbosity.NORMAL.value)
+        try:
+            _log_verbosity = LogVerbosity(int(raw_verbosity))
+        except (TypeError, ValueError):
+            _log_verbosity = LogVerbosity.NORMAL
+    return _log_verbosity
+
+
+def refresh_log_verbosity() -> LogVerbosity:
+    """Read the verbosity from the plugin settings again, picking up any changes.
+
+    This is called whenever a new run starts.
+    """
+    global _log_verbosity
+    _log_verbosity = None
+    return get_log_verbosity()
+
+
+class RateLimitedLogger:
+    """Leveled logger for the generators, which rate limits messages about similar items.
+
+    Messages sharing the same `key` are emitted at most once every
+    `min_interval` seconds. The others are counted and summarized when calling
+    `flush()`. Callers in hot loops use `should_emit()` in order to avoid
+    building messages that would not be emitted. Items that only deserve a
+    single summary message, whatever their number, are counted with `count()`.
+    """
+
+    verbosity: LogVerbosity
+    min_interval: float
+    _info_callback: Optional[Callable[[str], None]]
+    _last_emitted: dict[str, float]
+    _suppressed: dict[str, int]
+    _counts: dict[str, int]
+
+    def __init__(
+            self,
+            info_callback: Optional[Callable[[str], None]] = None,
+            verbosity: Optional[LogVerbosity] = None,
+            min_interval: float = _RATE_LIMIT_INTERVAL,
+    ):
+        self.verbosity = verbosity if verbosity is not None else get_log_verbosity()
+        self.min_interval = min_interval
+        self._info_callback = info_callback
+        self._last_emitted = {}
+        self._suppressed = {}
+        self._counts = {}
+
+    def info(
+            self,
+            message: str,
+            verbosity: LogVerbosity = LogVerbosity.NORMAL,
+            key: Optional[str] = None,
+    ) -> None:
+        if verbosity <= self.verbosity and self._should_emit(key):
+            if self._info_callback is not None:
+                self._info_callback(message)
+            else:
+                qgis.utils.QgsMessageLog.logMessage(message, "qgisconefor")
+
+    def should_emit(
+            self,
+            verbosity: LogVerbosity = LogVerbosity.NORMAL,
+            key: Optional[str] = None,
+    ) -> bool:
+        """Whether an informative message would be emitted now.
+
+        Messages that are rate limited are counted as suppressed, so a message
+        should be passed to `info()` only when this returns `True`.
+        """
+        if verbosity > self.verbosity:
+            return False
+        if key is None:
+            return True
+        last_emitted = self._last_emitted.get(key)
+        if last_emitted is not None and time.monotonic() - last_emitted < self.min_interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return False
+        return True
+
+    def warning(self, message: str, key: Optional[str] = None) -> None:
+        if self._should_emit(key):
+            log(message, level=qgis.core.Qgis.Warning)
+
+    def count(self, summary: str) -> None:
+        """Count an item, which `flush()` reports as part of a `"{count} {summary}"` message."""
+        self._counts[summary] = self._counts.get(summary, 0) + 1
+
+    def flush(self) -> None:
+        """Summarize the counted items and the messages that have been suppressed so far."""
+        for summary, num_items in self._counts.items():
+            self.info(f"{num_items:,} {summary}")
+        for key, num_suppressed in self._suppressed.items():
+            self.info(f"{num_suppressed:,} more messages about {key} were not shown")
+        self._counts = {}
+        self._suppressed = {}
+
+    def _should_emit(self, key: Optional[str]) -> bool:
+        if key is None:
+            result = True
+        else:
+            now = time.monotonic()
+            last_emitted = self._last_emitted.get(key)
+            if last_emitted is not None and now - last_emitted < self.min_interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                result = False
+            else:
+                self._last_emitted[key] = now
+                result = True
+        return result
 
 
 def extract_contents(path):
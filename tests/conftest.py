@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="session")
+def qgis_application():
+    """A headless QGIS application, for tests that need data providers or CRSs."""
+    qgis_core = pytest.importorskip("qgis.core")
+    application = qgis_core.QgsApplication([], False)
+    application.initQgis()
+    yield application
+    application.exitQgis()
+
+
+@pytest.fixture()
+def planar_measurer(qgis_application, monkeypatch):
+    """Make the generators of connection files measure planar distances."""
+    import qgis.core
+    from qgisconefor import coneforinputsprocessor
+
+    measurer = qgis.core.QgsDistanceArea()
+    measurer.setEllipsoid("NONE")
+    monkeypatch.setattr(coneforinputsprocessor, "get_measurer", lambda crs: measurer)
+    return measurer
+
+
+def _create_memory_layer(geometry_type: str, geometries: list):
+    import qgis.core
+
+    layer = qgis.core.QgsVectorLayer(
+        f"{geometry_type}?crs=EPSG:3857&field=node_id:integer", "nodes", "memory")
+    node_ids = np.random.default_rng(11).permutation(len(geometries)) + 1
+    features = []
+    for node_id, geometry in zip(node_ids.tolist(), geometries):
+        feature = qgis.core.QgsFeature(layer.fields())
+        feature.setGeometry(geometry)
+        feature.setAttributes([node_id])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+@pytest.fixture()
+def point_layer(qgis_application):
+    """A layer with 200 randomly placed points, whose node ids are shuffled."""
+    import qgis.core
+
+    coordinates = np.random.default_rng(13).random((200, 2)) * 10_000
+    return _create_memory_layer(
+        "Point",
+        [
+            qgis.core.QgsGeometry.fromPointXY(qgis.core.QgsPointXY(x, y))
+            for x, y in coordinates.tolist()
+        ]
+    )
+
+
+@pytest.fixture()
+def polygon_layer(qgis_application):
+    """A layer with 60 randomly placed squares, whose node ids are shuffled."""
+    import qgis.core
+
+    corners = np.random.default_rng(17).random((60, 2)) * 10_000
+    return _create_memory_layer(
+        "Polygon",
+        [
+            qgis.core.QgsGeometry.fromRect(qgis.core.QgsRectangle(x, y, x + 150, y + 150))
+            for x, y in corners.tolist()
+        ]
+    )
+
+
+@pytest.fixture()
+def geopackage_point_layer(tmp_path, point_layer):
+    """The features of `point_layer`, saved to a GeoPackage."""
+    import qgis.core
+
+    path = tmp_path / "nodes.gpkg"
+    options = qgis.core.QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = "GPKG"
+    options.layerName = "nodes"
+    error, *_ = qgis.core.QgsVectorFileWriter.writeAsVectorFormatV3(
+        point_layer, str(path), qgis.core.QgsProject.instance().transformContext(), options)
+    assert error == qgis.core.QgsVectorFileWriter.NoError
+    layer = qgis.core.QgsVectorLayer(f"{path}|layername=nodes", "nodes", "ogr")
+    assert layer.isValid()
+    return layer
+
+
+@pytest.fixture()
+def aggregate_pushdown_results(monkeypatch):
+    """Record the results of each attempt to profile fields in the data source."""
+    from qgisconefor import coneforinputsprocessor
+
+    results = []
+    profile_fields_with_aggregates = coneforinputsprocessor._profile_fields_with_aggregates
+
+    def record_result(*args, **kwargs):
+        results.append(profile_fields_with_aggregates(*args, **kwargs))
+        return results[-1]
+
+    monkeypatch.setattr(
+        coneforinputsprocessor, "_profile_fields_with_aggregates", record_result)
+    return results
@@ -0,0 +1,111 @@
+import pytest
+
+pytest.importorskip("qgis.core")
+# the Processing plugin of QGIS must also be importable
+pytest.importorskip("qgis.processing")
+
+from qgisconefor.processing.algorithms import coneforinputs  # noqa: E402
+from qgisconefor.schemas import NodeConnectionType  # noqa: E402
+
+
+def test_probability_files_have_their_own_decimal_places(qgis_application, tmp_path):
+    specs = coneforinputs.ConeforInputsPolygon()._get_connection_file_specs(
+        [NodeConnectionType.EDGE_DISTANCE, NodeConnectionType.CENTROID_DISTANCE],
+        tmp_path,
+        "nodes",
+        decimal_places=2,
+        decay_distance=1000.0,
+        decay_probability=0.5,
+        probability_decimal_places=6,
+    )
+    assert [(spec.output_path.name, spec.decimal_places) for spec in specs] == [
+        ("distances_edges_nodes.txt", 2),
+        ("probabilities_edges_nodes.txt", 6),
+        ("distances_centroids_nodes.txt", 2),
+        ("probabilities_centroids_nodes.txt", 6),
+    ]
+
+
+def test_node_fields_of_a_geopackage_are_profiled_in_the_data_source(
+        geopackage_point_layer, aggregate_pushdown_results):
+    import qgis.core
+
+    algorithm = coneforinputs.ConeforInputsPoint()
+    parameters = {algorithm.INPUT_POINT_LAYER[0]: geopackage_point_layer.source()}
+    context = qgis.core.QgsProcessingContext()
+    source = algorithm.parameterAsSource(parameters, algorithm.INPUT_POINT_LAYER[0], context)
+    layer = algorithm._get_profiled_layer(parameters, algorithm.INPUT_POINT_LAYER[0], context)
+    algorithm._validate_node_attributes(
+        source, node_id_field="node_id", nodes_to_add_field=None, layer=layer)
+    assert len(aggregate_pushdown_results) == 1
+    assert aggregate_pushdown_results[0] is not None
+
+
+def test_selected_features_are_not_profiled_as_a_layer(qgis_application, point_layer):
+    import qgis.core
+
+    qgis.core.QgsProject.instance().addMapLayer(point_layer)
+    try:
+        algorithm = coneforinputs.ConeforInputsPoint()
+        parameters = {
+            algorithm.INPUT_POINT_LAYER[0]: qgis.core.QgsProcessingFeatureSourceDefinition(
+                point_layer.id(), selectedFeaturesOnly=True)
+        }
+        context = qgis.core.QgsProcessingContext()
+        context.setProject(qgis.core.QgsProject.instance())
+        assert algorithm._get_profiled_layer(
+            parameters, algorithm.INPUT_POINT_LAYER[0], context) is None
+        parameters[algorithm.INPUT_POINT_LAYER[0]] = point_layer.id()
+        assert algorithm._get_profiled_layer(
+            parameters, algorithm.INPUT_POINT_LAYER[0], context) is point_layer
+    finally:
+        qgis.core.QgsProject.instance().removeMapLayer(point_layer.id())
+
+
+def test_generated_layer_is_filled_while_reading_the_nodes(
+        tmp_path, polygon_layer, planar_measurer):
+    import qgis.core
+    from qgisconefor import (
+        coneforinputsprocessor,
+        nodeids,
+    )
+
+    algorithm = coneforinputs.ConeforInputsPolygon()
+    context = qgis.core.QgsProcessingContext()
+    source = qgis.core.QgsProcessingFeatureSource(polygon_layer, context)
+    layer_sink, layer_id = algorithm._create_generated_layer_sink(
+        source, add_node_ids=True, add_node_attributes=True, context=context)
+    generated_files = coneforinputsprocessor.generate_conefor_files(
+        node_id_field_name=None,
+        node_attribute_field_name=None,
+        nodes_to_add_field_name=None,
+        crs=polygon_layer.crs(),
+        feature_iterator_factory=polygon_layer.getFeatures,
+        fields=polygon_layer.fields(),
+        num_features=polygon_layer.featureCount(),
+        nodes_output_path=tmp_path / "nodes.txt",
+        connection_files=[],
+        progress_callback=None,
+        info_callback=lambda message: None,
+        area_calculator=coneforinputsprocessor.get_area_calculator(polygon_layer.crs()),
+        autogenerated_node_ids=nodeids.AutogeneratedNodeIds.from_feature_source(source),
+        layer_sink=layer_sink,
+    )
+    layer_sink.sink.flushBuffer()
+    generated_layer = context.temporaryLayerStore().mapLayer(layer_id)
+    assert generated_layer.fields().names() == [
+        "node_id", algorithm._autogenerated_node_id_field_name,
+        algorithm._autogenerated_node_attribute_field_name,
+    ]
+    rows = {
+        feat.attributes()[1]: (feat.attributes()[2], feat.geometry().asWkt())
+        for feat in generated_layer.getFeatures()
+    }
+    # autogenerated node ids follow the order of feature ids
+    originals = sorted(polygon_layer.getFeatures(), key=lambda feat: feat.id())
+    assert {node_id: geometry for node_id, (_, geometry) in rows.items()} == {
+        node_id: feat.geometry().asWkt() for node_id, feat in enumerate(originals, start=1)}
+    lines = generated_files.nodes_path.read_text(encoding="utf-8").splitlines()[:-1]
+    node_areas = {int(node_id): float(area) for node_id, area in map(str.split, lines)}
+    assert node_areas == pytest.approx({node_id: area for node_id, (area, _) in rows.items()})
+    assert list(node_areas.values()) == pytest.approx([150 * 150] * len(originals))
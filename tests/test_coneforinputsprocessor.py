@@ -0,0 +1,395 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("qgis.core")
+
+from qgisconefor import (  # noqa: E402
+    coneforinputsprocessor,
+    distances,
+    edgedistances,
+    nodeids,
+    nodestore,
+    textfiles,
+    utilities,
+)
+from qgisconefor.schemas import LogVerbosity  # noqa: E402
+
+
+def _ignore_message(message):
+    pass
+
+
+def _read_connections(path):
+    """Read a connection file into a mapping of pairs of node ids to distances."""
+    lines = path.read_text(encoding="utf-8").splitlines()
+    assert lines[-1] == ""
+    result = {}
+    for line in lines[:-1]:
+        from_node_id, to_node_id, distance = line.split("\t")
+        result[(int(from_node_id), int(to_node_id))] = float(distance)
+    # each pair is written only once
+    assert len(result) == len(lines) - 1
+    return result
+
+
+def _get_nearest_neighbour_connections(node_ids, all_distances, num_neighbours, max_distance):
+    """Find the connections of each node to its nearest neighbours by brute force.
+
+    A pair is keyed by the node ids of its positions in ascending order.
+    """
+    result = {}
+    for row, row_distances in enumerate(all_distances.tolist()):
+        neighbours = sorted(
+            (distance, col) for col, distance in enumerate(row_distances) if col != row)
+        for distance, col in neighbours[:num_neighbours]:
+            if max_distance is None or distance <= max_distance:
+                first, second = min(row, col), max(row, col)
+                result.setdefault((node_ids[first], node_ids[second]), distance)
+    return result
+
+
+def _get_geometry_store(layer):
+    features = sorted(layer.getFeatures(), key=lambda feat: feat.id())
+    return edgedistances.GeometryStore(
+        node_ids=[feat["node_id"] for feat in features],
+        feature_ids=[feat.id() for feat in features],
+        geometries=[feat.geometry() for feat in features],
+    )
+
+
+@pytest.mark.parametrize("num_nearest_neighbours", [1, 4])
+@pytest.mark.parametrize("max_distance", [None, 900.0])
+def test_nearest_neighbour_centroid_distances(
+        tmp_path, planar_measurer, num_nearest_neighbours, max_distance):
+    import qgis.core
+
+    rng = np.random.default_rng(23)
+    num_nodes = 120
+    coordinates = rng.random((num_nodes, 2)) * 10_000
+    node_ids = (rng.permutation(num_nodes) + 1).tolist()
+    centroids = distances.CentroidStore(
+        node_ids=node_ids, feature_ids=np.arange(num_nodes), coordinates=coordinates)
+    path = coneforinputsprocessor.write_connection_file_with_centroid_distances(
+        centroids,
+        qgis.core.QgsCoordinateReferenceSystem("EPSG:3857"),
+        tmp_path / "distances.txt",
+        None,
+        0.0,
+        info_callback=_ignore_message,
+        max_distance=max_distance,
+        num_nearest_neighbours=num_nearest_neighbours,
+    )
+    all_distances = np.hypot(*(coordinates[:, np.newaxis, :] - coordinates).transpose(2, 0, 1))
+    expected = _get_nearest_neighbour_connections(
+        node_ids, all_distances, num_nearest_neighbours, max_distance)
+    result = _read_connections(path)
+    assert result.keys() == expected.keys()
+    assert result == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("num_nearest_neighbours", [1, 3])
+def test_nearest_neighbour_edge_distances(tmp_path, polygon_layer, num_nearest_neighbours):
+    store = _get_geometry_store(polygon_layer)
+    all_distances = np.array([
+        [first.distance(second) for second in store.geometries]
+        for first in store.geometries
+    ])
+    expected = _get_nearest_neighbour_connections(
+        store.node_ids, all_distances, num_nearest_neighbours, None)
+    path = coneforinputsprocessor.write_connection_file_with_edge_distances(
+        store,
+        polygon_layer.crs(),
+        tmp_path / "distances.txt",
+        None,
+        0.0,
+        info_callback=_ignore_message,
+        num_nearest_neighbours=num_nearest_neighbours,
+    )
+    result = _read_connections(path)
+    assert result.keys() == expected.keys()
+    assert result == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("max_distance", [None, 2000.0])
+def test_edge_distances_skip_nodes_without_geometry(tmp_path, polygon_layer, max_distance):
+    import qgis.core
+
+    store = _get_geometry_store(polygon_layer)
+    num_nodes = len(store)
+    geometries_without_distance = [
+        (0, qgis.core.QgsGeometry()),
+        (30, qgis.core.QgsGeometry.fromWkt("Polygon EMPTY")),
+    ]
+    for position, geom in geometries_without_distance:
+        store.node_ids.insert(position, num_nodes + 1 + position)
+        store.feature_ids.insert(position, -1 - position)
+        store.geometries.insert(position, geom)
+    messages = []
+    path = coneforinputsprocessor.write_connection_file_with_edge_distances(
+        store,
+        polygon_layer.crs(),
+        tmp_path / "distances.txt",
+        None,
+        0.0,
+        info_callback=messages.append,
+        max_distance=max_distance,
+    )
+    result = _read_connections(path)
+    assert all(node_id <= num_nodes for pair in result for node_id in pair)
+    assert all(distance >= 0 for distance in result.values())
+    if max_distance is None:
+        assert len(result) == num_nodes * (num_nodes - 1) // 2
+    assert any("Skipping 2 nodes" in message for message in messages)
+
+
+def test_parallel_centroid_distances_match_a_single_process(tmp_path, planar_measurer):
+    import qgis.core
+
+    rng = np.random.default_rng(19)
+    num_nodes = 400
+    centroids = distances.CentroidStore(
+        node_ids=(rng.permutation(num_nodes) + 1).tolist(),
+        feature_ids=np.arange(num_nodes),
+        coordinates=rng.random((num_nodes, 2)) * 100_000,
+    )
+    crs = qgis.core.QgsCoordinateReferenceSystem("EPSG:3857")
+    contents = []
+    for num_workers in (1, 3):
+        path = coneforinputsprocessor.write_connection_file_with_centroid_distances(
+            centroids,
+            crs,
+            tmp_path / f"distances_{num_workers}.txt",
+            None,
+            0.0,
+            info_callback=_ignore_message,
+            num_workers=num_workers,
+            writer_memory_budget=10_000,
+        )
+        contents.append(path.read_bytes())
+    assert contents[0] == contents[1]
+    assert contents[0].count(b"\n") == num_nodes * (num_nodes - 1) // 2 + 1
+
+
+@pytest.mark.parametrize("max_distance", [None, 2000.0])
+def test_parallel_edge_distances_match_a_single_process(tmp_path, polygon_layer, max_distance):
+    contents = []
+    for num_workers in (1, 3):
+        path = coneforinputsprocessor.write_connection_file_with_edge_distances(
+            _get_geometry_store(polygon_layer),
+            polygon_layer.crs(),
+            tmp_path / f"distances_{num_workers}.txt",
+            None,
+            0.0,
+            info_callback=_ignore_message,
+            max_distance=max_distance,
+            num_workers=num_workers,
+        )
+        contents.append(path.read_bytes())
+    assert contents[0] == contents[1]
+
+
+def test_nearest_neighbour_pairs_do_not_depend_on_the_memory_budget(
+        tmp_path, planar_measurer, monkeypatch):
+    import qgis.core
+
+    rng = np.random.default_rng(31)
+    num_nodes = 300
+    centroids = distances.CentroidStore(
+        node_ids=(rng.permutation(num_nodes) + 1).tolist(),
+        feature_ids=np.arange(num_nodes),
+        coordinates=rng.random((num_nodes, 2)) * 10_000,
+    )
+    contents = []
+    for writer_memory_budget in (textfiles.DEFAULT_WRITER_MEMORY_BUDGET, 500):
+        path = coneforinputsprocessor.write_connection_file_with_centroid_distances(
+            centroids,
+            qgis.core.QgsCoordinateReferenceSystem("EPSG:3857"),
+            tmp_path / "distances.txt",
+            None,
+            0.0,
+            info_callback=_ignore_message,
+            num_nearest_neighbours=5,
+            writer_memory_budget=writer_memory_budget,
+        )
+        contents.append(path.read_bytes())
+        # pairs are also passed on to the writer in many small chunks
+        monkeypatch.setattr(coneforinputsprocessor, "_NEAREST_NEIGHBOUR_CHUNK_PAIRS", 10)
+    assert contents[0] == contents[1]
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "distances.txt", "distances_2.txt"]
+
+
+@pytest.mark.parametrize("max_value, expected", [
+    pytest.param(nodeids.MAX_NODE_ID, True, id="largest"),
+    pytest.param(nodeids.MAX_NODE_ID + 1, False, id="too-large"),
+])
+def test_node_identifier_fields_must_fit_node_ids(qgis_application, max_value, expected):
+    import qgis.core
+    from qgis.PyQt import QtCore
+
+    field = qgis.core.QgsField("node_id", QtCore.QVariant.ULongLong)
+    profile = coneforinputsprocessor.FieldProfile(
+        field=field, num_features=2, distinct_count=2, min_value=1, max_value=max_value)
+    assert coneforinputsprocessor.validate_node_identifier_attribute(
+        None, field, profile) is expected
+
+
+@pytest.mark.parametrize("verbosity, shows_details", [
+    pytest.param(LogVerbosity.NORMAL, False, id="normal"),
+    pytest.param(LogVerbosity.DEBUG, True, id="debug"),
+])
+def test_skipped_nodes_are_summarized(
+        tmp_path, qgis_application, monkeypatch, verbosity, shows_details):
+    monkeypatch.setattr(utilities, "_log_verbosity", verbosity)
+    nodes = nodestore.NodeStore(
+        node_ids=[1, 2, 3, 4, 5, 6],
+        feature_ids=np.arange(6),
+        attributes=[10.0, -1.0, None, -2.0, None, None],
+    )
+    messages = []
+    path = coneforinputsprocessor.generate_node_file_from_store(
+        nodes, tmp_path / "nodes.txt", None, 0.0, info_callback=messages.append)
+    assert path.read_text(encoding="utf-8") == "1\t10.0\n\n"
+    assert "2 features with a negative node attribute were skipped" in messages
+    assert "3 features without a node attribute were skipped" in messages
+    # similar messages are rate limited, only the first one of each kind is shown
+    for detail in ("Skipping this feature", "skipping this feature"):
+        num_details = len([message for message in messages if detail in message])
+        assert num_details == (1 if shows_details else 0)
+
+
+def _create_profiled_layer(rows):
+    import qgis.core
+
+    layer = qgis.core.QgsVectorLayer(
+        "None?field=node_id:integer&field=to_add:integer&field=value:integer",
+        "profiled",
+        "memory"
+    )
+    features = []
+    for row in rows:
+        feature = qgis.core.QgsFeature(layer.fields())
+        feature.setAttributes(list(row))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def test_profile_fields(qgis_application):
+    layer = _create_profiled_layer([(1, 0, 5), (2, 1, 5), (3, None, 7), (7, 1, None)])
+    profiles = coneforinputsprocessor.profile_fields(
+        layer, ["node_id", "to_add", "value", "node_id"])
+    assert list(profiles) == ["node_id", "to_add", "value"]
+    node_id = profiles["node_id"]
+    assert (node_id.num_features, node_id.distinct_count, node_id.null_count) == (4, 4, 0)
+    assert (node_id.min_value, node_id.max_value) == (1, 7)
+    assert node_id.has_unique_values
+    assert not node_id.is_binary
+    to_add = profiles["to_add"]
+    # NULL counts as one more distinct value, and makes the field not binary
+    assert (to_add.distinct_count, to_add.null_count) == (3, 1)
+    assert not to_add.is_binary
+    assert not to_add.has_unique_values
+    value = profiles["value"]
+    assert (value.distinct_count, value.null_count, value.min_value, value.max_value) == (
+        3, 1, 5, 7)
+
+
+def test_profile_fields_of_binary_fields(qgis_application):
+    layer = _create_profiled_layer([(1, 0, 5), (2, 1, 5), (3, 1, 7)])
+    profile = coneforinputsprocessor.profile_fields(layer, ["to_add"])["to_add"]
+    assert profile.is_binary
+    assert profile.num_features == 3
+
+
+def test_profile_fields_pushed_down_to_a_geopackage(
+        point_layer, geopackage_point_layer, aggregate_pushdown_results):
+    pushed_down = coneforinputsprocessor.profile_fields(geopackage_point_layer, ["node_id"])
+    assert len(aggregate_pushdown_results) == 1
+    assert aggregate_pushdown_results[0] is not None
+    scanned = coneforinputsprocessor.profile_fields(point_layer, ["node_id"])
+    assert [
+        (profile.num_features, profile.distinct_count, profile.null_count,
+         profile.min_value, profile.max_value, profile.is_binary)
+        for profile in (pushed_down["node_id"], scanned["node_id"])
+    ] == [(200, 200, 0, 1, 200, False)] * 2
+
+
+def test_conefor_files_are_generated_from_a_single_read(tmp_path, polygon_layer, planar_measurer):
+    from qgisconefor.schemas import NodeConnectionType
+
+    read_requests = []
+
+    def get_features(request):
+        read_requests.append(request)
+        return polygon_layer.getFeatures(request)
+
+    specs = [
+        coneforinputsprocessor.ConnectionFileSpec(
+            NodeConnectionType.EDGE_DISTANCE, tmp_path / "edges.txt", max_distance=3000.0),
+        coneforinputsprocessor.ConnectionFileSpec(
+            NodeConnectionType.CENTROID_DISTANCE, tmp_path / "centroids.txt"),
+        coneforinputsprocessor.ConnectionFileSpec(
+            NodeConnectionType.CENTROID_DISTANCE,
+            tmp_path / "probabilities.txt",
+            decay_distance=1000.0,
+            decay_probability=0.5,
+        ),
+        coneforinputsprocessor.ConnectionFileSpec(
+            NodeConnectionType.EDGE_DISTANCE_NEAREST_NEIGHBOURS,
+            tmp_path / "nearest.txt",
+            num_nearest_neighbours=2,
+        ),
+    ]
+    generated_files = coneforinputsprocessor.generate_conefor_files(
+        node_id_field_name="node_id",
+        node_attribute_field_name=None,
+        nodes_to_add_field_name=None,
+        crs=polygon_layer.crs(),
+        feature_iterator_factory=get_features,
+        fields=polygon_layer.fields(),
+        num_features=polygon_layer.featureCount(),
+        nodes_output_path=tmp_path / "nodes.txt",
+        connection_files=specs,
+        progress_callback=None,
+        info_callback=_ignore_message,
+        area_calculator=coneforinputsprocessor.get_area_calculator(polygon_layer.crs()),
+    )
+    assert len(read_requests) == 1
+    assert generated_files.connections_paths == [spec.output_path for spec in specs]
+    store = _get_geometry_store(polygon_layer)
+    lines = generated_files.nodes_path.read_text(encoding="utf-8").splitlines()[:-1]
+    node_areas = {int(node_id): float(area) for node_id, area in map(str.split, lines)}
+    assert node_areas == pytest.approx({node_id: 150 * 150 for node_id in store.node_ids})
+    centroids = distances.CentroidStore(
+        node_ids=store.node_ids,
+        feature_ids=np.array(store.feature_ids),
+        coordinates=np.array([
+            (centroid.x(), centroid.y())
+            for centroid in (geom.centroid().asPoint() for geom in store.geometries)
+        ]),
+    )
+    for spec in specs:
+        path = tmp_path / f"expected_{spec.output_path.name}"
+        if spec.uses_edges:
+            coneforinputsprocessor.write_connection_file_with_edge_distances(
+                _get_geometry_store(polygon_layer),
+                polygon_layer.crs(),
+                path,
+                None,
+                0.0,
+                info_callback=_ignore_message,
+                max_distance=spec.max_distance,
+                num_nearest_neighbours=spec.num_nearest_neighbours,
+            )
+        else:
+            coneforinputsprocessor.write_connection_file_with_centroid_distances(
+                centroids,
+                polygon_layer.crs(),
+                path,
+                None,
+                0.0,
+                info_callback=_ignore_message,
+                distance_transform=spec.get_distance_transform(),
+            )
+        assert spec.output_path.read_bytes() == path.read_bytes()
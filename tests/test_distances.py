@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("qgis.core")
+
+from qgisconefor import distances  # noqa: E402
+
+# GRS80 ellipsoid, as used in the examples of Vincenty's paper
+_GRS80 = distances.Ellipsoid(semi_major_axis=6378137.0, semi_minor_axis=6356752.314140)
+
+
+def _get_all_block_pairs(num_nodes, blocks):
+    pairs = []
+    for row_start, row_end in blocks:
+        rows, cols = distances.get_upper_triangle_pairs(num_nodes, row_start, row_end)
+        pairs.extend(zip(rows.tolist(), cols.tolist()))
+    return pairs
+
+
+@pytest.mark.parametrize("num_nodes", [0, 1, 2, 3, 10, 101])
+@pytest.mark.parametrize("max_pairs_per_block", [1, 7, 50, 10_000])
+def test_row_blocks_cover_each_pair_once_and_in_order(num_nodes, max_pairs_per_block):
+    blocks = list(distances.iter_upper_triangle_row_blocks(num_nodes, max_pairs_per_block))
+    expected_rows, expected_cols = np.triu_indices(num_nodes, k=1)
+    assert _get_all_block_pairs(num_nodes, blocks) == list(
+        zip(expected_rows.tolist(), expected_cols.tolist()))
+    for row_start, row_end in blocks:
+        rows, _ = distances.get_upper_triangle_pairs(num_nodes, row_start, row_end)
+        # a block is only bigger than the maximum when it holds a single row
+        assert rows.size <= max_pairs_per_block or row_end - row_start == 1
+
+
+@pytest.mark.parametrize("start_row, stop_row", [(0, 4), (4, 9), (9, 30), (3, 3)])
+def test_row_blocks_of_a_range_of_rows(start_row, stop_row):
+    num_nodes = 30
+    blocks = list(
+        distances.iter_upper_triangle_row_blocks(num_nodes, 20, start_row, stop_row))
+    assert all(start_row <= row_start < row_end <= stop_row for row_start, row_end in blocks)
+    assert _get_all_block_pairs(num_nodes, blocks) == [
+        (row, col) for row in range(start_row, min(stop_row, num_nodes))
+        for col in range(row + 1, num_nodes)
+    ]
+
+
+@pytest.mark.parametrize("row_start, row_end", [(0, 1), (0, 12), (5, 9), (11, 12)])
+def test_distance_block_counts_its_triangle_pairs(row_start, row_end):
+    num_nodes = 12
+    rows, cols = distances.get_upper_triangle_pairs(num_nodes, row_start, row_end)
+    block = distances.DistanceBlock(
+        row_start=row_start, row_end=row_end, rows=rows, cols=cols, distances=np.empty(0))
+    assert block.num_triangle_pairs(num_nodes) == rows.size
+
+
+def test_planar_distances():
+    coordinates = np.array([(0.0, 0.0), (3.0, 4.0), (-1.0, 1.0)])
+    rows, cols = distances.get_upper_triangle_pairs(3, 0, 2)
+    np.testing.assert_allclose(
+        distances.measure_planar_distances(coordinates, rows, cols),
+        [5.0, np.sqrt(2.0), np.sqrt(25.0)]
+    )
+
+
+@pytest.mark.parametrize("first, second, expected", [
+    pytest.param(
+        (144 + 25 / 60 + 29.52440 / 3600, -(37 + 57 / 60 + 3.72030 / 3600)),
+        (143 + 55 / 60 + 35.38390 / 3600, -(37 + 39 / 60 + 10.15610 / 3600)),
+        54972.271,
+        id="flinders-peak-buninyong"
+    ),
+    pytest.param((0.0, 0.0), (90.0, 0.0), _GRS80.semi_major_axis * np.pi / 2, id="equator"),
+    pytest.param((10.0, 45.0), (10.0, 45.0), 0.0, id="same-point"),
+])
+def test_geodesic_kernel(first, second, expected):
+    result = distances.measure_geodesic_distances(
+        np.array([first, second]), np.array([0]), np.array([1]), _GRS80)
+    assert result[0] == pytest.approx(expected, abs=distances.GEODESIC_KERNEL_TOLERANCE)
+
+
+def test_geodesic_kernel_flags_nearly_antipodal_points():
+    lon_lat = np.array([(0.0, 0.5), (179.5, -0.5), (10.0, 10.0)])
+    result = distances.measure_geodesic_distances(
+        lon_lat, np.array([0, 0]), np.array([1, 2]), _GRS80)
+    assert np.isnan(result[0])
+    assert not np.isnan(result[1])
+
+
+def test_geodesic_kernel_matches_distance_area(qgis_application):
+    import qgis.core
+
+    measurer = qgis.core.QgsDistanceArea()
+    measurer.setSourceCrs(
+        qgis.core.QgsCoordinateReferenceSystem("EPSG:4326"),
+        qgis.core.QgsProject.instance().transformContext()
+    )
+    measurer.setEllipsoid("EPSG:7030")
+    rng = np.random.default_rng(3)
+    lon_lat = np.column_stack([rng.uniform(-10, 10, 40), rng.uniform(35, 55, 40)])
+    rows, cols = distances.get_upper_triangle_pairs(len(lon_lat), 0, len(lon_lat))
+    result = distances.measure_geodesic_distances(
+        lon_lat, rows, cols, distances.Ellipsoid.from_measurer(measurer))
+    points = [qgis.core.QgsPointXY(x, y) for x, y in lon_lat.tolist()]
+    expected = distances.measure_distances_with_measurer(points, rows, cols, measurer)
+    np.testing.assert_allclose(result, expected, rtol=0, atol=distances.GEODESIC_KERNEL_TOLERANCE)
+
+
+def test_engine_blocks_within_distance_match_all_pairs(qgis_application):
+    import qgis.core
+
+    rng = np.random.default_rng(5)
+    coordinates = rng.random((300, 2)) * 1000
+    measurer = qgis.core.QgsDistanceArea()
+    engine = distances.CentroidDistanceEngine(coordinates, measurer, max_pairs_per_block=1000)
+    all_pairs = {}
+    for block in engine.iter_blocks():
+        all_pairs.update(zip(zip(block.rows.tolist(), block.cols.tolist()), block.distances))
+    assert len(all_pairs) == engine.num_pairs
+    max_distance = 120.0
+    within_distance = {}
+    for block in engine.iter_blocks(max_distance=max_distance):
+        within_distance.update(
+            zip(zip(block.rows.tolist(), block.cols.tolist()), block.distances))
+    assert within_distance == {
+        pair: distance for pair, distance in all_pairs.items() if distance <= max_distance}
+
+
+def test_engine_nearest_neighbours_with_an_ellipsoid(qgis_application):
+    import qgis.core
+
+    measurer = qgis.core.QgsDistanceArea()
+    measurer.setSourceCrs(
+        qgis.core.QgsCoordinateReferenceSystem("EPSG:4326"),
+        qgis.core.QgsProject.instance().transformContext()
+    )
+    measurer.setEllipsoid("EPSG:7030")
+    rng = np.random.default_rng(29)
+    # at high latitudes, the nearest points in degrees are often not the nearest in meters
+    lon_lat = np.column_stack([rng.uniform(-20, 20, 60), rng.uniform(60, 75, 60)])
+    engine = distances.CentroidDistanceEngine(lon_lat, measurer)
+    num_neighbours = 3
+    for row, neighbours, neighbour_distances in engine.iter_nearest_neighbours(num_neighbours):
+        cols = np.delete(np.arange(engine.num_nodes), row)
+        all_distances = engine.measure(np.full(cols.size, row), cols)
+        nearest = np.lexsort((cols, all_distances))[:num_neighbours]
+        assert neighbours.tolist() == cols[nearest].tolist()
+        np.testing.assert_allclose(neighbour_distances, all_distances[nearest])
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("qgis.gui")
+# the Processing plugin of QGIS must also be importable
+pytest.importorskip("processing")
+
+from qgisconefor import (  # noqa: E402
+    layeranalysis,
+    main,
+    schemas,
+)
+
+
+def test_scheduler_drops_results_of_superseded_tasks(qgis_application, polygon_layer):
+    import qgis.core
+
+    project = qgis.core.QgsProject.instance()
+    project.addMapLayer(polygon_layer)
+    layer_id = polygon_layer.id()
+    try:
+        scheduler = main.LayerAnalysisScheduler(layeranalysis.LayerAnalysisCache())
+        fingerprints = {layer_id: layeranalysis.get_layer_fingerprint(polygon_layer)}
+        cached = schemas.LayerRelevantFields(unique_field_names=["node_id"])
+        # a cached layer is handled without starting an analysis task
+        scheduler.cache.store(polygon_layer, fingerprints[layer_id], cached)
+        emitted = []
+        scheduler.layers_analyzed.connect(emitted.append)
+        scheduler.schedule([layer_id])
+        scheduler._start_pending()
+        older_generation = scheduler._generation
+        scheduler.schedule([layer_id])
+        scheduler._start_pending()
+        assert emitted == [{layer_id: cached}, {layer_id: cached}]
+        newer = schemas.LayerRelevantFields(unique_field_names=["fid"])
+        scheduler._handle_layer_analyzed(scheduler._generation, fingerprints, layer_id, newer)
+        # a superseded task delivers its result last
+        older = schemas.LayerRelevantFields()
+        scheduler._handle_layer_analyzed(older_generation, fingerprints, layer_id, older)
+        assert emitted[2:] == [{layer_id: newer}]
+        assert scheduler.cache.get(
+            polygon_layer, fingerprints[layer_id]).relevant_fields == newer
+    finally:
+        project.removeMapLayer(layer_id)
@@ -0,0 +1,188 @@
+import dataclasses
+
+import pytest
+
+pytest.importorskip("qgis.core")
+
+from qgisconefor import (  # noqa: E402
+    coneforinputsprocessor,
+    nodestore,
+    sharding,
+)
+from qgisconefor.schemas import NodeConnectionType  # noqa: E402
+
+
+def _ignore_message(message):
+    pass
+
+
+def _write_shards(output_dir, num_nodes, num_shards):
+    """Write the partial files and manifests of the shards of a fake run."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    boundaries = sharding.get_shard_boundaries(num_nodes, num_shards)
+    manifest_paths = []
+    for shard_index in range(num_shards):
+        stem = sharding.get_shard_stem("distances", shard_index, num_shards)
+        row_start = boundaries[shard_index]
+        row_end = boundaries[shard_index + 1]
+        rows = [
+            f"{row}\t{col}\t{float(row + col)!r}\n"
+            for row in range(row_start, row_end) for col in range(row + 1, num_nodes)
+        ]
+        if len(rows) > 0:
+            partial_path = output_dir / f"{stem}.txt"
+            partial_path.write_text("".join(rows) + "\n", encoding="utf-8")
+            partial_file_name = partial_path.name
+            partial_file_digest = sharding.get_file_digest(partial_path)
+        else:
+            partial_file_name = None
+            partial_file_digest = None
+        manifest = sharding.ShardManifest(
+            shard_index=shard_index,
+            num_shards=num_shards,
+            row_start=row_start,
+            row_end=row_end,
+            num_rows=len(rows),
+            run_parameters={"num_nodes": num_nodes, "nodes_digest": "digest"},
+            partial_file_name=partial_file_name,
+            partial_file_digest=partial_file_digest,
+        )
+        manifest_path = output_dir / f"{stem}.json"
+        manifest_path.write_text(manifest.to_json(), encoding="utf-8")
+        manifest_paths.append(manifest_path)
+    return manifest_paths
+
+
+@pytest.mark.parametrize("num_nodes", [0, 1, 2, 3, 10, 1000])
+@pytest.mark.parametrize("num_shards", [1, 2, 7])
+def test_shard_boundaries_split_all_pairs(num_nodes, num_shards):
+    boundaries = sharding.get_shard_boundaries(num_nodes, num_shards)
+    assert len(boundaries) == num_shards + 1
+    assert boundaries[0] == 0
+    assert boundaries[-1] == num_nodes
+    assert boundaries == sorted(boundaries)
+    shard_pairs = [
+        sharding.count_pairs(num_nodes, row_start, row_end)
+        for row_start, row_end in zip(boundaries, boundaries[1:])
+    ]
+    assert sum(shard_pairs) == num_nodes * (num_nodes - 1) // 2
+
+
+def test_shard_boundaries_are_balanced():
+    num_nodes = 1000
+    boundaries = sharding.get_shard_boundaries(num_nodes, 8)
+    shard_pairs = [
+        sharding.count_pairs(num_nodes, row_start, row_end)
+        for row_start, row_end in zip(boundaries, boundaries[1:])
+    ]
+    # shards differ by less than one row's worth of pairs
+    assert max(shard_pairs) - min(shard_pairs) < num_nodes
+
+
+def test_validate_manifests_orders_shards(tmp_path):
+    manifest_paths = _write_shards(tmp_path, num_nodes=20, num_shards=4)
+    result = sharding.validate_manifests(
+        sharding.load_manifests(reversed(manifest_paths)))
+    assert [path for path, _ in result] == manifest_paths
+
+
+@pytest.mark.parametrize("change, message", [
+    pytest.param(lambda paths: paths[:-1], "Missing shards: 3", id="missing"),
+    pytest.param(lambda paths: [*paths, paths[1]], "given twice", id="duplicate"),
+    pytest.param(lambda paths: [], "No shard manifests", id="empty"),
+])
+def test_validate_manifests_detects_missing_and_duplicate_shards(tmp_path, change, message):
+    manifest_paths = _write_shards(tmp_path, num_nodes=20, num_shards=4)
+    with pytest.raises(sharding.ShardValidationError, match=message):
+        sharding.validate_manifests(sharding.load_manifests(change(manifest_paths)))
+
+
+def test_validate_manifests_detects_changed_partial_files(tmp_path):
+    manifest_paths = _write_shards(tmp_path, num_nodes=20, num_shards=4)
+    partial_path = manifest_paths[2].with_suffix(".txt")
+    partial_path.write_text(partial_path.read_text() + "1\t2\t3.0\n")
+    with pytest.raises(sharding.ShardValidationError, match="does not match its manifest"):
+        sharding.validate_manifests(sharding.load_manifests(manifest_paths))
+
+
+def test_validate_manifests_detects_shards_of_other_runs(tmp_path):
+    manifest_paths = _write_shards(tmp_path / "first", num_nodes=20, num_shards=4)
+    other_paths = _write_shards(tmp_path / "second", num_nodes=21, num_shards=4)
+    with pytest.raises(sharding.ShardValidationError, match="same run"):
+        sharding.validate_manifests(
+            sharding.load_manifests([*manifest_paths[:-1], other_paths[-1]]))
+
+
+def test_merge_shards_writes_all_pairs_in_order(tmp_path):
+    num_nodes = 20
+    manifest_paths = _write_shards(tmp_path, num_nodes=num_nodes, num_shards=30)
+    result = sharding.merge_shards(
+        manifest_paths, tmp_path / "merged.txt", info_callback=_ignore_message)
+    assert result.read_text(encoding="utf-8") == "".join(
+        f"{row}\t{col}\t{float(row + col)!r}\n"
+        for row in range(num_nodes) for col in range(row + 1, num_nodes)
+    ) + "\n"
+
+
+@pytest.mark.parametrize("max_distance", [None, 1500.0])
+def test_merged_shards_match_a_single_run(tmp_path, point_layer, planar_measurer, max_distance):
+    spec = coneforinputsprocessor.ConnectionFileSpec(
+        connection_method=NodeConnectionType.CENTROID_DISTANCE,
+        output_path=tmp_path / "distances_centroids_nodes.txt",
+        max_distance=max_distance,
+    )
+    num_shards = 5
+    manifest_paths = [
+        sharding.generate_shard(
+            point_layer,
+            tmp_path / "shards",
+            shard_index,
+            num_shards,
+            spec,
+            node_id_field_name="node_id",
+            writer_memory_budget=1000,
+            info_callback=_ignore_message,
+        )
+        for shard_index in range(num_shards)
+    ]
+    merged_path = sharding.merge_shards(
+        reversed(manifest_paths), tmp_path / "merged.txt", info_callback=_ignore_message)
+    nodes = nodestore.extract_nodes(
+        "node_id", None, None, point_layer.getFeatures, point_layer.fields(),
+        keep_centroids=True)
+    single_path = coneforinputsprocessor.write_connection_file_with_centroid_distances(
+        nodes.get_centroid_store(),
+        point_layer.crs(),
+        tmp_path / "single.txt",
+        None,
+        0.0,
+        info_callback=_ignore_message,
+        max_distance=max_distance,
+    )
+    assert merged_path.read_bytes() == single_path.read_bytes()
+
+
+def test_nearest_neighbours_cannot_be_sharded(tmp_path, point_layer):
+    spec = coneforinputsprocessor.ConnectionFileSpec(
+        connection_method=NodeConnectionType.CENTROID_DISTANCE_NEAREST_NEIGHBOURS,
+        output_path=tmp_path / "distances.txt",
+        num_nearest_neighbours=3,
+    )
+    with pytest.raises(ValueError):
+        sharding.generate_shard(
+            point_layer, tmp_path, 0, 2, spec, info_callback=_ignore_message)
+
+
+def test_manifest_round_trip():
+    manifest = sharding.ShardManifest(
+        shard_index=1,
+        num_shards=2,
+        row_start=5,
+        row_end=10,
+        num_rows=12,
+        run_parameters={"num_nodes": 10, "max_distance": None},
+        partial_file_name="distances.shard-0001-of-0002.txt",
+        partial_file_digest="abc",
+    )
+    assert sharding.ShardManifest.from_json(manifest.to_json()) == manifest
+    assert dataclasses.asdict(manifest)["format_version"] == sharding.MANIFEST_FORMAT_VERSION
@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+
+from qgisconefor import textfiles
+
+
+def _read_rows(path):
+    text = path.read_text(encoding="utf-8")
+    assert text.endswith("\n\n")
+    return text[:-1].splitlines()
+
+
+@pytest.mark.parametrize("columns, decimal_places, expected", [
+    pytest.param(
+        ([3, 1], [10, 20]),
+        None,
+        "3\t10\n1\t20\n",
+        id="integers"
+    ),
+    pytest.param(
+        ([1, 2], [3, 4], [0.1, 2 / 3]),
+        None,
+        f"1\t3\t0.1\n2\t4\t{2 / 3!r}\n",
+        id="full-precision"
+    ),
+    pytest.param(
+        ([1, 2], [3, 4], [0.1, 2 / 3]),
+        3,
+        "1\t3\t0.100\n2\t4\t0.667\n",
+        id="decimal-places"
+    ),
+])
+def test_format_lines(columns, decimal_places, expected):
+    buffer = textfiles.ConeforRecordBuffer.from_columns(*columns)
+    assert "".join(buffer.format_lines(decimal_places=decimal_places)) == expected
+
+
+def test_format_lines_of_a_slice_in_several_chunks(monkeypatch):
+    monkeypatch.setattr(textfiles, "_FORMAT_CHUNK_ROWS", 3)
+    buffer = textfiles.ConeforRecordBuffer(2)
+    buffer.extend((index, index * 10) for index in range(10))
+    lines = "".join(buffer.format_lines(start=2, stop=9)).splitlines()
+    assert lines == [f"{index}\t{index * 10}" for index in range(2, 9)]
+
+
+def test_record_buffer_switches_column_to_float():
+    buffer = textfiles.ConeforRecordBuffer(2)
+    buffer.append((1, 2))
+    buffer.append((2, 2.5))
+    assert buffer.get_column(0).dtype == np.int64
+    assert buffer.get_column(1).tolist() == [2.0, 2.5]
+
+
+def test_writer_streams_sorted_rows(tmp_path):
+    rows = [(index // 3, index, index * 0.5) for index in range(30)]
+    with textfiles.ConeforTextFileWriter(tmp_path / "out.txt") as writer:
+        writer.write_rows(rows[:10])
+        writer.write_rows(rows[10:])
+        result = writer.close()
+    assert result == tmp_path / "out.txt"
+    assert _read_rows(result) == [f"{a}\t{b}\t{c!r}" for a, b, c in rows]
+    assert sorted(tmp_path.iterdir()) == [result]
+
+
+def test_writer_is_a_stable_sort_by_first_column(tmp_path):
+    rng = np.random.default_rng(42)
+    keys = rng.integers(0, 50, size=5000)
+    rows = [(int(key), index, float(index) / 7) for index, key in enumerate(keys)]
+    # a small memory budget forces the rows to be spilled in many sorted runs
+    writer = textfiles.ConeforTextFileWriter(tmp_path / "out.txt", memory_budget=2000)
+    with writer:
+        for start in range(0, len(rows), 100):
+            writer.write_rows(rows[start:start + 100])
+        result = writer.close()
+    expected = sorted(rows, key=lambda row: row[0])
+    assert writer.num_rows == len(rows)
+    assert _read_rows(result) == [f"{a}\t{b}\t{c!r}" for a, b, c in expected]
+    assert sorted(tmp_path.iterdir()) == [result]
+
+
+def test_writer_sorts_large_integer_keys_exactly(tmp_path):
+    # these keys are equal when converted to floating point
+    big = 2 ** 53
+    rows = [(big + 1, 1), (big, 2), (big + 1, 3), (big, 4)]
+    writer = textfiles.ConeforTextFileWriter(tmp_path / "out.txt", memory_budget=16)
+    with writer:
+        for row in rows:
+            writer.write_rows([row])
+        result = writer.close()
+    assert _read_rows(result) == [
+        f"{big}\t2", f"{big}\t4", f"{big + 1}\t1", f"{big + 1}\t3"]
+
+
+def test_writer_without_rows_does_not_create_a_file(tmp_path):
+    with textfiles.ConeforTextFileWriter(tmp_path / "out.txt") as writer:
+        assert writer.close() is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_writer_discards_files_on_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        with textfiles.ConeforTextFileWriter(tmp_path / "out.txt", memory_budget=16) as writer:
+            writer.write_rows([(2, 1), (1, 1), (3, 1)])
+            raise RuntimeError()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_writer_does_not_overwrite_existing_files(tmp_path):
+    (tmp_path / "out.txt").write_text("existing")
+    with textfiles.ConeforTextFileWriter(tmp_path / "out.txt") as writer:
+        writer.write_rows([(1, 2)])
+        result = writer.close()
+    assert result == tmp_path / "out_2.txt"
+    assert (tmp_path / "out.txt").read_text() == "existing"
+
+
+def test_writer_merges_sorted_files_as_a_stable_sort(tmp_path, monkeypatch):
+    # merging in several passes must keep the order of the inputs
+    monkeypatch.setattr(textfiles, "_MAX_MERGE_FAN_IN", 2)
+    rng = np.random.default_rng(7)
+    input_dir = tmp_path / "inputs"
+    input_dir.mkdir()
+    all_rows = []
+    with textfiles.ConeforTextFileWriter(tmp_path / "merged.txt", memory_budget=64) as writer:
+        for file_index in range(5):
+            keys = np.sort(rng.integers(0, 20, size=50))
+            rows = [(int(key), file_index, row_index) for row_index, key in enumerate(keys)]
+            if file_index == 2:
+                # rows may also be written in between sorted files
+                writer.write_rows(rows[::-1])
+            else:
+                path = input_dir / f"input-{file_index}.txt"
+                path.write_text("".join(f"{a}\t{b}\t{c}\n" for a, b, c in rows) + "\n")
+                writer.add_sorted_file(path, len(rows))
+            all_rows.extend(rows if file_index != 2 else rows[::-1])
+        result = writer.close()
+    expected = sorted(all_rows, key=lambda row: row[0])
+    assert writer.num_rows == len(all_rows)
+    assert _read_rows(result) == [f"{a}\t{b}\t{c}" for a, b, c in expected]
+    # sorted files are left untouched
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["inputs", "merged.txt"]
+    assert len(list(input_dir.iterdir())) == 4
+
+
+def test_writer_does_not_remove_sorted_files_on_error(tmp_path):
+    path = tmp_path / "input.txt"
+    path.write_text("1\t2\n\n")
+    with pytest.raises(RuntimeError):
+        with textfiles.ConeforTextFileWriter(tmp_path / "out.txt") as writer:
+            writer.add_sorted_file(path, 1)
+            raise RuntimeError()
+    assert list(tmp_path.iterdir()) == [path]